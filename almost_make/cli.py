@@ -1,8 +1,20 @@
 #!/usr/bin/python3
-import sys, os
+import sys, os, atexit, json, contextlib
 from almost_make.utils.printUtil import *
 import almost_make.utils.makeUtil as makeUtility
 import almost_make.utils.macroUtil as macroUtility
+import almost_make.utils.errorUtil as errorUtility
+import almost_make.utils.jobserverUtil as jobserverUtil
+import almost_make.utils.scheduleUtil as scheduleUtil
+import almost_make.utils.parseCacheUtil as parseCacheUtil
+import almost_make.utils.hashStateUtil as hashStateUtil
+import almost_make.utils.actionCacheUtil as actionCacheUtil
+import almost_make.utils.traceUtil as traceUtil
+import almost_make.utils.buildLogUtil as buildLogUtil
+import almost_make.utils.restatLogUtil as restatLogUtil
+import almost_make.utils.outputSyncUtil as outputSyncUtil
+import almost_make.utils.targetLogUtil as targetLogUtil
+import almost_make.utils.loadControlUtil as loadControlUtil
 from almost_make.utils.argsUtil import *
 from almost_make import version
 
@@ -17,14 +29,18 @@ ARGUMENT_MAPPINGS = \
     's': 'silent',
     'b': 'built-in-shell',
     'w': 'print-directory',
-    'j': 'jobs'
+    'j': 'jobs',
+    'O': 'output-sync',
+    'q': 'question',
+    'l': 'load-average'
 }
 
 # These are flags, so don't associate values with them...
 JUST_FLAGS = \
 {
     'help', 'keep-going', 'print-expanded', 'just-print', 'silent', 'built-in-shell',
-    'print-directory', 'undefined-is-error'
+    'print-directory', 'undefined-is-error', 'print-stat-cache',
+    'parse-cache', 'hash', 'build-log', 'restat', 'question', 'verbose'
 }
 
 # Don't save these when we recurse...
@@ -34,7 +50,9 @@ NO_SAVE_ARGS = \
     'f', 'file',
     'default',
     'h', 'help', 
-    'version'
+    'version',
+    'trace', # Recursive calls would overwrite our trace.
+    'plan'
 }
 
 def printHelp():
@@ -50,10 +68,14 @@ def printHelp():
     cprint("    --file", FORMAT_COLORS['GREEN'])
     print("\t\t\t File to parse (default is Makefile).")
     cprint("    -k", FORMAT_COLORS['GREEN'])
-    print("\t\t\t\t Keep going if errors are encountered.")
+    print("\t\t\t\t Keep going if errors are encountered: when a recipe fails, still make the targets that don't depend on it, then list the targets that couldn't be made and exit with status 2. Without -k, a failed recipe stops the commands other recipes are running.")
     cprint("    -n, --just-print", FORMAT_COLORS['GREEN'])
     cprint("\t\t Just print commands to be run, without evaluating (print commands, don't send them to the shell). ")
     print("Be aware that $(shell ...) macros are still evaluated. This option only applies to individual commands.")
+    cprint("    -q, --question", FORMAT_COLORS['GREEN'])
+    print("\t\t Don't run any recipes. Exit with status 1 if any target needs to be made, 0 otherwise.")
+    cprint("    --plan=json", FORMAT_COLORS['GREEN'])
+    print("\t\t Don't run any recipes. Print, as JSON, each target that needs to be made (in an order in which they could be made), the targets it waits for, and its expanded commands.")
     cprint("    -p", FORMAT_COLORS['GREEN'])
     print("\t\t\t\t Rather than finding targets, print the makefile, with top-level targets expanded.")
     cprint("    -C dir", FORMAT_COLORS['GREEN'])
@@ -61,9 +83,41 @@ def printHelp():
     cprint("    -w, --print-directory", FORMAT_COLORS['GREEN'])
     print("\t Print the current directory before and after running make. ")
     cprint("    -j, --jobs", FORMAT_COLORS['GREEN'])
-    print("\t\t\t Maximum number of jobs (e.g. almake -j 8). ")
+    print("\t\t\t Maximum number of jobs (e.g. almake -j 8). Recursive invocations of make share these job slots, unless given their own -j.")
+    cprint("    -l, --load-average load", FORMAT_COLORS['GREEN'])
+    print("\t Don't start new jobs while the load (on Linux, the number of runnable threads) is at least load, unless no other jobs are running. -l without a value removes the limit.")
+    cprint("    --min-free-memory size", FORMAT_COLORS['GREEN'])
+    print("\t Don't start new jobs while less than size of memory is available, unless no other jobs are running. size is in megabytes (e.g. 512), has a unit (e.g. 2G), or is a percentage of total memory (e.g. 10%).")
+    cprint("    --executor=name", FORMAT_COLORS['GREEN'])
+    print("\t\t With -j, how recipes run at the same time: thread (the default; one thread per job) or async (from one asyncio event loop, which scales better to very large -j, e.g. with a distributed compiler).")
+    cprint("    -O, --output-sync[=mode]", FORMAT_COLORS['GREEN'])
+    print("\t With -j, collect the output of each recipe and print it all at once, so that output of recipes run at the same time isn't mixed. mode is target (the default), line (print the output of each command at once), recurse (also collect the output of recursive calls to make), or none.")
+    cprint("    --verbose", FORMAT_COLORS['GREEN'])
+    print("\t\t Print why new jobs aren't being started (see -l and --min-free-memory), and when they start again.")
     cprint("    -s, --silent", FORMAT_COLORS['GREEN'])
     print("\t\t In most cases, don't print output.")
+    cprint("    --parse-cache", FORMAT_COLORS['GREEN'])
+    print("\t\t Store parsed makefiles in .almake/parse and reuse them while the makefile, included files, relevant environment variables, and $(shell ...) and $(wildcard ...) results are unchanged.")
+    cprint("    --hash", FORMAT_COLORS['GREEN'])
+    print("\t\t\t Rebuild targets only when the contents of their prerequisites or their recipes change, rather than when prerequisites are newer. Content digests are stored in .almake/hash.db.")
+    cprint("    --cache-dir dir", FORMAT_COLORS['GREEN'])
+    print("\t\t Store the outputs of recipes in dir. When a recipe has already been run with the same commands, prerequisite contents, and PATH (and macros listed as prerequisites of .CACHE_ENV), restore its output from dir rather than running it. Several checkouts can share dir.")
+    cprint("    --cache-size size", FORMAT_COLORS['GREEN'])
+    print("\t\t Maximum size of --cache-dir, in megabytes (default 1024). The least-recently-used outputs are removed first.")
+    cprint("    --remote-cache url", FORMAT_COLORS['GREEN'])
+    print("\t\t Before running a recipe, check the remote cache at url (e.g. one served by almake_cache_server) for its output. Outputs of recipes that were run are uploaded in the background. Uses the local cache given by --cache-dir (default .almake/cache).")
+    cprint("    --trace file", FORMAT_COLORS['GREEN'])
+    print("\t\t Write a trace of time spent parsing, checking targets, and running each recipe and command to file. Load it in https://ui.perfetto.dev or chrome://tracing.")
+    cprint("    --log-dir dir", FORMAT_COLORS['GREEN'])
+    print("\t\t Also write the output of each target's recipe (and the commands it runs) to dir/target.log. Targets are named relative to the directory containing dir, so recursive calls to make can share it.")
+    cprint("    --build-log", FORMAT_COLORS['GREEN'])
+    print("\t\t Record how long each recipe takes, and the commands it ran, in .almake/log. Rebuild targets whose commands have changed since they were last made. With -j, targets on the longest path through the build (by how long their recipes took last time) start first.")
+    cprint("    --default-duration seconds", FORMAT_COLORS['GREEN'])
+    print("\t With --build-log, assume recipes that haven't run before take seconds (default 1).")
+    cprint("    --restat", FORMAT_COLORS['GREEN'])
+    print("\t\t After running each recipe, check whether its target changed. If not, don't rebuild targets that depend on it (unless they're outdated for another reason). To do this for only some targets, list them as prerequisites of .RESTAT.")
+    cprint("    --print-stat-cache", FORMAT_COLORS['GREEN'])
+    print("\t\t Print how often cached file modification times were used, rather than checking the file system, and (with --cache-dir) how often recipe outputs were restored.")
     cprint("    --undefined-is-error", FORMAT_COLORS['GREEN'])
     print("\t\t Display an error when attempting to use an undefined macro.")
     cprint("    --expand-undefined-to value", FORMAT_COLORS['GREEN'])
@@ -104,113 +158,372 @@ def printHelp():
     	  "setting MAKEFLAGS to --built-in-shell causes almake to " +
     	  "always use its built-in shell, rather than the system shell.")
 
-# On commandline run...
-def main(args=sys.argv):
-    args = parseArgs(args, ARGUMENT_MAPPINGS, strictlyFlags=JUST_FLAGS)
+# Get the maximum number of jobs and the job slots to use, given [args].
+# If a parent make shares its job server through MAKEFLAGS, join it. Otherwise, 
+# if running more than one job, start a job server for recursive calls to make.
+# [jobsGiven] should be True iff -j was given on the command line (and not through MAKEFLAGS). 
+# Like GNU make, this starts a new job server, rather than joining the parent's.
+# A make run by another's recipe in this process shares [parentSlots], that make's job slots,
+# unless given its own -j. Updates --jobserver-auth in [args].
+def getJobSlots(args, jobsGiven, errorUtil, parentSlots=None):
+    jobs = 1
+
+    if 'jobs' in args:
+        try:
+            jobs = int(args['jobs'])
+        except ValueError as ex:
+            errorUtil.reportError("Invalid argument to --jobs. This must be an integer.")
+
+    if parentSlots is not None and not jobsGiven:
+        jobSlots = jobserverUtil.SharedJobSlots(parentSlots, jobs)
+
+        # Makes started in other processes join the same job server, if there is one.
+        if jobSlots.auth is not None:
+            args['jobserver-auth'] = jobSlots.auth
+        else:
+            args.pop('jobserver-auth', None)
+        return (jobs, jobSlots)
+
+    if 'jobserver-auth' in args and not jobsGiven:
+        jobSlots = jobserverUtil.joinJobServer(str(args['jobserver-auth']), jobs)
+
+        if jobSlots is not None:
+            return (jobs, jobSlots)
+        errorUtil.logWarning("Unable to use the job server, %s. Starting a new one." % str(args['jobserver-auth']))
+    args.pop('jobserver-auth', None)
+
+    if jobs > 1:
+        jobSlots = jobserverUtil.startJobServer(jobs)
+
+        if jobSlots is not None:
+            args['jobserver-auth'] = jobSlots.auth
+            return (jobs, jobSlots)
+    return (jobs, jobserverUtil.JobSlots(jobs))
+
+# Wrap [jobSlots] so that new jobs don't start while the load or memory use is too high,
+# given -l and --min-free-memory in [args]. Returns [jobSlots] if neither is given.
+def getThrottledJobSlots(args, jobSlots, errorUtil):
+    maxLoad, minFreeMemory = None, None
+
+    # -l without a value means no limit, as in GNU make.
+    if 'load-average' in args and args['load-average'] is not True:
+        try:
+            maxLoad = float(args['load-average'])
+        except ValueError:
+            errorUtil.reportError("Invalid argument to --load-average. This must be a number.")
+
+    if 'min-free-memory' in args:
+        freeMemory = loadControlUtil.getFreeMemory()
+
+        if freeMemory is None:
+            errorUtil.logWarning("Unable to check available memory. Ignoring --min-free-memory.")
+        else:
+            try:
+                minFreeMemory = loadControlUtil.parseMemoryLimit(str(args['min-free-memory']), freeMemory[1])
+            except ValueError:
+                errorUtil.reportError("Invalid argument to --min-free-memory, %s. This must be a size (e.g. 512, 2G) or a percentage (e.g. 10%%)." % str(args['min-free-memory']))
+
+    if maxLoad is None and minFreeMemory is None:
+        return jobSlots
+
+    log = None
+    if 'verbose' in args:
+        log = lambda message: cprint("almake: %s\n" % message, "YELLOW")
+    return loadControlUtil.ThrottledJobSlots(jobSlots, maxLoad, minFreeMemory, log)
+
+# Parse [argv] (e.g. sys.argv) and the arguments in MAKEFLAGS, get job slots (see getJobSlots)
+# and save the arguments in MAKEFLAGS, for recursive calls to make. If given, [parentSlots]
+# are the job slots of the make whose recipe is running this one in the same process.
+# Returns (args, jobs, jobSlots).
+def getArgs(argv, parentSlots=None):
+    args = parseArgs(argv, ARGUMENT_MAPPINGS, strictlyFlags=JUST_FLAGS)
+    jobsGiven = 'jobs' in args
     
     # Fill args from MAKEFLAGS (see https://www.gnu.org/software/make/manual/make.html#How-the-MAKE-Variable-Works)
     args = fillArgsFromEnv(args, "MAKEFLAGS", ARGUMENT_MAPPINGS, JUST_FLAGS) # Previously-defined args take precedence.
+
+    # Recursive calls to make need to know about our job server, so do this before saving args.
+    jobs, jobSlots = 1, None
+    if not 'help' in args and not 'version' in args:
+        jobs, jobSlots = getJobSlots(args, jobsGiven, errorUtility.ErrorUtil(), parentSlots)
+
+    # Recursive calls to make run in other directories, but should share the same cache.
+    if 'cache-dir' in args:
+        args['cache-dir'] = os.path.abspath(str(args['cache-dir']))
+
+    # Paths given on the command line are relative to the directory we were started in, not -C's.
+    if 'trace' in args:
+        args['trace'] = os.path.abspath(str(args['trace']))
+
+    # Recursive calls to make should write to the same log directory.
+    if 'log-dir' in args:
+        args['log-dir'] = os.path.abspath(str(args['log-dir']))
+
     saveArgsInEnv(args, "MAKEFLAGS", NO_SAVE_ARGS) # For recursive calls to make.
-    
+    return (args, jobs, jobSlots)
+
+# On commandline run...
+def main(args=sys.argv):
+    args, jobs, jobSlots = getArgs(args)
+
     if 'help' in args:
         printHelp()
     elif 'version' in args:
         version.printVersion()
     else:
-        macroUtil = macroUtility.MacroUtil()
-        makeUtil = makeUtility.MakeUtil()
+        exitStatus = runMake(args, jobs, jobSlots, atexit.register)
 
-        fileName = 'Makefile'
-        targets = []
-        
-        defaultMacros = macroUtil.getDefaultMacros() # Fills with macros from environment, etc.
-        overrideMacros = {}
-        
-        if 'directory' in args:
+        if exitStatus != 0:
+            sys.exit(exitStatus)
+
+# Run make with [args], [jobs] and [jobSlots] (see getArgs). [atExit] is called with each function
+# that should run once make is done (e.g. to save caches), even if it fails. If given, [parent]
+# is the MakeUtil whose recipe is running this make in the same process (see runInProcess).
+# Returns make's exit status.
+def runMake(args, jobs, jobSlots, atExit, parent=None):
+    macroUtil = macroUtility.MacroUtil()
+    makeUtil = makeUtility.MakeUtil()
+
+    fileName = 'Makefile'
+    targets = []
+    
+    defaultMacros = macroUtil.getDefaultMacros() # Fills with macros from environment, etc.
+    overrideMacros = {}
+    
+    if 'directory' in args:
+        try:
+            os.chdir(args['directory'])
+        except Exception as ex:
+            print("Error changing directories: %s" % str(ex))
+            sys.exit(1)
+    
+    # If we know the path to the python interpreter...
+    if sys.executable:
+        defaultMacros["MAKE"] = sys.executable + " " + os.path.abspath(__file__) 
+                            #^ Use ourself, rather than another make implementation.
+
+    if 'keep-going' in args:
+        makeUtil.setStopOnError(False)
+    
+    if 'silent' in args:
+        makeUtil.setSilent(True)
+
+    makeUtil.setMaxJobs(jobs)
+    makeUtil.setRecursiveMake(runInProcess)
+    makeUtil.setJobSlots(getThrottledJobSlots(args, jobSlots, errorUtility.ErrorUtil()))
+
+    if 'executor' in args:
+        if not args['executor'] in scheduleUtil.EXECUTORS:
+            errorUtility.ErrorUtil().reportError("Invalid argument to --executor, %s. This must be one of %s." % (str(args['executor']), ", ".join(scheduleUtil.EXECUTORS)))
+        else:
+            makeUtil.setExecutor(args['executor'])
+
+    if 'just-print' in args:
+        makeUtil.setJustPrint(True)
+
+    if 'output-sync' in args:
+        mode = args['output-sync']
+
+        # -O without a mode.
+        if mode is True:
+            mode = outputSyncUtil.SYNC_TARGET
+
+        if not mode in outputSyncUtil.SYNC_MODES:
+            errorUtility.ErrorUtil().reportError("Invalid argument to --output-sync, %s. This must be one of %s." % (str(mode), ", ".join(outputSyncUtil.SYNC_MODES)))
+        elif jobs > 1: # Without -j, output can't be mixed, so stream it.
+            makeUtil.setOutputSync(outputSyncUtil.OutputSync(mode))
+
+    if 'restat' in args:
+        makeUtil.setRestatAll(True)
+
+    # A make run by another in this process shares its parse and stat caches.
+    if parent is not None:
+        makeUtil.setFileStateCache(parent.getFileStateCache())
+
+    if parent is not None and parent.parseCache is not None:
+        makeUtil.setParseCache(parent.parseCache)
+    elif 'parse-cache' in args:
+        makeUtil.setParseCache(parseCacheUtil.ParseCache(os.path.abspath(os.path.join(makeUtility.STATE_DIR, 'parse'))))
+
+    if 'hash' in args:
+        hashState = hashStateUtil.HashState(os.path.join(makeUtility.STATE_DIR, 'hash.db'))
+        atExit(hashState.close) # Record what was built, even if the build fails.
+        makeUtil.setHashState(hashState)
+
+    if 'remote-cache' in args and not 'cache-dir' in args:
+        args['cache-dir'] = os.path.abspath(os.path.join(makeUtility.STATE_DIR, 'cache'))
+
+    if 'cache-dir' in args:
+        actionCache = actionCacheUtil.ActionCache(args['cache-dir'])
+
+        if 'cache-size' in args:
             try:
-                os.chdir(args['directory'])
-            except Exception as ex:
-                print("Error changing directories: %s" % str(ex))
-                sys.exit(1)
-        
-        # If we know the path to the python interpreter...
-        if sys.executable:
-            defaultMacros["MAKE"] = sys.executable + " " + os.path.abspath(__file__) 
-                                #^ Use ourself, rather than another make implementation.
+                actionCache.maxSize = int(float(args['cache-size']) * 1024 * 1024)
+            except ValueError:
+                errorUtility.ErrorUtil().reportError("Invalid argument to --cache-size. This must be a number.")
 
-        if 'keep-going' in args:
-            makeUtil.setStopOnError(False)
-        
-        if 'silent' in args:
-            makeUtil.setSilent(True)
+        if 'remote-cache' in args:
+            # Imported here: http.client is slow to import, and most builds (e.g. -q on each save) don't need it.
+            import almost_make.utils.remoteCacheUtil as remoteCacheUtil
 
-        if 'jobs' in args:
-            jobs = 1
             try:
-                jobs = int(args['jobs'])
+                actionCache.setRemote(remoteCacheUtil.RemoteCache(str(args['remote-cache'])))
             except ValueError as ex:
-                makeUtil.errorUtil.reportError("Invalid argument to --jobs. This must be an integer.")
-            makeUtil.setMaxJobs(jobs)
+                errorUtility.ErrorUtil().reportError(str(ex))
 
-        if 'just-print' in args:
-            makeUtil.setJustPrint(True)
+        atExit(actionCache.close)
+        makeUtil.setActionCache(actionCache)
 
-        if 'file' in args:
-            fileName = args['file']
-        
-        if 'expand-undefined-to' in args:
-            makeUtil.setDefaultMacroExpansion(runner.stripQuotes(args["expand-undefined-to"]))
+    restatLog = restatLogUtil.RestatLog(os.path.abspath(os.path.join(makeUtility.STATE_DIR, 'restat')))
+    atExit(restatLog.close)
+    makeUtil.setRestatLog(restatLog)
+
+    if 'build-log' in args:
+        buildLog = buildLogUtil.BuildLog(os.path.join(makeUtility.STATE_DIR, 'log'))
+        atExit(buildLog.close)
+        makeUtil.setBuildLog(buildLog)
+
+    if 'default-duration' in args:
+        try:
+            makeUtil.setDefaultDuration(float(args['default-duration']))
+        except ValueError:
+            errorUtility.ErrorUtil().reportError("Invalid argument to --default-duration. This must be a number.")
+
+    if 'log-dir' in args:
+        makeUtil.setTargetLogs(targetLogUtil.TargetLogs(args['log-dir']))
+
+    if 'trace' in args:
+        tracer = traceUtil.Tracer()
+        atExit(tracer.write, args['trace'])
+        makeUtil.setTracer(tracer)
+
+    if 'file' in args:
+        fileName = args['file']
+    
+    if 'expand-undefined-to' in args:
+        makeUtil.setDefaultMacroExpansion(runner.stripQuotes(args["expand-undefined-to"]))
+    
+    if 'undefined-is-error' in args:
+        makeUtil.setDefaultMacroExpansion(None)
+
+    if len(args['default']) > 0:
+        targets = [ ]
         
-        if 'undefined-is-error' in args:
-            makeUtil.setDefaultMacroExpansion(None)
-
-        if len(args['default']) > 0:
-            targets = [ ]
-            
-            # Split into targets and default macros.
-            for arg in args['default']:
-                assignmentIndex = arg.find("=")
-                if assignmentIndex > 0:
-                    key = arg[:assignmentIndex].strip() # e.g. VAR in VAR=33
-                    val = arg[assignmentIndex+1:].strip() # e.g. 33 in VAR=33
-                    overrideMacros[key] = val
-                    defaultMacros[key] = val
-                else:
-                    targets.append(arg)
+        # Split into targets and default macros.
+        for arg in args['default']:
+            assignmentIndex = arg.find("=")
+            if assignmentIndex > 0:
+                key = arg[:assignmentIndex].strip() # e.g. VAR in VAR=33
+                val = arg[assignmentIndex+1:].strip() # e.g. 33 in VAR=33
+                overrideMacros[key] = val
+                defaultMacros[key] = val
+            else:
+                targets.append(arg)
 	
 	    # Were we told to use the built-in shell?
-        if 'built-in-shell' in args:
-            overrideMacros["_BUILTIN_SHELL"] = "1"
-            overrideMacros["_CUSTOM_BASE_COMMANDS"] = "1"
+    if 'built-in-shell' in args:
+        overrideMacros["_BUILTIN_SHELL"] = "1"
+        overrideMacros["_CUSTOM_BASE_COMMANDS"] = "1"
 	
-        if len(targets) == 0: # Select the default target, if no targets
-            targets = ['']
-        
-        if not os.path.exists(fileName):
-            cprint("The file with name \"%s\" was not found!\n" % fileName, FORMAT_COLORS['RED'])
-            print("Please check your spelling.")
-            sys.exit(1)
+    if len(targets) == 0: # Select the default target, if no targets
+        targets = ['']
+    
+    if not os.path.exists(fileName):
+        cprint("The file with name \"%s\" was not found!\n" % fileName, FORMAT_COLORS['RED'])
+        print("Please check your spelling.")
+        sys.exit(1)
 
-        fileObj = open(fileName, 'r')
-        fileContents = fileObj.read()
-        fileObj.close()
+    fileObj = open(fileName, 'r')
+    fileContents = fileObj.read()
+    fileObj.close()
 
-        if 'print-directory' in args:
-            cprint("make: ", FORMAT_COLORS['YELLOW'])
-            print ('Entering directory %s' % runner.quote(os.getcwd()))
-        
-        if not 'print-expanded' in args:
-            # Run for each target.
-            for target in targets:
-                makeUtil.runMakefile(fileContents, target, defaultMacros, overrideMacros)
-        else:
-            contents, macros = macroUtil.expandAndDefineMacros(fileContents, defaultMacros)
-            contents, macros = makeUtil.handleIncludes(contents, macros)
-            print(contents)
+    if 'print-directory' in args:
+        cprint("make: ", FORMAT_COLORS['YELLOW'])
+        print ('Entering directory %s' % runner.quote(os.getcwd()))
+    
+    exitStatus = 0
+
+    if 'question' in args:
+        if makeUtil.isMakefileOutdated(fileContents, targets, defaultMacros, overrideMacros):
+            exitStatus = 1
+    elif 'plan' in args:
+        if args['plan'] != 'json':
+            errorUtility.ErrorUtil().reportError("Invalid argument to --plan, %s. The only supported format is json." % str(args['plan']))
+
+        plan = makeUtil.planMakefile(fileContents, targets, defaultMacros, overrideMacros)
+        print(json.dumps({ 'targets': plan }, indent=2))
+    elif not 'print-expanded' in args:
+        makeUtil.runMakefile(fileContents, targets, defaultMacros, overrideMacros)
+
+        # With -k, errors don't stop make, but it still fails (with status 2, as in GNU make).
+        if makeUtil.hasFailed():
+            exitStatus = 2
+    else:
+        contents, macros = makeUtil.macroUtil.expandAndDefineMacros(fileContents, defaultMacros)
+        contents, macros = makeUtil.handleIncludes(contents, macros)
+        print(contents)
+
+    if 'print-stat-cache' in args:
+        print(makeUtil.getFileStateCache().getSummary())
+
+        if 'cache-dir' in args:
+            print(actionCache.getSummary())
+
+    if 'print-directory' in args:
+        cprint("make: ", FORMAT_COLORS['YELLOW'])
+        print ('Leaving directory %s' % runner.quote(os.getcwd()))
+
+    return exitStatus
+
+# Run make with [makeArgs] in this process, for a recipe of [parent] (a MakeUtil; see its
+# setRecursiveMake), rather than starting another almake. The new make has its own macros
+# and working directory, and shares [parent]'s job slots, stat cache and parse cache.
+# Its output goes to the file descriptors [stdout] and [stderr], if given. This process's
+# working directory, environment (e.g. MAKEFLAGS and exports) and output are restored
+# afterwards. Returns make's exit status.
+def runInProcess(makeArgs, parent, stdout=None, stderr=None):
+    origDir = os.getcwd()
+    environment = dict(os.environ)
+    savedFds = []
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    for fd, target in [ (stdout, 1), (stderr, 2) ]:
+        if fd is not None and fd != target:
+            savedFds.append((target, os.dup(target)))
+            os.dup2(fd, target)
+
+    try:
+        with contextlib.ExitStack() as cleanup:
+            args, jobs, jobSlots = getArgs([ sys.argv[0] ] + makeArgs, parent.jobSlots)
+
+            if 'help' in args:
+                printHelp()
+                return 0
+            elif 'version' in args:
+                version.printVersion()
+                return 0
+
+            cleanup.callback(jobSlots.close)
+            return runMake(args, jobs, jobSlots, cleanup.callback, parent)
+    except SystemExit as ex: # e.g. from errorUtil's reportError.
+        if ex.code is None or type(ex.code) == int:
+            return ex.code or 0
+
+        print(ex.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        for target, savedFd in savedFds:
+            os.dup2(savedFd, target)
+            os.close(savedFd)
 
-        if 'print-directory' in args:
-            cprint("make: ", FORMAT_COLORS['YELLOW'])
-            print ('Leaving directory %s' % runner.quote(os.getcwd()))
+        os.chdir(origDir)
+        os.environ.clear()
+        os.environ.update(environment)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,8 @@
+#!make
+
+all:
+	@cd sub
+	-@touch allLines.txt
+
+.ONESHELL:
+.PHONY: all
@@ -0,0 +1,14 @@
+#!make
+
+# Only prerequisites of .ONESHELL are run in one shell.
+
+inOne:
+	cd sub
+	touch inOne.txt
+
+separate:
+	cd sub
+	touch separate.txt
+
+.ONESHELL: inOne
+.PHONY: inOne separate
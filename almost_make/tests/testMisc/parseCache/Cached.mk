@@ -0,0 +1,10 @@
+#!make
+
+include values.mk
+FILES := $(wildcard *.txt)
+
+show:
+	@echo "Value: $(VALUE)"
+	@echo "Files: $(FILES)"
+
+.PHONY: show
@@ -0,0 +1,4 @@
+#!make
+
+cached.txt: cached.mk
+	cp cached.mk cached.txt
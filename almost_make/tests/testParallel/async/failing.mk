@@ -0,0 +1,12 @@
+#!make
+
+# afterFailure depends on a failing target, so it should never be made.
+
+afterFailure: fails
+	mkdir afterFailure
+
+fails:
+	@sleep 0.1
+	exit 1
+
+.PHONY: fails
@@ -0,0 +1,13 @@
+#!make
+
+# With .NOTPARALLEL, goals are made one after another, in order, even with -j.
+
+first:
+	sleep 0.5
+	mkdir firstRan
+
+second:
+	ls | grep firstRan
+
+.NOTPARALLEL:
+.PHONY: first second
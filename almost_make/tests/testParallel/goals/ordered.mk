@@ -0,0 +1,15 @@
+#!make
+
+# The prerequisites of targets listed in .NOTPARALLEL are made in order.
+
+all: first second
+
+first:
+	sleep 0.5
+	mkdir firstRan
+
+second:
+	ls | grep firstRan
+
+.NOTPARALLEL: all
+.PHONY: all first second
@@ -0,0 +1,26 @@
+#!make
+
+# broken.o fails. app depends on it, other doesn't.
+
+all: app other
+
+app: broken.o working.o
+	echo app > app.txt
+broken.o:
+	exit 2
+	echo broken > broken.txt
+working.o:
+	echo working > working.txt
+other: working.o
+	echo other > other.txt
+
+# Without -k, fast's failure should stop slow's sleep.
+race: slow fast
+slow:
+	sleep 3
+	echo slow > slow.txt
+fast:
+	sleep 0.5
+	exit 1
+
+.PHONY: all app other broken.o working.o race slow fast
@@ -0,0 +1,28 @@
+#!make
+
+# Only one link can run at a time: a second mkdir linkLock would fail.
+# waiter only finishes if other runs at the same time, so jobs outside
+# the pool still run in parallel.
+
+.POOL: link 1
+.POOL_link: %.lnk
+
+all: a.lnk b.lnk c.lnk waiter other
+
+a.lnk b.lnk c.lnk:
+	mkdir linkLock
+	sleep 0.2
+	rm -r linkLock
+	touch $@
+
+waiter:
+	sleep 0.5
+	ls | grep otherRan
+
+other:
+	mkdir otherRan
+
+clean:
+	-rm -rf linkLock otherRan a.lnk b.lnk c.lnk
+
+.PHONY: all waiter other clean
@@ -0,0 +1,8 @@
+#!make
+
+all: a b c
+
+a b c:
+	@echo made $@
+
+.PHONY: all a b c
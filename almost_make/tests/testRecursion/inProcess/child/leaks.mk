@@ -0,0 +1,9 @@
+#!make
+
+# LEAKED is only set if the environment from the last make run here was kept.
+LEAKED ?= nothing
+
+check:
+	echo "Environment: $(LEAKED)" > leaks.txt
+
+.PHONY: check
@@ -1,3 +1,3 @@
 #!/usr/bin/python3
 
-__all__ = ["argsUtil", "errorUtil", "macroUtil", "makeUtil", "shellUtil", "printUtil"]
+__all__ = ["argsUtil", "errorUtil", "macroUtil", "makeUtil", "shellUtil", "printUtil", "scheduleUtil", "jobserverUtil", "fileStateUtil", "ruleUtil", "parseCacheUtil", "hashStateUtil", "actionCacheUtil", "remoteCacheUtil", "cacheServer", "traceUtil", "buildLogUtil", "restatLogUtil", "outputSyncUtil", "targetLogUtil", "spawnUtil", "asyncScheduleUtil", "loadControlUtil"]
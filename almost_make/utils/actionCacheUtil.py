@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+
+# A content-addressed cache of recipe outputs.
+# An action is a recipe run with particular inputs. Its key is a digest of the
+# expanded commands, the contents of its prerequisites, and selected environment
+# macros. If an action with the same key was run before (e.g. in another checkout
+# that shares the cache directory), its output can be restored rather than running
+# the recipe again.
+#
+# Layout of the cache directory:
+#  - blobs/ab/abcdef...: zlib-compressed file contents, named by the digest of the
+#    uncompressed contents. Identical outputs are only stored once.
+#  - actions/0123...: JSON, naming the blob produced by each action.
+#  - size: an estimate of the size of blobs/ and actions/, in bytes. Measuring the cache
+#    means listing every entry, so it's only done when this estimate, plus what a run
+#    added, is more than the maximum size (see close).
+# Restored outputs are checked against their blobs' digests, so a corrupted (or, from a
+# remote cache, malicious) blob is never restored. Entries are touched when used. When the cache is larger than its maximum size, the
+# least-recently used actions (and blobs no longer used by any action) are removed.
+#
+# If there is a remote cache (see remoteCacheUtil), local misses are fetched from it,
+# and new actions are uploaded to it.
+
+import os, re, json, zlib, hashlib, tempfile, threading
+
+CACHE_FORMAT = 1
+DIGEST_EXP = re.compile(r'[0-9a-f]{64}')
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024 # Bytes.
+
+# Get whether [digest] is a content digest (hexadecimal SHA-256), so is safe to use in paths.
+def isValidDigest(digest):
+    return isinstance(digest, str) and DIGEST_EXP.fullmatch(digest) is not None
+
+class ActionCache:
+    def __init__(self, cacheDir, maxSize=DEFAULT_MAX_SIZE):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.blobDir = os.path.join(cacheDir, 'blobs')
+        self.actionDir = os.path.join(cacheDir, 'actions')
+        self.sizePath = os.path.join(cacheDir, 'size')
+        self.remote = None
+
+        self.lock = threading.Lock()
+        self.addedSize = 0 # Bytes written to the cache by this process.
+
+        self.hits = 0
+        self.misses = 0
+
+    # Get the key for an action that runs [commands] (a list of expanded commands), given
+    # [inputs], a list of (path, content digest), and [environment], a map from macro names to values.
+    def getKey(self, commands, inputs, environment):
+        keyData = repr((CACHE_FORMAT, commands, inputs, sorted(environment.items())))
+        return hashlib.sha256(keyData.encode('utf-8')).hexdigest()
+
+    # Also fetch actions from, and upload actions to, [remote] (a remoteCacheUtil.RemoteCache).
+    def setRemote(self, remote):
+        self.remote = remote
+
+    # Raises ValueError if [digest] isn't a digest (e.g. it's from a corrupted action record),
+    # rather than returning a path that could be outside the cache.
+    def getBlobPath(self, digest):
+        if not isValidDigest(digest):
+            raise ValueError("Invalid digest, %s." % repr(digest))
+        return os.path.join(self.blobDir, digest[:2], digest)
+
+    def getActionPath(self, key):
+        return os.path.join(self.actionDir, key)
+
+    # Write the contents of the file at [path] to the cache. Returns the content digest.
+    def storeBlob(self, path):
+        os.makedirs(self.blobDir, exist_ok=True)
+        digest = hashlib.sha256()
+        compressor = zlib.compressobj()
+
+        fd, tempPath = tempfile.mkstemp(dir=self.blobDir)
+
+        try:
+            with os.fdopen(fd, 'wb') as out, open(path, 'rb') as file:
+                chunk = file.read(CHUNK_SIZE)
+
+                while len(chunk) > 0:
+                    digest.update(chunk)
+                    out.write(compressor.compress(chunk))
+                    chunk = file.read(CHUNK_SIZE)
+                out.write(compressor.flush())
+
+            digest = digest.hexdigest()
+            blobPath = self.getBlobPath(digest)
+
+            if os.path.exists(blobPath): # Already stored.
+                os.utime(blobPath)
+                os.remove(tempPath)
+            else:
+                self.noteAdded(os.path.getsize(tempPath))
+                os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+                os.replace(tempPath, blobPath)
+        except:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        return digest
+
+    # Store the file at [outputPath] as the result of the action with key [key].
+    # Returns True on success.
+    def store(self, key, outputPath):
+        try:
+            digest = self.storeBlob(outputPath)
+            entry = { 'digest': digest, 'mode': os.stat(outputPath).st_mode & 0o777 }
+            self.writeFile(self.getActionPath(key), json.dumps(entry).encode('utf-8'))
+        except OSError:
+            return False # Caching is an optimization. Don't fail the build.
+
+        if self.remote is not None:
+            self.remote.upload(key, self)
+        return True
+
+    # Write [data] (bytes) to [path], in the cache, such that other processes
+    # never see a partially-written file.
+    def writeFile(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tempPath, path)
+        except:
+            os.remove(tempPath)
+            raise
+
+        if path != self.sizePath:
+            self.noteAdded(len(data))
+
+    # Note that [size] bytes were added to the cache. Replaced entries are counted too, so
+    # this can overestimate, which only means the cache is measured sooner.
+    def noteAdded(self, size):
+        with self.lock:
+            self.addedSize += size
+
+    # Get the estimated size of the cache (see the top of this file), or None if unknown.
+    def readSizeEstimate(self):
+        try:
+            with open(self.sizePath, 'r') as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return None
+
+    def writeSizeEstimate(self, size):
+        try:
+            self.writeFile(self.sizePath, str(size).encode('utf-8'))
+        except OSError:
+            pass # The cache will be measured again next time.
+
+    # If the action with key [key] has been stored, write its output to [outputPath]
+    # and return True. Otherwise, return False.
+    def restore(self, key, outputPath):
+        actionPath = self.getActionPath(key)
+
+        if self.remote is not None and not os.path.exists(actionPath):
+            self.remote.fetch(key, self)
+
+        try:
+            with open(actionPath, 'r') as file:
+                entry = json.load(file)
+
+            blobPath = self.getBlobPath(entry['digest'])
+            decompressor = zlib.decompressobj()
+            digest = hashlib.sha256()
+
+            # Write to a temporary file, so that a failed restore doesn't leave a partial output.
+            outputDir = os.path.dirname(os.path.abspath(outputPath))
+            fd, tempPath = tempfile.mkstemp(dir=outputDir)
+
+            try:
+                with os.fdopen(fd, 'wb') as out, open(blobPath, 'rb') as blob:
+                    chunk = blob.read(CHUNK_SIZE)
+
+                    while len(chunk) > 0:
+                        data = decompressor.decompress(chunk)
+                        digest.update(data)
+                        out.write(data)
+                        chunk = blob.read(CHUNK_SIZE)
+
+                    data = decompressor.flush()
+                    digest.update(data)
+                    out.write(data)
+
+                if digest.hexdigest() != entry['digest']:
+                    os.remove(blobPath) # So that the output can be stored again.
+                    raise ValueError("The blob for %s doesn't match its digest." % key)
+
+                os.chmod(tempPath, entry['mode'] & 0o777)
+                os.replace(tempPath, outputPath)
+            except:
+                os.remove(tempPath)
+                raise
+
+            # Mark as recently used.
+            os.utime(actionPath)
+            os.utime(blobPath)
+        except (OSError, ValueError, KeyError, zlib.error):
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    # Get a list of (path, size, last used time) for each file in [directory].
+    def listFiles(self, directory):
+        result = []
+
+        for parent, _, fileNames in os.walk(directory):
+            for fileName in fileNames:
+                path = os.path.join(parent, fileName)
+
+                try:
+                    stat = os.stat(path)
+                    result.append((path, stat.st_size, stat.st_mtime))
+                except OSError:
+                    pass # Removed by another process.
+        return result
+
+    # Remove the least-recently-used entries until the cache is at most [maxSize] bytes.
+    # Records the cache's size, for close.
+    def trim(self):
+        blobs = self.listFiles(self.blobDir)
+        actions = self.listFiles(self.actionDir)
+        totalSize = sum([ size for _, size, _ in blobs + actions ])
+
+        if totalSize <= self.maxSize:
+            self.writeSizeEstimate(totalSize)
+            return
+
+        blobSizes = { os.path.basename(path): size for path, size, _ in blobs }
+        usedBy = {} # Maps blob digests to the number of actions that use them.
+        actionBlobs = {}
+
+        for path, _, _ in actions:
+            try:
+                with open(path, 'r') as file:
+                    digest = json.load(file)['digest']
+            except (OSError, ValueError, KeyError):
+                digest = None
+            actionBlobs[path] = digest
+            usedBy[digest] = usedBy.get(digest, 0) + 1
+
+        # Remove the oldest actions first.
+        actions.sort(key=lambda action: action[2])
+
+        for path, size, _ in actions:
+            if totalSize <= self.maxSize:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalSize -= size
+
+            digest = actionBlobs[path]
+            usedBy[digest] -= 1
+
+            if digest in blobSizes and usedBy[digest] == 0:
+                try:
+                    os.remove(self.getBlobPath(digest))
+                    totalSize -= blobSizes[digest]
+                except (OSError, ValueError):
+                    pass
+
+        self.writeSizeEstimate(totalSize)
+
+    # Finish uploading to the remote cache (if any). Then, if the cache might be larger than
+    # [maxSize], trim it. Other processes using the cache at the same time can overwrite each
+    # other's estimates, so the estimate can be low, which only delays trimming until later.
+    def close(self):
+        if self.remote is not None:
+            self.remote.close()
+
+        estimate = self.readSizeEstimate()
+
+        if self.addedSize == 0 and (estimate is None or estimate <= self.maxSize):
+            return # Nothing changed.
+
+        if estimate is None or estimate + self.addedSize > self.maxSize:
+            self.trim()
+        else:
+            self.writeSizeEstimate(estimate + self.addedSize)
+
+    def getSummary(self):
+        summary = "Action cache: %d hits, %d misses." % (self.hits, self.misses)
+
+        if self.remote is not None:
+            summary += " " + self.remote.getSummary()
+        return summary
+
+if __name__ == "__main__":
+    import shutil
+    print("Testing actionCacheUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    tempDir = tempfile.mkdtemp()
+    cache = ActionCache(os.path.join(tempDir, 'cache'))
+    outputPath = os.path.join(tempDir, 'output.txt')
+
+    key = cache.getKey([ 'echo test > output.txt' ], [ ('input.txt', 'abc') ], { 'PATH': '/bin' })
+    assertEql(key == cache.getKey([ 'echo test > output.txt' ], [ ('input.txt', 'abcd') ], { 'PATH': '/bin' }), False, "Inputs are part of keys.")
+    assertEql(cache.restore(key, outputPath), False, "Empty caches miss.")
+
+    with open(outputPath, 'w') as file:
+        file.write("Test output\n" * 100)
+    os.chmod(outputPath, 0o755)
+
+    assertEql(cache.store(key, outputPath), True, "Storing outputs.")
+    assertEql(cache.store('other', outputPath), True, "Storing identical outputs.")
+    assertEql(len(cache.listFiles(cache.blobDir)), 1, "Identical outputs share a blob.")
+    assertEql(cache.listFiles(cache.blobDir)[0][1] < 1200, True, "Blobs are compressed.")
+
+    os.remove(outputPath)
+    assertEql(cache.restore(key, outputPath), True, "Restoring outputs.")
+    with open(outputPath, 'r') as file:
+        assertEql(file.read(), "Test output\n" * 100, "Restored contents.")
+    assertEql(os.stat(outputPath).st_mode & 0o777, 0o755, "Restored modes.")
+
+    # Make [key] the least-recently used.
+    os.utime(cache.getActionPath(key), (0, 0))
+    cache.maxSize = sum([ size for _, size, _ in cache.listFiles(cache.cacheDir) ]) - 1
+    cache.trim()
+    assertEql(os.path.exists(cache.getActionPath(key)), False, "Trimming removes the oldest actions.")
+    assertEql(cache.restore('other', outputPath), True, "Blobs used by other actions are kept.")
+
+    # The cache is only measured when it might be too large.
+    sizeCache = ActionCache(os.path.join(tempDir, 'sizeCache'))
+    sizeCache.store(key, outputPath)
+    sizeCache.close()
+
+    listed = []
+    sizeCache = ActionCache(os.path.join(tempDir, 'sizeCache'))
+    sizeCache.listFiles = lambda directory: listed.append(directory) or ActionCache.listFiles(sizeCache, directory)
+    sizeCache.restore(key, outputPath)
+    sizeCache.store('another', outputPath)
+    sizeCache.close()
+    assertEql(listed, [], "Caches below their maximum size aren't measured.")
+    measured = sum([ size for _, size, _ in ActionCache.listFiles(sizeCache, sizeCache.blobDir) + ActionCache.listFiles(sizeCache, sizeCache.actionDir) ])
+    assertEql(sizeCache.readSizeEstimate(), measured, "Sizes are estimated from what was added.")
+
+    sizeCache.maxSize = sizeCache.readSizeEstimate()
+    sizeCache.addedSize = 0
+    os.utime(sizeCache.getActionPath(key), (0, 0))
+    sizeCache.store('yetAnother', outputPath)
+    sizeCache.close()
+    assertEql(len(listed) > 0, True, "Caches that might be too large are measured and trimmed.")
+    assertEql(os.path.exists(sizeCache.getActionPath(key)), False, "Trimming uses the measured size.")
+
+    # Corrupted blobs aren't restored, and are removed.
+    blobPath = cache.getBlobPath(cache.listFiles(cache.blobDir)[0][0].split(os.sep)[-1])
+    with open(blobPath, 'wb') as file:
+        file.write(zlib.compress(b"Something else\n"))
+
+    assertEql(cache.restore('other', outputPath), False, "Blobs that don't match their digests aren't restored.")
+    assertEql(os.path.exists(blobPath), False, "Blobs that don't match their digests are removed.")
+    with open(outputPath, 'r') as file:
+        assertEql(file.read(), "Test output\n" * 100, "Failed restores leave outputs unchanged.")
+
+    # Action records can't name files outside the cache.
+    cache.writeFile(cache.getActionPath('bad'), json.dumps({ 'digest': '../../output.txt', 'mode': 0o644 }).encode('utf-8'))
+    assertEql(cache.restore('bad', outputPath), False, "Invalid digests are rejected.")
+    assertEql([ isValidDigest(digest) for digest in [ 'a' * 64, 'a' * 64 + '\n', '../' + 'a' * 61, None ] ], [ True, False, False, False ], "Digests are 64 hexadecimal digits.")
+
+    shutil.rmtree(tempDir)
@@ -8,6 +8,7 @@ SPACE_CHARS = re.compile('\\s')
 # any default arguments (not immediately after  a key) are put into a list under the
 # key defaultArgKey. If no default args, the list is empty. For example, 
 # ['make'] -> {'default': []}. 
+# Values can also be given as --key=value, or, for single-character arguments, as -kvalue.
 # If a given argument or its single-character representative is in [strictlyFlags], it is
 # considered a flag -- non-argument text after it is associated with [defaultArgKey], rather
 # than the argument. For example, if foo is in  strictlyFlags, then [ ... --foo thing ...]
@@ -35,12 +36,24 @@ def parseArgs(args,
             if lastArgText:
                 result[lastArgText] = True
             lastArgText = chunk[2:]
+
+            # GNU-style --key=value.
+            if "=" in lastArgText:
+                key, value = lastArgText.split("=", 1)
+                result[key] = value
+                lastArgText = None
         elif chunk.startswith("-") and len(chunk) > 1:
-            singleChars.extend(chunk[1:])
-            
             if lastArgText:
                 result[lastArgText] = True
                 lastArgText = None
+
+            # A single-character option with its value attached (e.g. -j4, as
+            # GNU make writes to MAKEFLAGS).
+            if len(chunk) > 2 and chunk[1] in mappings and not mappings[chunk[1]] in strictlyFlags:
+                result[mappings[chunk[1]]] = chunk[2:]
+                continue
+
+            singleChars.extend(chunk[1:])
             
             # Permits single-characters mapping to multi-char
             # flags **with values**.
@@ -126,6 +139,7 @@ def saveArgsInEnv(argMap, envVariable, doNotSave, defaultKey="default"):
             continue
     
         prefix = "--"
+        separator = "="
         defTo = str(argMap[key])
         defTo = shlex.quote(defTo)
         
@@ -134,11 +148,12 @@ def saveArgsInEnv(argMap, envVariable, doNotSave, defaultKey="default"):
             defTo = " ".join([ shlex.quote(val) for val in key ]) # default arg stores a list.
         elif len(key) == 1:
             prefix = "-"
+            separator = " "
         
         if argMap[key] == True:
             argString += prefix + key
         else:
-            argString += prefix + key + " " + defTo
+            argString += prefix + key + separator + defTo
         
         argString += " "
     
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+
+# Runs the recipes in a build graph from a single asyncio event loop (--executor=async).
+# Each job is a coroutine that awaits the commands it starts, so thousands of jobs
+# (e.g. with -j 500 and a distributed compiler) can run at once without a thread, and
+# its stack, for each, or contention between those threads for the GIL.
+#
+# Dependencies, priorities and failures are handled as in scheduleUtil.Scheduler.
+# Free job slots are taken right away. Waiting for a slot can block (e.g. reading a
+# token from a job server), so that is done by a helper thread, one slot at a time.
+
+import os, sys, heapq, asyncio, subprocess, contextvars, concurrent.futures
+
+import almost_make.utils.scheduleUtil as scheduleUtil
+import almost_make.utils.spawnUtil as spawnUtil
+
+# Before Python 3.12, asyncio starts a thread to wait for each child process, unless told to
+# use pidfds (where the OS supports them). Returns whether pidfds are used.
+def usePidfds():
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+        return False
+
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return False
+
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+    return True
+
+# Run [args] (a list of arguments or, if [shell], a command for the system shell), writing to
+# [stdout] and [stderr] (file descriptors), if given. Returns the command's exit status.
+# If the command fails, raises subprocess.CalledProcessError (like spawnUtil.run with check).
+# Like commands started by spawnUtil, the command can be stopped by spawnUtil.terminateAll.
+async def runProcess(args, shell=False, stdout=None, stderr=None):
+    if shell:
+        process = await asyncio.create_subprocess_shell(args, stdout=stdout, stderr=stderr)
+    else:
+        process = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr)
+
+    spawnUtil.runningProcesses.add(process)
+
+    try:
+        returncode = await process.wait()
+    finally:
+        spawnUtil.runningProcesses.remove(process)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return returncode
+
+# Run [function] with [args] on another thread, so that it doesn't block the event loop.
+# It sees the current job's JobLocals (see scheduleUtil). Returns its result.
+async def runInThread(function, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, function, *args)
+
+class AsyncScheduler(scheduleUtil.Scheduler):
+    # Run [runJob] (which should return a coroutine) for [node]. Returns (node, result, exception).
+    # Exceptions are returned, rather than raised, because asyncio re-raises SystemExit
+    # (e.g. from errorUtil's reportError) out of the event loop, rather than from the task.
+    # The job runs in [lane] (see scheduleUtil.currentJob).
+    async def runNode(self, runJob, node, lane):
+        scheduleUtil.currentJob.lane = lane
+
+        try:
+            return (node, await runJob(node), None)
+        except BaseException as ex:
+            return (node, None, ex)
+
+    # Start jobs for nodes in the ready-queue, whenever a job slot is free, until
+    # there is nothing left to do, or a job has failed. Then, wait for running jobs.
+    async def work(self, runJob):
+        loop = asyncio.get_running_loop()
+        slotThread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        wakeUp = asyncio.Event() # Set when a job finishes or a job slot has been taken.
+        finished = []            # Finished jobs' tasks that haven't been handled yet.
+        running = 0
+        acquiring = None         # Resolves when a job slot has been taken by [slotThread].
+        lanes = {}               # Maps running jobs' tasks to their lanes.
+        freeLanes = []           # A heap of lanes no running job has, below the highest in use.
+
+        def onFinished(task):
+            heapq.heappush(freeLanes, lanes.pop(task))
+            finished.append(task)
+            wakeUp.set()
+
+        # Start the highest-priority ready node's job, with the job slot we've taken.
+        # If no node can start (e.g. because their pools are full), return the slot.
+        def startJob():
+            node = self.popReady()
+
+            if node is None:
+                self.jobSlots.release()
+                return 0
+
+            lane = len(lanes)
+            if len(freeLanes) > 0:
+                lane = heapq.heappop(freeLanes)
+
+            task = asyncio.ensure_future(self.runNode(runJob, node, lane))
+            lanes[task] = lane
+            task.add_done_callback(onFinished)
+            return 1
+
+        try:
+            while running > 0 or (len(self.ready) > 0 and self.failure is None):
+                # Only wait for a job slot if there is a node for it. Otherwise,
+                # we could hold tokens other make processes need.
+                while acquiring is None and len(self.ready) > 0 and self.failure is None:
+                    if self.jobSlots.tryAcquire():
+                        running += startJob()
+                    else:
+                        acquiring = loop.run_in_executor(slotThread, self.jobSlots.acquire)
+                        acquiring.add_done_callback(lambda future: wakeUp.set())
+
+                await wakeUp.wait()
+                wakeUp.clear()
+
+                if acquiring is not None and acquiring.done():
+                    acquiring.result()
+                    acquiring = None
+
+                    if self.failure is None:
+                        running += startJob()
+                    else:
+                        self.jobSlots.release()
+
+                while len(finished) > 0:
+                    node, result, failure = finished.pop().result()
+                    running -= 1
+                    self.jobSlots.release()
+
+                    with self.lock:
+                        if failure is not None:
+                            self.failNode(node, failure)
+                        else:
+                            self.finishNode(node, result)
+        finally:
+            if acquiring is not None:
+                await acquiring
+                self.jobSlots.release()
+            slotThread.shutdown()
+
+    # Run [runJob] once for each node in the graph. See scheduleUtil.Scheduler.run.
+    # [runJob] should return a coroutine.
+    def run(self, runJob):
+        self.prepareRun()
+
+        if self.remaining > 0:
+            usePidfds()
+            asyncio.run(self.work(runJob))
+
+        if self.failure is not None:
+            raise self.failure
+
+if __name__ == "__main__":
+    import time, threading
+    print("Testing asyncScheduleUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    # A diamond: top depends on left and right, which both depend on shared.
+    scheduler = AsyncScheduler(4)
+    top, left, right, shared = [ scheduler.getNode(name) for name in [ 'top', 'left', 'right', 'shared' ] ]
+    scheduler.addDependency(top, left)
+    scheduler.addDependency(top, right)
+    scheduler.addDependency(left, shared)
+    scheduler.addDependency(right, shared)
+
+    order = []
+
+    async def recordJob(node):
+        order.append(node.target)
+        await asyncio.sleep(0)
+        return node.target
+
+    scheduler.run(recordJob)
+    assertEql(len(order), 4, "Each node runs exactly once.")
+    assertEql(order[0], 'shared', "The shared dependency runs first.")
+    assertEql(order[-1], 'top', "The top-level target runs last.")
+    assertEql(top.wait(), 'top', "Nodes store their results.")
+
+    # Many jobs run at once, without a thread each.
+    scheduler = AsyncScheduler(200)
+    for index in range(200):
+        scheduler.getNode(index)
+
+    running = [ 0, 0 ] # Currently running, most running at once.
+    threadCounts = []
+
+    async def sleepJob(node):
+        running[0] += 1
+        running[1] = max(running)
+        threadCounts.append(threading.active_count())
+        await runProcess([ 'sleep', '0.2' ])
+        running[0] -= 1
+
+    startTime = time.perf_counter()
+    scheduler.run(sleepJob)
+    assertEql(running[1], 200, "Up to maxJobs jobs run at once.")
+    assertEql(max(threadCounts) < 10, True, "Jobs don't each have a thread.")
+    assertEql(time.perf_counter() - startTime < 10, True, "Jobs run concurrently.")
+
+    scheduler = AsyncScheduler(3)
+    for index in range(10):
+        scheduler.getNode(index)
+
+    running = [ 0, 0 ]
+    scheduler.run(sleepJob)
+    assertEql(running[1], 3, "At most maxJobs jobs run at once.")
+
+    # Jobs running at the same time have different lanes, which are reused.
+    scheduler = AsyncScheduler(3)
+    for index in range(10):
+        scheduler.getNode(index)
+
+    lanes = []
+
+    async def laneJob(node):
+        await runInThread(lambda: lanes.append(scheduleUtil.currentJob.lane))
+        await asyncio.sleep(0.05)
+
+    scheduler.run(laneJob)
+    assertEql(sorted(set(lanes)), [ 0, 1, 2 ], "Each running job has its own lane, in threads too.")
+
+    scheduler = AsyncScheduler(4)
+    scheduler.addPool('link', 2)
+    for index in range(8):
+        scheduler.setPool(scheduler.getNode(index), 'link')
+
+    running = [ 0, 0 ]
+    scheduler.run(sleepJob)
+    assertEql(running[1], 2, "Pools limit how many of their jobs run at once.")
+
+    # A failing job stops the build.
+    scheduler = AsyncScheduler(2)
+    parent = scheduler.getNode('parent')
+    scheduler.addDependency(parent, scheduler.getNode('child'))
+
+    async def failOnChild(node):
+        if node.target == 'child':
+            await runProcess('exit 3', shell=True)
+        return True
+
+    try:
+        scheduler.run(failOnChild)
+        raise Exception("AsyncScheduler.run should re-raise job failures.")
+    except subprocess.CalledProcessError as ex:
+        assertEql(ex.returncode, 3, "Exit statuses are kept.")
+    assertEql(parent.done.is_set(), False, "Dependents of a failed job don't run.")
+
+    # With keepGoing, nodes that don't depend on the failed job still run.
+    scheduler = AsyncScheduler(2, keepGoing=True)
+    parent = scheduler.getNode('parent')
+    scheduler.addDependency(parent, scheduler.getNode('child'))
+    sibling = scheduler.getNode('sibling')
+
+    scheduler.run(failOnChild)
+    assertEql(([ node.target for node in scheduler.failed ], [ node.target for node in scheduler.skipped ]), ([ 'child' ], [ 'parent' ]), "Failures and the nodes they stopped are recorded.")
+    assertEql(sibling.result, True, "Other nodes still run.")
+
+    # Without keepGoing, a failure can stop running commands.
+    scheduler = AsyncScheduler(2, onFailure=spawnUtil.terminateAll)
+    scheduler.getNode('child')
+    scheduler.getNode('slow')
+
+    async def slowJob(node):
+        if node.target == 'slow':
+            await runProcess([ 'sleep', '10' ])
+        await asyncio.sleep(0.1)
+        return await failOnChild(node)
+
+    startTime = time.perf_counter()
+    try:
+        scheduler.run(slowJob)
+        raise Exception("AsyncScheduler.run should re-raise job failures.")
+    except subprocess.CalledProcessError as ex:
+        assertEql(ex.returncode, 3, "The first failure is re-raised.")
+    assertEql(time.perf_counter() - startTime < 5, True, "Running commands are stopped.")
+
+    scheduler = AsyncScheduler(2)
+    scheduler.getNode('exits')
+
+    async def exitJob(node):
+        raise SystemExit(1)
+
+    try:
+        scheduler.run(exitJob)
+        raise Exception("AsyncScheduler.run should re-raise SystemExit.")
+    except SystemExit:
+        pass
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+# A persistent log of how long each target's recipe took to run, and a hash of the
+# commands it ran, similar to ninja's .ninja_log. The scheduler uses these durations to
+# start targets on the longest path through the build graph first. A target whose
+# commands have changed (e.g. because CFLAGS was changed on the command line) is rebuilt.
+#
+# The log is a text file. After a header line, each line is
+#   DURATION_MS<tab>COMMAND_HASH<tab>TARGET
+# where TARGET is the target's absolute path. Unknown durations and hashes are written as '-'.
+# The log is only appended to, so later lines replace earlier lines for the same target.
+# When most lines are out-of-date, the log is rewritten with just the latest line for each target.
+
+import os, threading, tempfile, hashlib
+
+LOG_HEADER = "# almake log v2"
+UNKNOWN = '-'
+
+# Get a short hash of [commands], a list of expanded commands.
+def hashCommands(commands):
+    return hashlib.sha256("\n".join(commands).encode('utf-8')).hexdigest()[:16]
+
+# Rewrite the log when it has this many more lines than targets.
+MAX_STALE_LINES = 1000
+
+class BuildLog:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {} # Maps targets to (duration in seconds, command hash). Either can be None.
+        self.lineCount = 0
+        self.file = None
+
+        self.load()
+
+    # Get the key used to store [target] in the log.
+    def normalize(self, target):
+        return os.path.normcase(os.path.abspath(target))
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                lines = file.read().split('\n')
+        except OSError:
+            return
+
+        # Ignore logs from other versions.
+        if lines[0] != LOG_HEADER:
+            return
+
+        for line in lines[1:]:
+            parts = line.split('\t', 2)
+
+            if len(parts) < 3:
+                continue
+
+            try:
+                duration = None if parts[0] == UNKNOWN else int(parts[0]) / 1000
+                commandHash = None if parts[1] == UNKNOWN else parts[1]
+            except ValueError:
+                continue # Ignore partially-written lines.
+
+            self.entries[parts[2]] = (duration, commandHash)
+            self.lineCount += 1
+
+    # Get the duration of [target]'s recipe when it last ran, in seconds, or None.
+    def getDuration(self, target):
+        return self.entries.get(self.normalize(target), (None, None))[0]
+
+    # Get the hash of the commands [target]'s recipe last ran (see hashCommands), or None.
+    def getCommandHash(self, target):
+        return self.entries.get(self.normalize(target), (None, None))[1]
+
+    def formatLine(self, target, entry):
+        duration, commandHash = entry
+
+        if duration is None:
+            duration = UNKNOWN
+        else:
+            duration = str(int(duration * 1000))
+        return "%s\t%s\t%s\n" % (duration, commandHash or UNKNOWN, target)
+
+    # Open the log for appending. If it has too many stale lines, rewrite it first.
+    # Must be called with [lock] held.
+    def openLog(self):
+        directory = os.path.dirname(self.path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        if self.lineCount == 0 or self.lineCount > len(self.entries) + MAX_STALE_LINES:
+            fd, tempPath = tempfile.mkstemp(dir=directory or '.')
+
+            with os.fdopen(fd, 'w') as file:
+                file.write(LOG_HEADER + "\n")
+
+                for target in self.entries:
+                    file.write(self.formatLine(target, self.entries[target]))
+            os.replace(tempPath, self.path)
+            self.lineCount = len(self.entries)
+
+        self.file = open(self.path, 'a')
+
+    # Note that [target]'s recipe took [duration] seconds and ran commands with hash [commandHash].
+    # If [duration] is None, keep the last known duration.
+    def record(self, target, duration, commandHash):
+        target = self.normalize(target)
+
+        with self.lock:
+            if duration is None:
+                duration = self.entries.get(target, (None, None))[0]
+            entry = (duration, commandHash)
+
+            try:
+                if self.file is None:
+                    self.openLog()
+
+                self.file.write(self.formatLine(target, entry))
+                self.file.flush()
+                self.lineCount += 1
+            except OSError:
+                pass # The log is an optimization. Don't fail the build.
+
+            self.entries[target] = entry
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+if __name__ == "__main__":
+    import shutil
+    print("Testing buildLogUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    tempDir = tempfile.mkdtemp()
+    logPath = os.path.join(tempDir, 'state', 'log')
+
+    log = BuildLog(logPath)
+    assertEql(log.getDuration('foo.o'), None, "Targets without history.")
+
+    log.record('foo.o', 1.5, hashCommands([ 'cc -c foo.c' ]))
+    log.record('./bar.o', 0.25, None)
+    log.record('foo.o', 2, hashCommands([ 'cc -O2 -c foo.c' ]))
+    log.record('bar.o', None, 'abc')
+    log.close()
+
+    log = BuildLog(logPath)
+    assertEql(log.getDuration('./foo.o'), 2, "The latest duration is used.")
+    assertEql(log.getCommandHash('foo.o'), hashCommands([ 'cc -O2 -c foo.c' ]), "Command hashes are stored.")
+    assertEql(hashCommands([ 'cc -c foo.c' ]) == hashCommands([ 'cc -O2 -c foo.c' ]), False, "Different commands have different hashes.")
+    assertEql((log.getDuration('bar.o'), log.getCommandHash('bar.o')), (0.25, 'abc'), "Unknown durations are kept.")
+    assertEql(log.lineCount, 4, "The log is appended to.")
+
+    log.lineCount = len(log.entries) + MAX_STALE_LINES + 1
+    log.record('baz.o', 0, None)
+    log.close()
+
+    with open(logPath, 'r') as file:
+        assertEql(len(file.read().strip().split('\n')), 4, "Logs with many stale lines are rewritten.")
+
+    shutil.rmtree(tempDir)
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+# A minimal server for almake's remote build cache (see remoteCacheUtil).
+# This is a reference implementation, meant for testing the protocol on one machine
+# or sharing a cache on a trusted network. It has no authentication.
+#
+# Protocol (HTTP/1.1, with keep-alive):
+#  - GET, HEAD, or PUT /ac/KEY: the action record (JSON) for the action with key KEY.
+#  - GET, HEAD, or PUT /cas/DIGEST: the zlib-compressed contents of a blob.
+# Both KEY and DIGEST are hexadecimal SHA-256 digests. Uploaded blobs must decompress
+# to contents with digest DIGEST.
+
+import os, re, sys, zlib, hashlib, tempfile, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from almost_make.utils.printUtil import *
+from almost_make.utils.argsUtil import parseArgs
+from almost_make.version import printVersion
+
+PATH_EXP = re.compile(r'^/(ac|cas)/([0-9a-f]{64})$')
+MAX_UPLOAD_SIZE = 1024 * 1024 * 1024 # Bytes.
+CHUNK_SIZE = 1024 * 1024
+
+ARG_MAPPINGS = \
+{
+    'h': 'help',
+    'p': 'port',
+    'd': 'directory'
+}
+
+JUST_FLAGS = \
+{
+    'help', 'version'
+}
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep connections alive between requests.
+
+    # Get the path to the file for this request, or None if the request's path is invalid.
+    def getFilePath(self):
+        match = PATH_EXP.match(self.path)
+
+        if match is None:
+            return None
+        kind, name = match.groups()
+        return os.path.join(self.server.directory, kind, name[:2], name)
+
+    def sendEmpty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(sendBody=False)
+
+    def do_GET(self, sendBody=True):
+        path = self.getFilePath()
+
+        if path is None:
+            self.sendEmpty(400)
+            return
+
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            self.sendEmpty(404)
+            return
+
+        with file:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(file.fileno()).st_size))
+            self.end_headers()
+
+            if sendBody:
+                chunk = file.read(CHUNK_SIZE)
+
+                while len(chunk) > 0:
+                    self.wfile.write(chunk)
+                    chunk = file.read(CHUNK_SIZE)
+
+    def do_PUT(self):
+        path = self.getFilePath()
+
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+
+        if path is None or length < 0 or length > MAX_UPLOAD_SIZE:
+            self.close_connection = True # We haven't read the body.
+            self.sendEmpty(400)
+            return
+
+        kind, name = PATH_EXP.match(self.path).groups()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        # Check blobs against their digests, so that clients can't store the wrong contents.
+        decompressor = zlib.decompressobj()
+        digest = hashlib.sha256()
+        valid = True
+
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                remaining = length
+
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+
+                    if len(chunk) == 0:
+                        raise IOError("Connection closed before the upload finished.")
+                    file.write(chunk)
+                    remaining -= len(chunk)
+
+                    if kind == 'cas' and valid:
+                        try:
+                            digest.update(decompressor.decompress(chunk))
+                        except zlib.error:
+                            valid = False
+
+            if kind == 'cas' and valid:
+                try:
+                    digest.update(decompressor.flush())
+                    valid = decompressor.eof and digest.hexdigest() == name
+                except zlib.error:
+                    valid = False
+
+            if not valid:
+                os.remove(tempPath)
+                self.sendEmpty(400)
+                return
+
+            # Readers only ever see complete entries.
+            os.replace(tempPath, path)
+        except:
+            os.remove(tempPath)
+            raise
+
+        self.sendEmpty(201)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class CacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Serve the cache stored in [directory] at [address], a (host, port) tuple.
+    def __init__(self, address, directory, quiet=False):
+        ThreadingHTTPServer.__init__(self, address, CacheRequestHandler)
+        self.directory = directory
+        self.quiet = quiet
+
+    # Get the URL of this server.
+    def getURL(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+# Start a server for [directory] on a background thread. If [port] is 0,
+# pick an unused port. Returns the server. Call its shutdown method to stop it.
+def startServer(directory, port=0, host='127.0.0.1', quiet=True):
+    server = CacheServer((host, port), directory, quiet)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def printHelp():
+    cprint("Help: \n", FORMAT_COLORS['YELLOW'])
+    cprint(" Summary: ", FORMAT_COLORS['YELLOW'])
+    print("Serve a remote build cache for almake --remote-cache over HTTP. There is no authentication: only use this on a trusted network.")
+    cprint(" Usage: almake_cache_server [options]\n", FORMAT_COLORS['YELLOW'])
+    print("  where options include:")
+    cprint("    -h, --help", FORMAT_COLORS['GREEN'])
+    print("\t\t Print this message.")
+    cprint("    --version", FORMAT_COLORS['GREEN'])
+    print("\t\t Print version and licensing information.")
+    cprint("    -d, --directory dir", FORMAT_COLORS['GREEN'])
+    print("\t Store the cache in dir (default is the current directory).")
+    cprint("    -p, --port port", FORMAT_COLORS['GREEN'])
+    print("\t Listen on port (default is 8080).")
+    cprint("    --host host", FORMAT_COLORS['GREEN'])
+    print("\t\t Listen on host (default is 127.0.0.1).")
+
+def main(args=sys.argv):
+    args = parseArgs(args, ARG_MAPPINGS, strictlyFlags=JUST_FLAGS)
+
+    if 'help' in args:
+        printHelp()
+    elif 'version' in args:
+        printVersion()
+    else:
+        directory = os.path.abspath(str(args.get('directory', '.')))
+        server = CacheServer((str(args.get('host', '127.0.0.1')), int(args.get('port', 8080))), directory)
+
+        print("Serving %s at %s" % (directory, server.getURL()))
+        sys.stdout.flush()
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
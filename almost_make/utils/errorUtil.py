@@ -5,8 +5,12 @@ from almost_make.utils.printUtil import *
 class ErrorUtil:
     stopOnError = True
     silent = False
+    errorCount = 0 # Number of errors reported.
+
     # On error, report [message] depending on [SILENT] and [STOP_ON_ERROR]
     def reportError(self, message):
+        self.errorCount += 1
+
         if not self.silent or self.stopOnError:
             cprint(str(message) + "\n", "RED", file=sys.stderr)
         
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# Caches whether files exist and when they were last modified.
+# Deciding what to make can stat the same paths many times (e.g. once
+# for each entry in VPATH, on every traversal of the dependency graph).
+# On slow file systems (e.g. NFS), these calls can take most of a
+# no-op build's time. Entries are keyed by normalized path, and should be
+# invalidated when a recipe that generates that path finishes.
+
+import os, threading
+
+class FileStateCache:
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+        self.generation = 0 # Incremented on each invalidation.
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Get the key used to store [path] in the cache.
+    def normalize(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    # Get a tuple, (exists, modification time in nanoseconds), for [path].
+    # If [path] doesn't exist, its modification time is None.
+    def getState(self, path):
+        key = self.normalize(path)
+        state = self.states.get(key)
+
+        if state is not None:
+            with self.lock:
+                self.hits += 1
+            return state
+
+        generation = self.generation
+
+        try:
+            state = (True, os.stat(key).st_mtime_ns)
+        except OSError:
+            state = (False, None)
+
+        with self.lock:
+            self.misses += 1
+
+            # Don't store the result if [path] might have changed while we were checking.
+            if generation == self.generation:
+                self.states[key] = state
+        return state
+
+    def exists(self, path):
+        return self.getState(path)[0]
+
+    # Get the modification time of [path] in nanoseconds, or None if it doesn't exist.
+    def getMTime(self, path):
+        return self.getState(path)[1]
+
+    # Forget what we know about [path]. Call this after [path] might have changed.
+    def invalidate(self, path):
+        key = self.normalize(path)
+
+        with self.lock:
+            self.generation += 1
+
+            if self.states.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.states = {}
+
+    def getSummary(self):
+        return "Stat cache: %d hits, %d misses, %d invalidations." % (self.hits, self.misses, self.invalidations)
+
+if __name__ == "__main__":
+    import tempfile
+    print("Testing fileStateUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    cache = FileStateCache()
+    tempDir = tempfile.mkdtemp()
+    path = os.path.join(tempDir, 'test.txt')
+
+    assertEql(cache.exists(path), False, "Files that don't exist.")
+    assertEql(cache.getMTime(path), None, "Missing files have no modification time.")
+    assertEql((cache.hits, cache.misses), (1, 1), "The second lookup is a hit.")
+
+    with open(path, 'w') as file:
+        file.write("Test")
+    assertEql(cache.exists(path), False, "Results are cached until invalidated.")
+
+    cache.invalidate(os.path.join(tempDir, '.', 'test.txt'))
+    assertEql(cache.exists(path), True, "Invalidation uses normalized paths.")
+    assertEql(cache.getMTime(path), os.stat(path).st_mtime_ns, "Modification times are in nanoseconds.")
+    assertEql(cache.invalidations, 1, "Invalidations are counted.")
+
+    os.remove(path)
+    os.rmdir(tempDir)
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+# Content digests of files and targets, stored in a SQLite database.
+# By default, a target is rebuilt when a prerequisite's modification time
+# is newer than its own. Operations that touch files without changing them
+# (e.g. git checkout, restoring a CI cache) would then rebuild everything.
+# With a HashState, a target's signature (a digest of its prerequisites' contents
+# and its recipe) is stored after it is made. A target is only rebuilt when its
+# signature changes.
+#
+# Each file's digest is stored with its modification time and size. Files with the
+# same modification time and size as when last hashed aren't read again.
+# Files are hashed in chunks, on a pool of threads (hashlib releases the GIL while hashing).
+
+import os, hashlib, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1024 * 1024
+
+# Get a digest of the contents of the file at [path].
+def hashFile(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        chunk = file.read(CHUNK_SIZE)
+
+        while len(chunk) > 0:
+            digest.update(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+class HashState:
+    # Store state in the database at [dbPath]. Use up to [maxThreads] threads
+    # for hashing (default: one per CPU).
+    def __init__(self, dbPath, maxThreads=None):
+        dbDir = os.path.dirname(dbPath)
+        if dbDir != '':
+            os.makedirs(dbDir, exist_ok=True)
+
+        # Recipes finish on the scheduler's worker threads, so share the connection behind a lock.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(dbPath, timeout=30, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, digest TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS targets (target TEXT PRIMARY KEY, signature TEXT)")
+        self.connection.commit()
+
+        self.pool = ThreadPoolExecutor(max_workers=maxThreads or os.cpu_count() or 1)
+        self.closed = False
+
+        self.filesHashed = 0
+
+    # Get the key used to store [path] in the database.
+    def normalize(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    # Get a digest of [path]'s contents, or None if it doesn't exist. Only reads
+    # [path] if its modification time or size have changed since it was last hashed.
+    def getDigest(self, path):
+        key = self.normalize(path)
+
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None
+
+        # Directories change whenever their entries do. Just use their modification times.
+        if not os.path.isfile(key):
+            return "mtime:%d" % stat.st_mtime_ns
+
+        with self.lock:
+            row = self.connection.execute("SELECT mtime, size, digest FROM files WHERE path = ?", (key,)).fetchone()
+
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+
+        try:
+            digest = hashFile(key)
+        except OSError:
+            return None
+
+        with self.lock:
+            self.filesHashed += 1
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (key, stat.st_mtime_ns, stat.st_size, digest))
+        return digest
+
+    # Get a list of digests, one for each path in [paths]. Files are hashed in parallel.
+    def getDigests(self, paths):
+        if len(paths) <= 1:
+            return [ self.getDigest(path) for path in paths ]
+        return list(self.pool.map(self.getDigest, paths))
+
+    # Get a signature for a target with prerequisites [inputs] (a list of paths)
+    # and recipe [recipe] (a list of commands).
+    def getSignature(self, inputs, recipe):
+        signature = hashlib.sha256()
+
+        for path, digest in zip(inputs, self.getDigests(inputs)):
+            signature.update(repr((path, digest)).encode('utf-8'))
+        signature.update(repr(recipe).encode('utf-8'))
+
+        return signature.hexdigest()
+
+    # Get the signature stored for [target] (a path), or None.
+    def getTargetSignature(self, target):
+        with self.lock:
+            row = self.connection.execute("SELECT signature FROM targets WHERE target = ?", (self.normalize(target),)).fetchone()
+
+        if row is None:
+            return None
+        return row[0]
+
+    def setTargetSignature(self, target, signature):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO targets VALUES (?, ?)", (self.normalize(target), signature))
+
+    # Write changes to the database and stop hashing threads.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.pool.shutdown()
+
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+if __name__ == "__main__":
+    import tempfile, shutil
+    print("Testing hashStateUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    tempDir = tempfile.mkdtemp()
+    dbPath = os.path.join(tempDir, 'state', 'hash.db')
+    inputPath = os.path.join(tempDir, 'input.txt')
+
+    with open(inputPath, 'w') as file:
+        file.write("Test")
+
+    state = HashState(dbPath, 2)
+    assertEql(state.getDigest(inputPath), hashlib.sha256(b"Test").hexdigest(), "Digests of contents.")
+    assertEql(state.getDigest(os.path.join(tempDir, 'missing.txt')), None, "Missing files have no digest.")
+
+    state.getDigest(inputPath)
+    assertEql(state.filesHashed, 1, "Unchanged files aren't hashed again.")
+
+    signature = state.getSignature([ inputPath, tempDir ], [ 'cat input.txt' ])
+    assertEql(signature == state.getSignature([ inputPath, tempDir ], [ 'cat input.txt > out' ]), False, "Recipes are part of signatures.")
+
+    state.setTargetSignature(os.path.join(tempDir, 'out'), signature)
+    state.close()
+
+    # Touching a file without changing it doesn't change its signature.
+    os.utime(inputPath, ns=(0, 0))
+    state = HashState(dbPath)
+    assertEql(state.getTargetSignature(os.path.join(tempDir, '.', 'out')), signature, "Signatures are stored.")
+    assertEql(state.getSignature([ inputPath, tempDir ], [ 'cat input.txt' ]), signature, "Touched files have the same signature.")
+    assertEql(state.filesHashed, 1, "Touched files are hashed again.")
+    state.close()
+
+    shutil.rmtree(tempDir)
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+# Job slots that can be shared between recursive invocations of make.
+#
+# A job server is a pool of tokens (single bytes in a pipe). Each make
+# process gets one job slot for free. Every additional job must first read
+# a token from the pool and write it back when it has finished. As such,
+# the total number of jobs across a whole tree of recursive makes is bounded.
+# This is compatible with GNU make's job server.
+# See https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+#  and https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html
+
+import os, tempfile, threading, atexit, shutil
+
+TOKEN = b'+'
+FIFO_PREFIX = 'fifo:'
+
+# Job slots that are local to this process.
+class JobSlots:
+    def __init__(self, maxJobs=1):
+        self.maxJobs = max(1, maxJobs)
+        self.semaphore = threading.Semaphore(self.maxJobs)
+
+        # Value for --jobserver-auth, if child processes can share these slots.
+        self.auth = None
+
+    # Block until a job slot is free, then take it.
+    def acquire(self):
+        self.semaphore.acquire()
+
+    # Take a job slot if one is free, without blocking. Returns whether a slot was taken.
+    def tryAcquire(self):
+        return self.semaphore.acquire(blocking=False)
+
+    # Return a job slot taken with acquire.
+    def release(self):
+        self.semaphore.release()
+
+    def close(self):
+        pass
+
+class JobServer(JobSlots):
+    # [readFd] and [writeFd] are the ends of the token pipe (they can be the same
+    # file descriptor). If [ownedDir] is given, it contains the pipe and is removed on close.
+    def __init__(self, readFd, writeFd, auth, maxJobs=1, ownedDir=None):
+        JobSlots.__init__(self, maxJobs)
+        self.readFd = readFd
+        self.writeFd = writeFd
+        self.auth = auth
+        self.ownedDir = ownedDir
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.implicitFree = True # Whether our free job slot is unused.
+        self.heldTokens = []     # Tokens read from the pipe that haven't been returned.
+
+        # A second, non-blocking descriptor for reading tokens, used by tryAcquire. Only
+        # opened for named pipes: making an inherited descriptor non-blocking would also
+        # affect the other processes sharing it.
+        self.nonBlockingFd = None
+
+        if auth.startswith(FIFO_PREFIX):
+            self.nonBlockingFd = os.open(auth[len(FIFO_PREFIX):], os.O_RDONLY | os.O_NONBLOCK)
+
+    def acquire(self):
+        with self.lock:
+            if self.implicitFree:
+                self.implicitFree = False
+                return
+
+        # Blocks until some process returns a token.
+        token = os.read(self.readFd, 1)
+
+        if len(token) == 0:
+            raise IOError("Job server closed (%s)." % self.auth)
+
+        with self.lock:
+            self.heldTokens.append(token)
+
+    def tryAcquire(self):
+        with self.lock:
+            if self.implicitFree:
+                self.implicitFree = False
+                return True
+
+        if self.nonBlockingFd is None:
+            return False
+
+        try:
+            token = os.read(self.nonBlockingFd, 1)
+        except BlockingIOError:
+            return False
+
+        if len(token) == 0:
+            return False
+
+        with self.lock:
+            self.heldTokens.append(token)
+        return True
+
+    def release(self):
+        with self.lock:
+            if len(self.heldTokens) > 0:
+                # Return the same byte we read, as GNU make recommends.
+                os.write(self.writeFd, self.heldTokens.pop())
+            else:
+                self.implicitFree = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.nonBlockingFd is not None:
+            os.close(self.nonBlockingFd)
+
+        # Only the process that created the pool removes it.
+        if self.ownedDir is not None:
+            os.close(self.readFd)
+            shutil.rmtree(self.ownedDir, ignore_errors=True)
+        elif self.auth.startswith(FIFO_PREFIX):
+            os.close(self.readFd)
+
+# Job slots for a make run in this process by a recipe of another (see makeUtil's
+# setRecursiveMake). Like a job server client, it has one free slot, the one the
+# recipe holds, and takes the others from [parent], the other make's job slots.
+class SharedJobSlots(JobSlots):
+    def __init__(self, parent, maxJobs=1):
+        JobSlots.__init__(self, maxJobs)
+        self.parent = parent
+        self.auth = parent.auth
+
+        self.lock = threading.Lock()
+        self.implicitFree = True # Whether our free job slot is unused.
+        self.parentSlots = 0     # Slots taken from [parent] that haven't been returned.
+
+    def acquire(self):
+        with self.lock:
+            if self.implicitFree:
+                self.implicitFree = False
+                return
+
+        self.parent.acquire()
+
+        with self.lock:
+            self.parentSlots += 1
+
+    def tryAcquire(self):
+        with self.lock:
+            if self.implicitFree:
+                self.implicitFree = False
+                return True
+
+        if not self.parent.tryAcquire():
+            return False
+
+        with self.lock:
+            self.parentSlots += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            fromParent = self.parentSlots > 0
+
+            if fromParent:
+                self.parentSlots -= 1
+            else:
+                self.implicitFree = True
+
+        if fromParent:
+            self.parent.release()
+
+# Create a new pool with [maxJobs] job slots in total. Returns a JobServer,
+# or None if job servers aren't supported here (e.g. no named pipes).
+def startJobServer(maxJobs):
+    if not hasattr(os, 'mkfifo'):
+        return None
+
+    tempDir = tempfile.mkdtemp(prefix='almake-')
+    fifoPath = os.path.join(tempDir, 'jobserver')
+
+    try:
+        os.mkfifo(fifoPath, 0o600)
+
+        # Open read-write so that neither end blocks waiting for the other.
+        fd = os.open(fifoPath, os.O_RDWR)
+        os.write(fd, TOKEN * (maxJobs - 1)) # One job slot is implicit.
+    except OSError:
+        shutil.rmtree(tempDir, ignore_errors=True)
+        return None
+
+    server = JobServer(fd, fd, FIFO_PREFIX + fifoPath, maxJobs, ownedDir=tempDir)
+    atexit.register(server.close)
+    return server
+
+# Join an existing pool, described by [auth] (the value of --jobserver-auth).
+# Both fifo:PATH (GNU make 4.4 and almake) and R,W (inherited file descriptors)
+# are supported. Returns a JobServer or None if the pool can't be used.
+def joinJobServer(auth, maxJobs=1):
+    auth = auth.strip()
+
+    try:
+        if auth.startswith(FIFO_PREFIX):
+            fd = os.open(auth[len(FIFO_PREFIX):], os.O_RDWR)
+            server = JobServer(fd, fd, auth, maxJobs)
+            atexit.register(server.close)
+            return server
+
+        readFd, writeFd = [ int(part) for part in auth.split(',') ]
+
+        # GNU make passes negative descriptors when it isn't sharing its
+        # job server with this recipe line.
+        if readFd < 0 or writeFd < 0:
+            return None
+
+        # Make sure we actually inherited the descriptors.
+        os.fstat(readFd)
+        os.fstat(writeFd)
+
+        return JobServer(readFd, writeFd, auth, maxJobs)
+    except (OSError, ValueError):
+        return None
+
+if __name__ == "__main__":
+    print("Testing jobserverUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    slots = JobSlots(2)
+    slots.acquire()
+    slots.acquire()
+    assertEql(slots.semaphore.acquire(blocking=False), False, "Local slots are bounded.")
+
+    server = startJobServer(3)
+
+    if server is not None:
+        assertEql(server.auth.startswith(FIFO_PREFIX), True, "Servers advertise a named pipe.")
+
+        client = joinJobServer(server.auth, 3)
+        assertEql(client is not None, True, "Clients can join a server.")
+
+        # The server and the client each have a free slot, plus two tokens in the pool.
+        for jobSlots in [ server, server, client, client ]:
+            jobSlots.acquire()
+        assertEql(len(server.heldTokens) + len(client.heldTokens), 2, "Tokens are shared.")
+
+        for jobSlots in [ server, server, client, client ]:
+            jobSlots.release()
+        assertEql(server.implicitFree and client.implicitFree, True, "Releasing returns slots.")
+
+        assertEql([ client.tryAcquire() for _ in range(4) ], [ True, True, True, False ], "Free slots can be taken without blocking.")
+        for _ in range(3):
+            client.release()
+
+        client.close()
+        server.close()
+        assertEql(os.path.exists(server.ownedDir), False, "The server cleans up after itself.")
+
+    # A make run in this process shares its parent's slots, plus the one its recipe holds.
+    parent = JobSlots(2)
+    parent.acquire()
+    shared = SharedJobSlots(parent, 2)
+    assertEql([ shared.tryAcquire() for _ in range(3) ], [ True, True, False ], "Shared slots come from the parent.")
+    assertEql(parent.tryAcquire(), False, "Shared slots are taken from the parent.")
+    shared.release()
+    assertEql(parent.tryAcquire(), True, "Shared slots are returned to the parent first.")
+
+    assertEql(joinJobServer("-1,-1"), None, "Negative descriptors mean no job server.")
+    assertEql(joinJobServer("not a job server"), None, "Invalid --jobserver-auth strings are ignored.")
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+# Admission control: stop starting new jobs while the machine is busy (-l, like GNU make's
+# --load-average) or short on memory (--min-free-memory), and start them again once that clears.
+# ThrottledJobSlots wraps job slots (see jobserverUtil). Before a slot is taken, the load and
+# the free memory are checked, every POLL_INTERVAL seconds, until both are within their limits.
+# As in GNU make, a job always starts if none of ours are running, so the build can't stall.
+#
+# On Linux, the load is the number of threads that are currently runnable (from /proc/loadavg),
+# as in GNU make 4.3+: the one-minute load average lags far behind jobs that just started.
+# Elsewhere, os.getloadavg() is used. Free memory is MemAvailable, from /proc/meminfo.
+
+import os, time, threading
+
+POLL_INTERVAL = 0.25 # Seconds.
+
+MEMORY_UNITS = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+
+# Get the current load, or None if it's unknown.
+def getLoad():
+    try:
+        # e.g. "0.52 0.58 0.59 3/1024 12345". The fourth field is runnable/total threads.
+        with open('/proc/loadavg', 'r') as file:
+            runnable = int(file.read().split()[3].split('/')[0])
+        return runnable - 1 # Don't count the thread reading /proc/loadavg.
+    except (OSError, IndexError, ValueError):
+        pass
+
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+# Get (free memory, total memory), in bytes, or None if unknown.
+def getFreeMemory():
+    values = {}
+
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                values[name] = int(value.split()[0]) * 1024 # Values are in kB.
+    except (OSError, IndexError, ValueError):
+        return None
+
+    if not 'MemTotal' in values or not 'MemAvailable' in values:
+        return None
+    return (values['MemAvailable'], values['MemTotal'])
+
+# Parse [text], an amount of memory: a percentage of [totalMemory] (e.g. 10%) or a size,
+# in megabytes unless it ends with K, M, G, or T (e.g. 512, 8G). Returns bytes.
+# Raises ValueError if [text] isn't a valid limit.
+def parseMemoryLimit(text, totalMemory):
+    text = text.strip().upper()
+
+    if text.endswith('%'):
+        return int(float(text[:-1]) / 100 * totalMemory)
+
+    unit = MEMORY_UNITS['M']
+
+    if text[-1:] in MEMORY_UNITS:
+        unit = MEMORY_UNITS[text[-1]]
+        text = text[:-1]
+    return int(float(text) * unit)
+
+class ThrottledJobSlots:
+    # [maxLoad] and [minFreeMemory] (in bytes) can be None, for no limit. If given, [log] is called
+    # with a message when new jobs stop being started, and when they start again.
+    def __init__(self, jobSlots, maxLoad=None, minFreeMemory=None, log=None, getLoad=getLoad, getFreeMemory=getFreeMemory):
+        self.jobSlots = jobSlots
+        self.maxJobs = jobSlots.maxJobs
+        self.auth = jobSlots.auth
+        self.maxLoad = maxLoad
+        self.minFreeMemory = minFreeMemory
+        self.log = log
+        self.getLoad = getLoad
+        self.getFreeMemory = getFreeMemory
+
+        self.lock = threading.Lock()
+        self.running = 0        # Number of our jobs that are running.
+        self.throttling = False # Whether the last check found too much load or too little free memory.
+
+    # Get why no more jobs should start now (a message), or None if they can.
+    def getPressure(self):
+        if self.maxLoad is not None:
+            load = self.getLoad()
+
+            if load is not None and load >= self.maxLoad:
+                return "the load (%g) is at least %g" % (load, self.maxLoad)
+
+        if self.minFreeMemory is not None:
+            freeMemory = self.getFreeMemory()
+
+            if freeMemory is not None and freeMemory[0] < self.minFreeMemory:
+                return "only %d MiB of memory is free (less than %d MiB)" % (freeMemory[0] // MEMORY_UNITS['M'], self.minFreeMemory // MEMORY_UNITS['M'])
+        return None
+
+    # Get whether another job can start now. Logs when this changes.
+    def canStart(self):
+        with self.lock:
+            if self.running == 0:
+                return True
+
+        pressure = self.getPressure()
+
+        with self.lock:
+            if self.log is not None and (pressure is not None) != self.throttling:
+                if pressure is not None:
+                    self.log("Not starting new jobs: %s." % pressure)
+                else:
+                    self.log("Starting new jobs again.")
+            self.throttling = pressure is not None
+
+        return pressure is None
+
+    def acquire(self):
+        while not self.canStart():
+            time.sleep(POLL_INTERVAL)
+
+        self.jobSlots.acquire()
+
+        with self.lock:
+            self.running += 1
+
+    def tryAcquire(self):
+        if not self.canStart() or not self.jobSlots.tryAcquire():
+            return False
+
+        with self.lock:
+            self.running += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+        self.jobSlots.release()
+
+    def close(self):
+        self.jobSlots.close()
+
+if __name__ == "__main__":
+    import almost_make.utils.jobserverUtil as jobserverUtil
+    print("Testing loadControlUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    assertEql(parseMemoryLimit("50%", 1000), 500, "Percentages of total memory.")
+    assertEql(parseMemoryLimit("2", 1000), 2 * 1024 ** 2, "Sizes are in megabytes by default.")
+    assertEql(parseMemoryLimit("1.5g", 1000), int(1.5 * 1024 ** 3), "Sizes can have units.")
+
+    try:
+        parseMemoryLimit("lots", 1000)
+        raise Exception("Invalid limits should raise ValueError.")
+    except ValueError:
+        pass
+
+    assertEql(getLoad() is None or getLoad() >= 0, True, "Loads aren't negative.")
+
+    load = [ 10 ]
+    messages = []
+    slots = ThrottledJobSlots(jobserverUtil.JobSlots(4), maxLoad=2, log=messages.append, getLoad=lambda: load[0])
+
+    slots.acquire()
+    assertEql(slots.running, 1, "Jobs start when none are running, regardless of the load.")
+    assertEql(slots.tryAcquire(), False, "No more jobs start while the load is too high.")
+    assertEql(messages, [ "Not starting new jobs: the load (10) is at least 2." ], "Throttling is logged.")
+
+    # Once the load drops, a blocked acquire continues.
+    thread = threading.Thread(target=slots.acquire)
+    thread.start()
+    time.sleep(POLL_INTERVAL * 2)
+    assertEql(slots.running, 1, "acquire waits while the load is too high.")
+
+    load[0] = 1
+    thread.join()
+    assertEql(slots.running, 2, "acquire continues once the load drops.")
+    assertEql(messages[-1], "Starting new jobs again.", "Resuming is logged.")
+
+    slots.release()
+    slots.release()
+
+    memory = [ (100, 1000) ]
+    slots = ThrottledJobSlots(jobserverUtil.JobSlots(4), minFreeMemory=500, getFreeMemory=lambda: memory[0])
+    slots.acquire()
+    assertEql(slots.tryAcquire(), False, "No more jobs start while too little memory is free.")
+    memory[0] = (900, 1000)
+    assertEql(slots.tryAcquire(), True, "Jobs start once memory is freed.")
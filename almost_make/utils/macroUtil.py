@@ -22,13 +22,17 @@ CONDITIONAL_STOP = re.compile(r"^\s*(endif)(?:\s|$)")
 COMMENT_CHAR = '#'
 
 class MacroUtil:
-    macroCommands = {} # All commands executable as $(name arg1, arg2, ...)
-    definitionConditions = [] # A list of additional preconditions for the definition of a macro.
-    lazyEvalConditions = []   # Don't expand macros on a line when in define & expand mode if any of these conditions are true.
     conditionals = False
-    errorLogger = errorUtil.ErrorUtil()
     expandUndefinedMacrosTo = None
-    
+
+    # Each MacroUtil has its own commands, conditions and error logger, so that several
+    # makefiles (e.g. recursive calls to make run in this process) can be parsed at once.
+    def __init__(self):
+        self.macroCommands = {} # All commands executable as $(name arg1, arg2, ...)
+        self.definitionConditions = [] # A list of additional preconditions for the definition of a macro.
+        self.lazyEvalConditions = []   # Don't expand macros on a line when in define & expand mode if any of these conditions are true.
+        self.errorLogger = errorUtil.ErrorUtil()
+
     def setStopOnError(self, stopOnErr):
         self.errorLogger.setStopOnError(stopOnErr)
     def setSilent(self, silent):
@@ -6,10 +6,7 @@
 #  - GNUMake: https://www.gnu.org/software/make/manual/make.html Accessed August 22, 2020
 #  - BSDMake:  http://khmere.com/freebsd_book/html/ch01.html Accessed Aug 22 2020 
 
-import re, sys, os, subprocess, time, threading, shlex
-# from concurrent.futures import ThreadPoolExecutor # We are **not** using this because adding an 
-#                                                   # executor to the queue when in an executed thread can cause deadlock! See 
-#                                                   # https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+import re, sys, os, subprocess, time, shlex, tempfile, contextlib
 
 from almost_make.utils.printUtil import cprint
 import almost_make.utils.macroUtil as macroUtility
@@ -18,34 +15,132 @@ import almost_make.utils.shellUtil.runner as runner
 import almost_make.utils.shellUtil.globber as globber
 import almost_make.utils.shellUtil.escapeParser as escaper
 import almost_make.utils.errorUtil as errorUtility
+import almost_make.utils.scheduleUtil as scheduleUtil
+import almost_make.utils.fileStateUtil as fileStateUtil
+import almost_make.utils.ruleUtil as ruleUtil
+import almost_make.utils.parseCacheUtil as parseCacheUtil
+import almost_make.utils.hashStateUtil as hashStateUtil
+import almost_make.utils.actionCacheUtil as actionCacheUtil
+import almost_make.utils.traceUtil as traceUtil
+import almost_make.utils.buildLogUtil as buildLogUtil
+import almost_make.utils.restatLogUtil as restatLogUtil
+import almost_make.utils.outputSyncUtil as outputSyncUtil
+import almost_make.utils.targetLogUtil as targetLogUtil
+import almost_make.utils.spawnUtil as spawnUtil
+
+# Directory for files that persist between runs (e.g. caches), relative to the makefile's directory.
+STATE_DIR = ".almake"
 
 # Regular expressions
 SPACE_CHARS = re.compile(r'\s+')
 INCLUDE_DIRECTIVE_EXP = re.compile(r"^\s*(include|\.include|-include|sinclude)\s+")
 
+# States of targets, as found by prepareGenerateTarget.
+TARGET_UP_TO_DATE = "up-to-date"
+TARGET_OUTDATED = "outdated" # Needs to be (re)generated.
+TARGET_MISSING = "missing"   # Doesn't exist, and there is no rule to make it.
+
 # Targets that are used by this parser/should be ignored.
 MAGIC_TARGETS = \
 {
     ".POSIX",
-    ".SUFFIXES"
+    ".SUFFIXES",
+    ".CACHE_ENV",
+    ".RESTAT",
+    ".NOTPARALLEL",
+    ".ONESHELL",
+    ".POOL"
+}
+
+# The prerequisites of .POOL_name (e.g. .POOL_link: app %.so) run in the pool, name.
+# See addPools.
+POOL_TARGET_PREFIX = ".POOL_"
+
+# Like GNU make, commands that only contain these characters are run directly,
+# rather than through /bin/sh (see getDirectArgs).
+NO_SHELL_SYNTAX_EXP = re.compile(r"""^[\w\-+=.,/:@% \t'"]*$""")
+
+# Shell builtins and keywords. Commands starting with these need a shell.
+SHELL_WORDS = \
+{
+    ".", ":", "alias", "bg", "break", "case", "cd", "command", "continue", "do", "done",
+    "elif", "else", "esac", "eval", "exec", "exit", "export", "fc", "fg", "fi", "for",
+    "getopts", "hash", "if", "in", "jobs", "login", "logout", "read", "readonly", "return",
+    "set", "shift", "source", "test", "then", "times", "trap", "type", "ulimit", "umask",
+    "unalias", "unset", "until", "wait", "while"
 }
 
+# Macros that are always part of action cache keys. Others can be
+# added as prerequisites of .CACHE_ENV.
+CACHE_ENV_MACROS = [ "PATH" ]
+
+# If [command] (e.g. cc -c foo.c) doesn't use any shell syntax (pipes, redirection,
+# globs, $, etc.), split it into arguments that can be run without a shell.
+# Otherwise, returns None.
+def getDirectArgs(command):
+    if os.name == 'nt' or NO_SHELL_SYNTAX_EXP.match(command) is None:
+        return None
+
+    try:
+        args = shlex.split(command)
+    except ValueError: # e.g. unclosed quotes. Let the shell report it.
+        return None
+
+    # Variable assignments (FOO=bar cmd) and builtins (cd, export, ...) need a shell.
+    if len(args) == 0 or "=" in args[0] or args[0] in SHELL_WORDS:
+        return None
+    return args
+
+# If [command] only runs make, [make] (e.g. the value of $(MAKE)), with arguments and no
+# other shell syntax (e.g. $(MAKE) -C lib all), get those arguments. Otherwise, returns None.
+def getRecursiveMakeArgs(command, make):
+    args = getDirectArgs(command)
+
+    try:
+        makeArgs = shlex.split(make)
+    except ValueError:
+        return None
+
+    if args is None or len(makeArgs) == 0 or args[:len(makeArgs)] != makeArgs:
+        return None
+    return args[len(makeArgs):]
+
+# Get whether [target] matches [pattern], a target in which a '%' matches any non-empty text.
+def matchesPattern(pattern, target):
+    if not '%' in pattern:
+        return pattern == target
+
+    before, after = pattern.split('%', 1)
+    return len(target) > len(before) + len(after) and target.startswith(before) and target.endswith(after)
+
+# Join [commands], the expanded lines of a recipe, into one script (see .ONESHELL).
+# As in GNU make, the first line's @ and - prefixes apply to the whole script.
+# They're removed from the other lines.
+def joinOneShellRecipe(commands):
+    lines = [ command.strip() for command in commands ]
+    return "\n".join(lines[:1] + [ line.lstrip("@-").lstrip() for line in lines[1:] ])
+
+# Raised, with -k, when a command in a recipe fails (after the failure has been reported).
+# The rest of the recipe doesn't run, and targets that depend on it aren't made.
+class RecipeError(Exception):
+    pass
+
 class MakeUtil:
     recipeStartChar = '\t'
     silent = False
-    macroCommands = {}
     maxJobs = 1
-    currentJobs = 1 # Number of currently running jobs...
-    jobLock = threading.Lock()
-    pending = {} # Set of pending jobs.
+    jobSlots = None # Shared with recursive calls to make. See jobserverUtil.
+    executor = scheduleUtil.EXECUTOR_THREAD # How recipes are run in parallel. See setExecutor.
     justPrint = False # Print commands, without evaluating.
+    restatAll = False # Whether to check all targets for changes after running their recipes. See isRestat.
 
     def __init__(self):
+        self.macroCommands = {}
         self.macroCommands["words"] = lambda argstring, macros: str(len(SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros))))
         self.macroCommands["sort"] = lambda argstring, macros: " ".join(sorted(list(set(SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros))))))
         self.macroCommands["strip"] = lambda argstring, macros: argstring.strip()
 
-        self.macroCommands["shell"] = lambda code, macros: os.popen(self.macroUtil.expandMacroUsages(code, macros)).read().rstrip(' \n\r\t') # To-do: Use the built-in shell if specified...
+        self.macroCommands["shell"] = lambda code, macros: self.evalShellMacro(code, macros)
         self.macroCommands["wildcard"] = lambda argstring, macros: " ".join([ shlex.quote(part) for part in self.glob(self.macroUtil.expandMacroUsages(argstring, macros), macros) ])
         self.macroCommands["dir"] = lambda argstring, macros: " ".join([ os.path.dirname(arg) for arg in SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros)) ])
         self.macroCommands["notdir"] = lambda argstring, macros: " ".join([ os.path.basename(arg) for arg in SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros)) ])
@@ -61,6 +156,26 @@ class MakeUtil:
 
         self.errorUtil = errorUtility.ErrorUtil()
         self.macroUtil = macroUtility.MacroUtil()
+        self.fileState = fileStateUtil.FileStateCache()
+        self.searchPaths = {} # Maps (VPATH, cwd) to search paths. See getSearchPath.
+        self.foundFiles = {} # Maps (path, VPATH, cwd) to (fileState generation, result). See findFile.
+        self.targetStates = {} # Maps targets to TARGET_ states for the current build.
+        self.ruleIndex = None
+        self.parseCache = None
+        self.parseRecorder = None # Notes what the makefile currently being parsed depends on.
+        self.hashState = None # If not None, decide whether targets are up-to-date by content. See hashStateUtil.
+        self.actionCache = None # If not None, restore recipe outputs from here, rather than running recipes.
+        self.tracer = traceUtil.NullTracer()
+        self.buildLog = None # Durations of recipes in earlier builds. See buildLogUtil.
+        self.restatLog = restatLogUtil.RestatLog() # Outputs that .RESTAT recipes left unchanged. See hasOutputChanged.
+        self.defaultDuration = 1.0 # Estimated duration of recipes that aren't in the build log, in seconds.
+        self.outputSync = outputSyncUtil.OutputSync() # Keeps the output of parallel recipes from interleaving.
+        self.targetLogs = None # If not None, a targetLogUtil.TargetLogs that archives each recipe's output.
+        self.cancelled = False # Whether running commands were stopped, because a recipe failed. See cancelJobs.
+        self.failedTargets = [] # With -k, targets whose recipes failed.
+        self.skippedTargets = [] # With -k, targets that weren't made because of those failures.
+        self.recursiveMake = None # Runs $(MAKE) in this process. See setRecursiveMake.
+        self.serialBuild = False # Whether recipes are being run one at a time. See getInProcessMakeArgs.
 
         self.macroUtil.enableConditionals() # ifeq, ifdef, etc.
 
@@ -88,12 +203,92 @@ class MakeUtil:
     def setJustPrint(self, justPrint):
         self.justPrint = justPrint
 
-    # Set the maximum number of threads used to evaluate targets.
+    # If [restat] is True, treat all targets as prerequisites of .RESTAT.
+    def setRestatAll(self, restat):
+        self.restatAll = restat
+
+    # Group the output of recipes with [outputSync], an outputSyncUtil.OutputSync.
+    def setOutputSync(self, outputSync):
+        self.outputSync = outputSync
+
+    # Copy the output of each recipe into a log in [targetLogs] (a targetLogUtil.TargetLogs).
+    def setTargetLogs(self, targetLogs):
+        self.targetLogs = targetLogs
+
+    # Set the maximum number of recipes that can run at the same time.
     # Note, however, that use of a recursive build-system may cause more than
     # this number of jobs to be used/created.
     def setMaxJobs(self, maxJobs):
         self.maxJobs = maxJobs
 
+    # Run recipes in parallel with [executor], one of scheduleUtil.EXECUTORS: with a pool
+    # of threads (EXECUTOR_THREAD) or from one asyncio event loop (EXECUTOR_ASYNC).
+    def setExecutor(self, executor):
+        self.executor = executor
+
+    # Take a job slot from [jobSlots] (e.g. a jobserverUtil.JobServer) before
+    # running each recipe. If None, use [maxJobs] slots local to this MakeUtil.
+    def setJobSlots(self, jobSlots):
+        self.jobSlots = jobSlots
+
+    # Reuse parsed makefiles stored in [parseCache] (a parseCacheUtil.ParseCache), if
+    # they are still valid. If None, always parse.
+    def setParseCache(self, parseCache):
+        self.parseCache = parseCache
+
+    # Decide whether targets are up-to-date using the content digests in [hashState]
+    # (a hashStateUtil.HashState), rather than only modification times. If None, only use modification times.
+    def setHashState(self, hashState):
+        self.hashState = hashState
+
+    # Restore the outputs of recipes from [actionCache] (an actionCacheUtil.ActionCache)
+    # when they have been run before with the same inputs. If None, always run recipes.
+    def setActionCache(self, actionCache):
+        self.actionCache = actionCache
+
+    # Record the time spent parsing, checking targets, and running recipes with [tracer]
+    # (a traceUtil.Tracer).
+    def setTracer(self, tracer):
+        self.tracer = tracer
+
+    # Record how long recipes take in [buildLog] (a buildLogUtil.BuildLog), and use the durations
+    # recorded there to run the targets on the longest path through the build first.
+    def setBuildLog(self, buildLog):
+        self.buildLog = buildLog
+
+    # Remember outputs that .RESTAT recipes left unchanged in [restatLog] (a restatLogUtil.RestatLog),
+    # so that they, and targets that depend on them, stay up-to-date in later builds.
+    def setRestatLog(self, restatLog):
+        self.restatLog = restatLog
+
+    # Estimate that recipes not in the build log take [duration] seconds.
+    def setDefaultDuration(self, duration):
+        self.defaultDuration = duration
+
+    # Get the estimated duration of [target]'s recipe, in seconds.
+    def getDurationEstimate(self, target):
+        duration = self.buildLog.getDuration(target)
+
+        if duration is None:
+            return self.defaultDuration
+        return duration
+
+    # Get the cache used to look up whether files exist and their modification times.
+    def getFileStateCache(self):
+        return self.fileState
+
+    # Use [fileState] (a fileStateUtil.FileStateCache, e.g. that of the make that started this
+    # one) to look up whether files exist and their modification times.
+    def setFileStateCache(self, fileState):
+        self.fileState = fileState
+
+    # Run recipe lines that only run $(MAKE) (e.g. $(MAKE) -C lib) with [recursiveMake], in this
+    # process, rather than starting another almake (and Python interpreter) for each.
+    # [recursiveMake] is called with (arguments to make, this MakeUtil, stdout, stderr) and
+    # returns make's exit status. If None, $(MAKE) always runs in another process.
+    def setRecursiveMake(self, recursiveMake):
+        self.recursiveMake = recursiveMake
+
     # Get a tuple.
     # First item: a map from target names
     #   to tuples of (dependencies, action)
@@ -174,13 +369,19 @@ class MakeUtil:
     # from macros['VPATH']. Returns an array with one element, the current working
     # directory, if there is no 'VPATH' macro.
     def getSearchPath(self, macros):
-        searchPath = [ os.path.abspath('.') ]
+        cwd = os.getcwd()
+        vpath = macros.get('VPATH')
+        cacheKey = (vpath, cwd)
+
+        if cacheKey in self.searchPaths:
+            return self.searchPaths[cacheKey]
+
+        searchPath = [ cwd ]
         
-        if not 'VPATH' in macros:
+        if vpath is None:
+            self.searchPaths[cacheKey] = searchPath
             return searchPath
 
-        vpath = macros['VPATH']
-
         # Split first by ';', then by ':', then finally,
         # try to split by space characters.
         splitOrder = [';', ':', ' ']
@@ -193,6 +394,7 @@ class MakeUtil:
                 break
         
         searchPath.extend([ os.path.normcase(part) for part in split ])
+        self.searchPaths[cacheKey] = searchPath
 
         return searchPath
 
@@ -201,32 +403,66 @@ class MakeUtil:
     # or space-separated entry for the file. Returns the 
     # path to the file, or None, if the file does not exist.
     def findFile(self, givenPath, macros):
+        # Results are only valid while nothing in the stat cache has been invalidated.
+        generation = self.fileState.generation
+        cacheKey = (givenPath, macros.get('VPATH'), os.getcwd())
+        found = self.foundFiles.get(cacheKey)
+
+        if found is not None and found[0] == generation:
+            return found[1]
+
+        result = self.searchForFile(givenPath, macros)
+        self.foundFiles[cacheKey] = (generation, result)
+        return result
+
+    # Find [givenPath] without using or updating the cache of results. See findFile.
+    def searchForFile(self, givenPath, macros):
         givenPath = os.path.normcase(givenPath)
         searchPath = self.getSearchPath(macros)
 
         for part in searchPath:
             path = os.path.join(part, givenPath)
 
-            if os.path.exists(path):
+            if self.fileState.exists(path):
+                # Paths in the current directory (searchPath[0]) are usually relative already. If so,
+                # skip relpath, which is slow.
+                if part is searchPath[0] and not os.path.isabs(givenPath):
+                    relativePath = os.path.normpath(givenPath)
+
+                    if not relativePath.startswith(os.pardir):
+                        return relativePath
                 return os.path.relpath(path)
         return None
 
+    # Forget the cached state of [target] and of each path it could be found at.
+    # Call this after running [target]'s recipe.
+    def invalidateTarget(self, target, macros):
+        self.targetStates.pop(target, None)
+        target = os.path.normcase(target)
+
+        for part in self.getSearchPath(macros):
+            self.fileState.invalidate(os.path.join(part, target))
+
     # Glob [text], but search [VPATH] for additional matches.
     def glob(self, text, macros):
         if not 'VPATH' in macros:
-            return globber.glob(text, '.')
-        
-        searchPath = self.getSearchPath(macros)
-        result = globber.glob(text, '.', [])
-        text = os.path.normcase(text)
+            result = globber.glob(text, '.')
+        else:
+            searchPath = self.getSearchPath(macros)
+            result = globber.glob(text, '.', [])
+            text = os.path.normcase(text)
 
-        for part in searchPath:
-            result.extend(globber.glob(os.path.join(part, text), '.', []))
-        
-        # Act like system glob. If we didn't find anything, 
-        # return [ text ] 
-        if len(result) == 0:
-            result = [ text ]
+            for part in searchPath:
+                result.extend(globber.glob(os.path.join(part, text), '.', []))
+            
+            # Act like system glob. If we didn't find anything, 
+            # return [ text ] 
+            if len(result) == 0:
+                result = [ text ]
+
+        # A cached parse is only valid if globbing gives the same result.
+        if self.parseRecorder is not None:
+            self.parseRecorder.recordGlob(text, macros.get('VPATH'), result)
         
         return result
 
@@ -244,6 +480,12 @@ class MakeUtil:
         
         return result
 
+    # Get the index of the rules in [targets]. See ruleUtil.
+    def getRuleIndex(self, targets):
+        if self.ruleIndex is None or self.ruleIndex.targets is not targets:
+            self.ruleIndex = ruleUtil.RuleIndex(targets, self.isPatternSubstRecipe)
+        return self.ruleIndex
+
     # Generate a recipe for [target] and add it to [targets].
     # Returns True if there is now a recipe for [target] in [targets],
     #  False otherwise.
@@ -252,72 +494,10 @@ class MakeUtil:
             return True
         
         generatedTarget = False
-        potentialNewRules = []
+        ruleIndex = self.getRuleIndex(targets)
 
         # Can we generate a recipe?
-        for key in targets.keys():
-            if self.isPatternSubstRecipe(key):
-                details, rules = targets[key]
-                generates, deps = details
-
-                for targetTest in generates:
-                    if targetTest == target:
-                        # Replace all '%' symbols with wildcard symbols.
-                        dependsOn = runner.shSplit(self.patsubst("%", "*", dependsOn.join(" ")), splitChars={ ' ', ';' })
-
-                        potentialNewRules.append((dependsOn, rules))
-                        continue
-                    elif not '%' in targetTest:
-                        continue
-
-                    sepIndex = targetTest.index("%")
-                    beforeContent = targetTest[:sepIndex]
-                    afterContent = targetTest[sepIndex + 1 :]
-
-                    if target.startswith(beforeContent) and target.endswith(afterContent):
-                        newKey = target
-                        newReplacement = newKey[sepIndex : len(newKey) - len(afterContent)]
-                        deps = " ".join(deps)
-                        deps = escaper.escapeSafeSplit(deps, "%", "\\")
-                        deps = newReplacement.join(deps)
-                        deps = deps.split(" ")
-
-                        potentialNewRules.append((deps, rules))
-            elif key.startswith(".") and "." in key[1:]:
-                shortKey = key[1:] # Remove the first '.'
-                parts = shortKey.split('.') # NOT a regex.
-                requires = '.' + parts[0].strip()
-                creates = '.' + parts[1].strip()
-                
-                # Don't evaluate... The user probably didn't intend for us to
-                # make a recipe from this.
-                if len(parts) > 2:
-                    continue
-                
-                if not ".SUFFIXES" in targets:
-                    continue
-                
-                validSuffixes,_ = targets[".SUFFIXES"]
-                
-                # Are these valid suffixes?
-                if not creates in validSuffixes \
-                        or not requires in validSuffixes:
-                    continue
-                
-                # Does it fit the current target?
-                if target.endswith(creates):
-                    deps,rules = targets[key]
-                    
-                    newDeps = [ dep for dep in deps if dep != '' ]
-                    withoutExtension = target[: - len(creates)]
-                    
-                    newDeps.append(withoutExtension + requires)
-
-                    potentialNewRules.append((newDeps, rules))
-            # Is it the same thing, just formatted differently?
-            elif os.path.abspath(key) == os.path.abspath(target):
-                rules, deps = targets[key]
-                potentialNewRules.append((rules, deps))
+        potentialNewRules = ruleIndex.getCandidates(target)
         
         fewestUngeneratableDeps = None
         for deps,rules in potentialNewRules:
@@ -339,6 +519,9 @@ class MakeUtil:
                 targets[target] = (deps, rules)
                 generatedTarget = True
                 fewestUngeneratableDeps = unsatisfiableCount
+
+        if generatedTarget:
+            ruleIndex.add(target)
         return generatedTarget
 
     # Return True iff [target] is not a "phony" target
@@ -353,6 +536,8 @@ class MakeUtil:
 
     # Get whether [target] needs to be (re)generated. If necessary,
     # creates a rule for [target] and adds it to [targets].
+    # Results are remembered for the rest of the build (or until [target] is
+    # rebuilt), so each target's dependencies are only checked once.
     def prepareGenerateTarget(self, target, targets, macros, visitingSet=None):
         target = target.strip()
         
@@ -364,7 +549,18 @@ class MakeUtil:
 
             # Just return whether it exists or not.
             return self.findFile(target, macros) == None
-        
+
+        state = self.targetStates.get(target)
+
+        if state is None:
+            state = self.getTargetState(target, targets, macros, visitingSet)
+            self.targetStates[target] = state
+
+        return state == TARGET_OUTDATED
+
+    # Find whether [target] is up-to-date, needs to be (re)generated, or can't be generated.
+    # Returns one of the TARGET_ constants. Use prepareGenerateTarget, which remembers results, instead.
+    def getTargetState(self, target, targets, macros, visitingSet):
         if not target in targets:
             self.generateRecipeFor(target, targets, macros)
         
@@ -374,57 +570,647 @@ class MakeUtil:
 
         if not target in targets:
             if selfExists:
-                return False
+                return TARGET_UP_TO_DATE
             else:
                 # This is an error! We need to generate the target, but
                 # there is no rule for it!
                 self.errorUtil.reportError("No rule to make %s." % target)
-                return False # If still running, we can't generate this.
+                return TARGET_MISSING # If still running, we can't generate this.
         
         deps, _ = targets[target]
         deps = self.globArgs(runner.removeEmpty(deps), macros, False) # Glob the set of dependencies.
         
         if selfExists:
-            selfMTime = os.path.getmtime(targetPath)
+            selfMTime = self.restatLog.getTargetMTime(targetPath, self.fileState.getMTime(targetPath))
         else:
-            return True
+            return TARGET_OUTDATED
         
         if self.isPhony(target, targets):
-            return True
+            return TARGET_OUTDATED
+
+        olderThanDep = False
         
         for dep in deps:
             if self.isPhony(dep, targets):
-                return True
+                return TARGET_OUTDATED
             
             pathToOther = self.findFile(dep, macros)
 
             # If it doesn't exist...
             if pathToOther == None:
-                return True
+                return TARGET_OUTDATED
 
             # If we're older than it...
-            if selfMTime < os.path.getmtime(pathToOther):
-                return True
+            if selfMTime < self.restatLog.getContentMTime(pathToOther, self.fileState.getMTime(pathToOther)):
+                # With content hashes, it's only outdated if the dependency's content changed.
+                if self.hashState is None:
+                    return TARGET_OUTDATED
+                olderThanDep = True
 
             visitingSet.add(target)
             needGenerateDep = self.prepareGenerateTarget(dep, targets, macros, visitingSet)
             visitingSet.remove(target)
 
             if needGenerateDep:
+                return TARGET_OUTDATED
+
+        if self.buildLog is not None and self.hasRecipeChanged(target, targets, macros):
+            return TARGET_OUTDATED
+
+        if self.hashState is not None:
+            return self.getHashedTargetState(target, targetPath, targets, macros, olderThanDep)
+        return TARGET_UP_TO_DATE
+
+    # Find whether [target], which exists at [targetPath] and whose dependencies are all
+    # up-to-date, needs to be regenerated, by comparing its signature to the one stored when
+    # it was last made. If no signature is stored, use modification times ([olderThanDep]).
+    def getHashedTargetState(self, target, targetPath, targets, macros, olderThanDep):
+        storedSignature = self.hashState.getTargetSignature(targetPath)
+
+        if storedSignature is None:
+            if olderThanDep:
+                return TARGET_OUTDATED
+
+            # Start tracking targets that were made before content hashes were enabled.
+            self.hashState.setTargetSignature(targetPath, self.getTargetSignature(target, targets, macros))
+            return TARGET_UP_TO_DATE
+
+        if storedSignature != self.getTargetSignature(target, targets, macros):
+            return TARGET_OUTDATED
+        return TARGET_UP_TO_DATE
+
+    # Get a digest of the contents of [target]'s dependencies and its expanded recipe.
+    def getTargetSignature(self, target, targets, macros):
+        macros, deps, depPaths = self.getRecipeMacros(target, targets, macros)
+        _, commands = targets[target]
+
+        inputs = [ path for dep, path in zip(deps, depPaths) if not self.isPhony(dep, targets) ]
+        recipe = [ self.macroUtil.expandMacroUsages(command, macros).strip() for command in commands ]
+        return self.hashState.getSignature(inputs, recipe)
+
+    # Get whether the commands in [target]'s recipe differ from those it ran last time, according
+    # to the build log. Targets that aren't in the log are assumed unchanged, and are added to it.
+    def hasRecipeChanged(self, target, targets, macros):
+        commandHash = self.getCommandHash(target, targets, macros)
+        loggedHash = self.buildLog.getCommandHash(target)
+
+        if loggedHash is None:
+            self.buildLog.record(target, None, commandHash)
+            return False
+        return loggedHash != commandHash
+
+    # Get a hash of the commands in [target]'s recipe, fully expanded.
+    def getCommandHash(self, target, targets, macros):
+        macros, _, _ = self.getRecipeMacros(target, targets, macros)
+        _, commands = targets[target]
+
+        return buildLogUtil.hashCommands([ self.macroUtil.expandMacroUsages(command, macros).strip() for command in commands ])
+
+    # Add [target] and each of its dependencies that need to be (re)generated
+    # to [scheduler]'s build graph. Returns [target]'s node.
+    def addToGraph(self, target, scheduler, targets, macros, visitingSet=None):
+        if scheduler.hasNode(target):
+            return scheduler.getNode(target)
+
+        if visitingSet is None:
+            visitingSet = set()
+
+        node = scheduler.getNode(target)
+        deps, _ = targets[target]
+        deps = self.globArgs(runner.removeEmpty(deps), macros, False) # Glob the set of dependencies.
+        serial = target in self.getNotParallelTargets(targets)
+        previous = None
+
+        visitingSet.add(target)
+        for dep in deps:
+            dep = dep.strip()
+
+            # Skip circular dependencies. prepareGenerateTarget has already warned about these.
+            if dep == "" or dep in visitingSet:
+                continue
+
+            if self.prepareGenerateTarget(dep, targets, macros):
+                depNode = self.addToGraph(dep, scheduler, targets, macros, visitingSet)
+                scheduler.addDependency(node, depNode)
+
+                # Prerequisites of targets listed in .NOTPARALLEL are made in order.
+                if serial and previous is not None and not scheduler.dependsOn(previous, depNode):
+                    scheduler.addDependency(depNode, previous)
+                previous = depNode
+        visitingSet.remove(target)
+
+        return node
+
+    # Get whether .NOTPARALLEL is given without prerequisites. If so, like GNU make,
+    # goals are made one at a time, in order, without running recipes in parallel.
+    def isNotParallel(self, targets):
+        return ".NOTPARALLEL" in targets and len(self.getNotParallelTargets(targets)) == 0
+
+    # Get the prerequisites of .NOTPARALLEL. Their own prerequisites are made one after another.
+    def getNotParallelTargets(self, targets):
+        return self.getSpecialPrerequisites(".NOTPARALLEL", targets)
+
+    # Get whether all of [target]'s recipe should be run by one shell. This is the case
+    # for all targets if .ONESHELL has no prerequisites, otherwise, for its prerequisites.
+    def isOneShell(self, target, targets):
+        if not ".ONESHELL" in targets:
+            return False
+
+        oneShellTargets = self.getSpecialPrerequisites(".ONESHELL", targets)
+        return len(oneShellTargets) == 0 or target in oneShellTargets
+
+    # Get the prerequisites of [specialTarget] (e.g. .NOTPARALLEL).
+    def getSpecialPrerequisites(self, specialTarget, targets):
+        if not specialTarget in targets:
+            return []
+        return [ dep.strip() for dep in runner.removeEmpty(targets[specialTarget][0]) if dep.strip() != "" ]
+
+    # Get whether to check if [target] changed after running its recipe. If it didn't,
+    # targets that depend on it only need to be rebuilt if they're outdated for some other reason.
+    def isRestat(self, target, targets):
+        if self.isPhony(target, targets) or self.justPrint:
+            return False
+        return self.restatAll or (".RESTAT" in targets and target in targets[".RESTAT"][0])
+
+    # Run [node]'s recipe, unless a dependency's recipe left its output unchanged (see isRestat)
+    # and, as such, [node] is now up-to-date. Returns whether [node]'s target changed.
+    def runNode(self, node, targets, macros):
+        if self.isNodeUpToDate(node, targets, macros):
+            return False
+        return self.runRecipe(node.target, targets, macros)
+
+    # Like runNode, but returns a coroutine that runs [node]'s recipe with the async executor.
+    async def runNodeAsync(self, node, targets, macros):
+        if self.isNodeUpToDate(node, targets, macros):
+            return False
+        return await self.runRecipeAsync(node.target, targets, macros)
+
+    # Get whether [node]'s target no longer needs to be made, because the recipes of its
+    # dependencies left their outputs unchanged.
+    def isNodeUpToDate(self, node, targets, macros):
+        if any([ dep.result is False for dep in node.deps ]):
+            self.targetStates.pop(node.target, None)
+
+            return not self.prepareGenerateTarget(node.target, targets, macros)
+        return False
+
+    # Get (modification time in nanoseconds, size, content digest) of the file at [path], or None.
+    def getOutputState(self, path):
+        if path is None:
+            return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, self.getContentDigests([ path ])[0])
+
+    # Get whether [target], which was at [targetPath] with state [before] (see getOutputState)
+    # before its recipe ran, changed. Its recipe ran with inputs as new as [inputsMTime].
+    # If it's unchanged, this is noted in the restat log, rather than by changing its modification
+    # time, so that it and its dependents stay up-to-date in later builds, too.
+    def hasOutputChanged(self, target, targetPath, before, inputsMTime, macros):
+        if before is None:
+            return True
+
+        try:
+            stat = os.stat(targetPath)
+        except OSError:
+            return True
+
+        mtime, size, digest = before
+
+        if stat.st_size != size:
+            return True
+
+        if stat.st_mtime_ns != mtime:
+            if self.getContentDigests([ targetPath ])[0] != digest:
                 return True
+
+            self.invalidateTarget(target, macros)
+
+        if stat.st_mtime_ns != mtime or inputsMTime > mtime:
+            contentMTime = self.restatLog.getContentMTime(targetPath, mtime)
+            self.restatLog.record(targetPath, stat.st_mtime_ns, inputsMTime, contentMTime)
+
+        self.targetStates[target] = TARGET_UP_TO_DATE
         return False
 
-    # Generate [target] if necessary (i.e. run recipes to create). Returns
-    # True if generated, False if not necessary.
-    def satisfyDependencies(self, target, targets, macros):
-        target = target.strip()
+    # Get the newest modification time of [target]'s dependencies that are files, as compared
+    # in getTargetState, in nanoseconds.
+    def getInputsMTime(self, target, targets, macros):
+        deps = self.globArgs(runner.removeEmpty(targets[target][0]), macros, False)
+        result = 0
 
-        if not self.prepareGenerateTarget(target, targets, macros):
-            return False
+        for dep in deps:
+            if self.isPhony(dep, targets):
+                continue
+
+            path = self.findFile(dep, macros)
+
+            if path is not None:
+                result = max(result, self.restatLog.getContentMTime(path, self.fileState.getMTime(path)))
+        return result
+
+    # Run the commands in [target]'s recipe. All of [target]'s
+    # dependencies should already be satisfied. Returns whether [target] changed:
+    # always True, unless [target] is a prerequisite of .RESTAT.
+    def runRecipe(self, target, targets, macros):
+        recipe = self.beginRecipe(target, targets, macros)
+
+        try:
+            with self.tracer.span(target, "recipe"):
+                result = self.runRecipeCommands(target, targets, macros)
+        finally:
+            self.endRecipeOutput(recipe)
+
+        return self.endRecipe(target, recipe, result, targets, macros)
+
+    # Like runRecipe, but returns a coroutine, for the async executor.
+    async def runRecipeAsync(self, target, targets, macros):
+        recipe = self.beginRecipe(target, targets, macros)
+
+        try:
+            with self.tracer.span(target, "recipe"):
+                result = await self.runRecipeCommandsAsync(target, targets, macros)
+        finally:
+            self.endRecipeOutput(recipe)
+
+        return self.endRecipe(target, recipe, result, targets, macros)
+
+    # Start running [target]'s recipe: note what's needed to check whether it changed (see
+    # isRestat) and start collecting its output. Returns a tuple to pass to endRecipe.
+    def beginRecipe(self, target, targets, macros):
+        startTime = time.perf_counter()
+        errorCount = self.errorUtil.errorCount
+        restatPath = None
+        before = None
+        inputsMTime = 0
+
+        if self.isRestat(target, targets):
+            restatPath = self.findFile(target, macros)
+            before = self.getOutputState(restatPath)
+            inputsMTime = self.getInputsMTime(target, targets, macros)
+
+        logging = self.targetLogs is not None and not self.justPrint and len(targets[target][1]) > 0
+        self.outputSync.begin()
+
+        if logging:
+            self.targetLogs.begin(target)
+
+        return (startTime, errorCount, restatPath, before, inputsMTime, logging)
+
+    # Stop collecting the output of [recipe] (from beginRecipe), even if it failed.
+    def endRecipeOutput(self, recipe):
+        if recipe[5]:
+            self.targetLogs.end()
+        self.outputSync.end()
+
+    # Finish running [target]'s recipe, [recipe] (from beginRecipe), which returned [result].
+    # Returns whether [target] changed.
+    def endRecipe(self, target, recipe, result, targets, macros):
+        startTime, errorCount, restatPath, before, inputsMTime, _ = recipe
+
+        if restatPath is not None:
+            result = self.hasOutputChanged(target, restatPath, before, inputsMTime, macros)
+
+        if self.buildLog is not None and not self.justPrint:
+            duration = time.perf_counter() - startTime
+            commandHash = None
+
+            # Don't log the commands of failed recipes (e.g. with -k), so that they run again.
+            if not self.isPhony(target, targets) and errorCount == self.errorUtil.errorCount:
+                commandHash = self.getCommandHash(target, targets, macros)
+            self.buildLog.record(target, duration, commandHash)
+        return result
+
+    # Run [target]'s recipe, or restore its output from the action cache. See runRecipe.
+    def runRecipeCommands(self, target, targets, macros):
+        macros, commands, cacheKey = self.prepareRecipeCommands(target, targets, macros)
+
+        if commands is None:
+            return True
+        errorCount = self.errorUtil.errorCount
+
+        try:
+            for command in commands:
+                self.runCommand(command.strip(), macros)
+        except RecipeError:
+            self.invalidateTarget(target, macros) # The recipe may have changed part of [target].
+            raise
+
+        self.endRecipeCommands(target, cacheKey, errorCount, targets, macros)
+        return True
+
+    # Like runRecipeCommands, but returns a coroutine, for the async executor.
+    async def runRecipeCommandsAsync(self, target, targets, macros):
+        import almost_make.utils.asyncScheduleUtil as asyncScheduleUtil
+
+        # With the action cache, preparing and finishing a recipe can take a while (hashing
+        # inputs, compressing outputs, requests to a remote cache). Do that on another
+        # thread, so that it doesn't stop other jobs.
+        async def runCacheStep(function, *args):
+            if self.actionCache is None:
+                return function(*args)
+            return await asyncScheduleUtil.runInThread(function, *args)
+
+        macros, commands, cacheKey = await runCacheStep(self.prepareRecipeCommands, target, targets, macros)
+
+        if commands is None:
+            return True
+        errorCount = self.errorUtil.errorCount
+
+        try:
+            for command in commands:
+                await self.runCommandAsync(command.strip(), macros)
+        except RecipeError:
+            self.invalidateTarget(target, macros)
+            raise
+
+        await runCacheStep(self.endRecipeCommands, target, cacheKey, errorCount, targets, macros)
+        return True
+
+    # Get a tuple, (the macros for [target]'s recipe (see getRecipeMacros), its commands, its
+    # key in the action cache or None). Commands are expanded as they're iterated over, so
+    # that they can use the results of earlier commands. If [target]'s output was restored
+    # from the action cache, there's nothing to run, and its commands are None.
+    def prepareRecipeCommands(self, target, targets, macros):
+        macros, deps, depPaths = self.getRecipeMacros(target, targets, macros)
+        _, commands = targets[target]
+        cacheKey = None
+
+        if self.actionCache is not None and not self.justPrint and not self.isPhony(target, targets) and len(commands) > 0:
+            # Expand each command only once: the cache key depends on the expanded commands.
+            commands = [ self.macroUtil.expandMacroUsages(command, macros) for command in commands ]
+            cacheKey = self.getActionKey(commands, deps, depPaths, targets, macros)
+
+            if self.actionCache.restore(cacheKey, macros["@"]):
+                if not self.silent:
+                    self.printOutput("Restored %s from the action cache.\n" % macros["@"])
+
+                self.finishRecipe(target, targets, macros)
+                return (macros, None, cacheKey)
+
+        expanded = cacheKey is not None
+
+        # Run the whole recipe as one script, rather than starting a shell for each line.
+        if self.isOneShell(target, targets) and len(commands) > 1:
+            if not expanded:
+                commands = [ self.macroUtil.expandMacroUsages(command, macros) for command in commands ]
+            commands = [ joinOneShellRecipe(commands) ]
+            expanded = True
+
+        if not expanded:
+            commands = ( self.macroUtil.expandMacroUsages(command, macros) for command in commands )
+        return (macros, commands, cacheKey)
+
+    # Update what's known about [target] after its commands have run. If no errors were
+    # reported since there were [errorCount] errors, store its output with [cacheKey].
+    def endRecipeCommands(self, target, cacheKey, errorCount, targets, macros):
+        self.finishRecipe(target, targets, macros)
+
+        # Don't cache outputs of failed recipes (e.g. when running with -k).
+        if cacheKey is not None and errorCount == self.errorUtil.errorCount:
+            targetPath = self.findFile(target, macros)
+
+            if targetPath is not None:
+                self.actionCache.store(cacheKey, targetPath)
+
+    # Run [command], an expanded line of a recipe, with [macros].
+    def runCommand(self, command, macros):
+        with self.tracer.span(command, "command"):
+            self.runCommandLine(command, macros)
+
+    # Like runCommand, but returns a coroutine, for the async executor.
+    async def runCommandAsync(self, command, macros):
+        with self.tracer.span(command, "command"):
+            await self.runCommandLineAsync(command, macros)
+
+    # Run [command] without tracing. See runCommand.
+    def runCommandLine(self, command, macros):
+        command, haltOnFail = self.beginCommandLine(command)
+        origDir = os.getcwd()
+
+        try:
+            status = 0
+            
+            if self.justPrint:
+                self.outputSync.write(command + "\n")
+            else:
+                with self.getCommandOutput(command, macros) as (stdout, stderr):
+                    status = self.runShellCommand(command, macros, stdout, stderr)
+            self.checkCommandStatus(command, status, haltOnFail)
+        except RecipeError:
+            raise
+        except Exception as e:
+            self.reportCommandException(command, e, haltOnFail)
+        finally:
+            self.endCommandLine(origDir)
+
+    # Like runCommandLine, but returns a coroutine, for the async executor.
+    async def runCommandLineAsync(self, command, macros):
+        command, haltOnFail = self.beginCommandLine(command)
+        origDir = os.getcwd()
+
+        try:
+            status = 0
+
+            if self.justPrint:
+                self.outputSync.write(command + "\n")
+            else:
+                with self.getCommandOutput(command, macros) as (stdout, stderr):
+                    status = await self.runShellCommandAsync(command, macros, stdout, stderr)
+            self.checkCommandStatus(command, status, haltOnFail)
+        except RecipeError:
+            raise
+        except Exception as e:
+            self.reportCommandException(command, e, haltOnFail)
+        finally:
+            self.endCommandLine(origDir)
+
+    # Echo [command] (unless it starts with @ or we're silent). Returns a tuple,
+    # ([command] without its @ and - prefixes, whether to stop if it fails).
+    def beginCommandLine(self, command):
+        # Another recipe failed (see cancelJobs). Don't start anything else.
+        if self.cancelled:
+            sys.exit(1)
+
+        if command.startswith("@"):
+            command = command[1:]
+        elif not self.silent:
+            self.printOutput(command + "\n")
+        haltOnFail = not command.startswith("-")
+        if command.startswith("-"):
+            command = command[1:]
+
+        return (command, haltOnFail)
+
+    def checkCommandStatus(self, command, status, haltOnFail):
+        if status != 0 and haltOnFail:
+            self.reportCommandFailure("Command %s exited with non-zero exit status, %s." % (command, str(status)))
+
+    def reportCommandException(self, command, exception, haltOnFail):
+        if haltOnFail: # e.g. -rm foo should be silent even if it cannot remove foo.
+            self.reportCommandFailure("Unable to run command:\n    ``%s``. \n\n  Message:\n%s" % (command, str(exception)))
+
+    # Report that a command failed, with [message], and stop its recipe. Without -k, this
+    # stops the build. Commands stopped by cancelJobs fail quietly: the failure that
+    # stopped them has already been reported.
+    def reportCommandFailure(self, message):
+        if self.cancelled:
+            sys.exit(1)
+
+        self.outputSync.flush()
+        self.errorUtil.reportError(message)
+        raise RecipeError(message)
+
+    # Stop running commands, because a recipe failed (without -k). Their recipes stop, too.
+    def cancelJobs(self):
+        self.cancelled = True
+        spawnUtil.terminateAll()
+
+    def endCommandLine(self, origDir):
+        # We should not switch directories, regardless of the command's result.
+        # Some platforms (e.g. a-Shell) do not reset the cwd after child processes exit.
+        if os.getcwd() != origDir:
+            os.chdir(origDir)
+        self.outputSync.endCommand()
+
+    # Print [text] (e.g. an echoed command) as part of the current recipe's output.
+    def printOutput(self, text):
+        self.outputSync.write(text)
+
+        if self.targetLogs is not None:
+            self.targetLogs.write(text)
+
+    # Run [command] with the system shell or, if _BUILTIN_SHELL is defined, the built-in
+    # shell. If given, [stdout] and [stderr] are file descriptors to which output is written.
+    # Returns the command's exit status.
+    def runShellCommand(self, command, macros, stdout=None, stderr=None):
+        makeArgs = self.getInProcessMakeArgs(command, macros)
+
+        if makeArgs is not None:
+            status = self.recursiveMake(makeArgs, self, stdout, stderr)
+
+            if status != 0:
+                raise subprocess.CalledProcessError(status, command) # Like spawnUtil.run with check.
+            return status
+
+        if not "_BUILTIN_SHELL" in macros:
+            args = None
+
+            if not "_ALWAYS_USE_SHELL" in macros:
+                args = getDirectArgs(command)
+
+            # Starting a shell for each command is slow. Skip it when possible.
+            if args is not None:
+                return spawnUtil.run(args, check=True, stdout=stdout, stderr=stderr)
+            return spawnUtil.run(command, shell=True, check=True, stdout=stdout, stderr=stderr)
+
+        defaultFlags = []
+        
+        if "_SYSTEM_SHELL_PIPES" in macros:
+            defaultFlags.append(runner.USE_SYSTEM_PIPE)
         
+        status,_ = shellUtility.evalScript(command, self.macroUtil, macros, defaultFlags = defaultFlags, stdout = stdout, stderr = stderr)
+        return status
+
+    # Like runShellCommand, but returns a coroutine, for the async executor.
+    async def runShellCommandAsync(self, command, macros, stdout=None, stderr=None):
+        import almost_make.utils.asyncScheduleUtil as asyncScheduleUtil
+
+        # Built-in commands (and $(MAKE), see getInProcessMakeArgs) run in this process.
+        # Run them on another thread, so that they don't stop the event loop.
+        if "_BUILTIN_SHELL" in macros or self.getInProcessMakeArgs(command, macros) is not None:
+            return await asyncScheduleUtil.runInThread(self.runShellCommand, command, macros, stdout, stderr)
+
+        args = None
+
+        if not "_ALWAYS_USE_SHELL" in macros:
+            args = getDirectArgs(command)
+
+        if args is not None:
+            return await asyncScheduleUtil.runProcess(args, stdout=stdout, stderr=stderr)
+        return await asyncScheduleUtil.runProcess(command, shell=True, stdout=stdout, stderr=stderr)
+
+    # If [command] only runs $(MAKE) and can run in this process (see setRecursiveMake), get the
+    # arguments to make. Otherwise, returns None. make changes the working directory (e.g. with
+    # -C), which all of this process's threads share, so this is only done while no other
+    # recipe can run at the same time (e.g. without -j). Define _MAKE_IN_SUBPROCESS to
+    # always start another process.
+    def getInProcessMakeArgs(self, command, macros):
+        if self.recursiveMake is None or not self.serialBuild or not "MAKE" in macros or "_MAKE_IN_SUBPROCESS" in macros:
+            return None
+        return getRecursiveMakeArgs(command, macros["MAKE"])
+
+    # Get a context manager that gives (stdout, stderr) file descriptors (or None, to
+    # inherit ours) to which [command] should write. If logging (see setTargetLogs), output
+    # is copied into the current target's log. If [outputSync] should collect the command's
+    # output, it is collected when the context manager exits.
+    @contextlib.contextmanager
+    def getCommandOutput(self, command, macros):
+        capture = self.outputSync.shouldCapture(command, macros.get("MAKE"))
+
+        if self.targetLogs is not None and self.targetLogs.isLogging():
+            tee = self.targetLogs.startTee(collect = capture)
+
+            try:
+                yield (tee.stdout, tee.stderr)
+            finally:
+                stdout, stderr = tee.finish()
+
+                if capture:
+                    self.outputSync.addCaptured(stdout, stderr)
+        elif capture:
+            # Output goes to temporary files, rather than pipes: built-in commands run on
+            # this thread, so nothing would read from a pipe while they write to it.
+            with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+                try:
+                    yield (stdout.fileno(), stderr.fileno())
+                finally:
+                    stdout.seek(0)
+                    stderr.seek(0)
+                    self.outputSync.addCaptured(stdout.read(), stderr.read())
+        else:
+            yield (None, None)
+
+    # Update what's known about [target] after its recipe has run (or its outputs were restored).
+    def finishRecipe(self, target, targets, macros):
+        self.invalidateTarget(target, macros)
+
+        if self.hashState is not None and not self.justPrint and not self.isPhony(target, targets):
+            targetPath = self.findFile(target, macros)
+
+            if targetPath is not None:
+                self.hashState.setTargetSignature(targetPath, self.getTargetSignature(target, targets, macros))
+
+    # Get the key for running [commands] (expanded) with dependencies [deps] at [depPaths] in
+    # the action cache. This includes digests of the dependencies' contents and the values of
+    # CACHE_ENV_MACROS and of the prerequisites of .CACHE_ENV.
+    def getActionKey(self, commands, deps, depPaths, targets, macros):
+        inputs = [ path for dep, path in zip(deps, depPaths) if not self.isPhony(dep, targets) ]
+        inputs = list(zip(inputs, self.getContentDigests(inputs)))
+
+        envNames = list(CACHE_ENV_MACROS)
+        if ".CACHE_ENV" in targets:
+            envNames.extend(targets[".CACHE_ENV"][0])
+        environment = { name: macros.get(name) for name in envNames }
+
+        return self.actionCache.getKey(commands, inputs, environment)
+
+    # Get a list of digests of the contents of the files at [paths] (None for files
+    # that aren't regular files).
+    def getContentDigests(self, paths):
+        if self.hashState is not None:
+            return self.hashState.getDigests(paths)
+        return [ hashStateUtil.hashFile(path) if os.path.isfile(path) else None for path in paths ]
+
+    # Get a tuple, (a copy of [macros] with the automatic macros for [target]'s recipe
+    # (e.g. $@ and $^) defined, [target]'s globbed dependencies, paths to those dependencies).
+    def getRecipeMacros(self, target, targets, macros):
         targetPath = self.findFile(target, macros)
 
-        deps, commands = targets[target]
+        deps, _ = targets[target]
         deps = self.globArgs(runner.removeEmpty(deps), macros, False) # Glob the set of dependencies.
         
         depPaths = []
@@ -434,85 +1220,193 @@ class MakeUtil:
                 depPaths.append(dep)
             else:
                 depPaths.append(self.findFile(dep, macros) or dep)
-        
-        pendingJobs = []
-
-        for dep in deps:
-    #        print("Checking dep %s; %s" % (dep, str(needGenerate(dep))))
-            if dep.strip() != "" and self.prepareGenerateTarget(dep, targets, macros):
-                self.jobLock.acquire()
-                if self.currentJobs < self.maxJobs and not dep in self.pending:
-                    self.currentJobs += 1
-                    self.jobLock.release()
 
-                    self.pending[dep] = threading.Thread(target=self.satisfyDependencies, args=(dep, targets, macros))
+        # Recipes can run in parallel, so each gets its own copy of the automatic macros.
+        macros = macros.copy()
 
-                    pendingJobs.append(dep)
-                else:
-                    self.jobLock.release()
-                    self.satisfyDependencies(dep, targets, macros)
-
-        for job in pendingJobs:
-            self.pending[job].start()
-
-        # Wait for all pending jobs to complete.
-        for job in pendingJobs:
-            self.pending[job].join()
-            self.pending[job] = None
-
-            self.jobLock.acquire()
-            self.currentJobs -= 1
-            self.jobLock.release()
-
-        # Here, we know that
-        # (1) all dependencies are satisfied
-        # (2) we need to run each command in recipe.
         # Define several macros the client will expect here:
         macros["@"] = targetPath or target
         macros["^"] = " ".join(depPaths)
         if len(deps) >= 1:
             macros["<"] = depPaths[0]
 
-        for command in commands:
-            command = self.macroUtil.expandMacroUsages(command, macros).strip()
-            if command.startswith("@"):
-                command = command[1:]
-            elif not self.silent:
-                print(command)
-                # Flush output so that it's not out of order when there's no TTY.
-                sys.stdout.flush()
-            haltOnFail = not command.startswith("-")
-            if command.startswith("-"):
-                command = command[1:]
-            
-            origDir = os.getcwd()
+        return (macros, deps, depPaths)
+
+    # Generate [target] if necessary (i.e. run recipes to create). Returns
+    # True if generated, False if not necessary.
+    # The graph of everything that needs to be generated is resolved first. Then, 
+    # up to [maxJobs] recipes are run at a time, each as soon as its dependencies
+    # have been generated.
+    def satisfyDependencies(self, target, targets, macros):
+        return len(self.satisfyGoals([ target ], targets, macros)) > 0
+
+    # Make each target in [goals]. Returns the goals that were outdated.
+    # With -j, goals share one build graph: independent goals are made at the same time
+    # and prerequisites they share are made once. Otherwise (or with .NOTPARALLEL), goals
+    # are made one after another, in order.
+    def satisfyGoals(self, goals, targets, macros):
+        serial = self.isNotParallel(targets)
+        self.serialBuild = serial or self.maxJobs <= 1
+
+        if serial or self.maxJobs <= 1:
+            return [ goal for goal in goals if len(self.buildGoals([ goal ], targets, macros, serial)) > 0 ]
+        return self.buildGoals(goals, targets, macros)
+
+    # Make [goals] with one scheduler. If [serial], run one recipe at a time.
+    # Returns the goals that were outdated.
+    def buildGoals(self, goals, targets, macros, serial=False):
+        getEstimate = None
+        if self.buildLog is not None:
+            getEstimate = lambda node: self.getDurationEstimate(node.target)
+
+        # With -k, a failed recipe only stops the targets that depend on it. Otherwise,
+        # it stops the build, and the commands other recipes are running.
+        keepGoing = not self.errorUtil.stopOnError
+
+        if serial:
+            scheduler = scheduleUtil.Scheduler(1, None, getEstimate, keepGoing, self.cancelJobs)
+        elif self.executor == scheduleUtil.EXECUTOR_ASYNC:
+            # Imported here: asyncio is slow to import, and only needed by this executor.
+            import almost_make.utils.asyncScheduleUtil as asyncScheduleUtil
+
+            scheduler = asyncScheduleUtil.AsyncScheduler(self.maxJobs, self.jobSlots, getEstimate, keepGoing, self.cancelJobs)
+            goals = self.addGoalsToGraph(goals, scheduler, targets, macros)
+            self.addPools(scheduler, targets)
+            scheduler.run(lambda node: self.runNodeAsync(node, targets, macros))
+            self.addFailures(scheduler)
+
+            return goals
+        else:
+            scheduler = scheduleUtil.Scheduler(self.maxJobs, self.jobSlots, getEstimate, keepGoing, self.cancelJobs)
+
+        goals = self.addGoalsToGraph(goals, scheduler, targets, macros)
+        self.addPools(scheduler, targets)
+        scheduler.run(lambda node: self.runNode(node, targets, macros))
+        self.addFailures(scheduler)
+
+        return goals
+
+    # With -k, note the targets that [scheduler] failed to make. Errors that weren't
+    # reported when they happened (i.e. other than failed commands) are reported here.
+    def addFailures(self, scheduler):
+        for node in scheduler.failed:
+            if not isinstance(node.exception, RecipeError):
+                self.errorUtil.reportError("Unable to make %s: %s" % (node.target, str(node.exception)))
+            self.failedTargets.append(node.target)
+
+        self.skippedTargets.extend([ node.target for node in scheduler.skipped ])
 
+    # With -k, print the targets that couldn't be made, if any.
+    def printFailureSummary(self):
+        if len(self.failedTargets) == 0 or self.silent:
+            return
+
+        failed = list(dict.fromkeys(self.failedTargets))
+        skipped = [ target for target in dict.fromkeys(self.skippedTargets) if not target in failed ]
+        message = "Failed to make %s." % ", ".join(failed)
+
+        if len(skipped) > 0:
+            message += "\nNot made, because of those failures: %s." % ", ".join(skipped)
+        cprint(message + "\n", "RED")
+
+    # Get whether there were errors that didn't stop make (with -k), e.g. a recipe that failed
+    # (see failedTargets) or a prerequisite without a rule.
+    def hasFailed(self):
+        return len(self.failedTargets) > 0 or self.errorUtil.errorCount + self.macroUtil.errorLogger.errorCount > 0
+
+    # Get a list of (pool name, targets and patterns in the pool), from each .POOL_name.
+    def getPoolMembers(self, targets):
+        members = []
+
+        for key in targets:
+            if not POOL_TARGET_PREFIX in key:
+                continue
+
+            # Lines with a '%' (e.g. .POOL_link: %.so) are stored like pattern rules.
+            if self.isPatternSubstRecipe(key):
+                (generates, deps), _ = targets[key]
+            else:
+                generates, deps = [ key ], targets[key][0]
+
+            for target in generates:
+                if target.startswith(POOL_TARGET_PREFIX):
+                    members.append((target[len(POOL_TARGET_PREFIX):], [ dep.strip() for dep in runner.removeEmpty(deps) if dep.strip() != "" ]))
+        return members
+
+    # Add the pools declared by .POOL, as pairs of names and depths (e.g. .POOL: link 2), to
+    # [scheduler]. At most depth jobs in each pool run at once. Put the nodes for targets
+    # listed as prerequisites of .POOL_name (e.g. .POOL_link: app %.so) in the pool, name.
+    def addPools(self, scheduler, targets):
+        declared = self.getSpecialPrerequisites(".POOL", targets)
+
+        if len(declared) % 2 != 0:
+            self.errorUtil.reportError(".POOL should list pairs of pool names and depths (e.g. .POOL: link 2), not %s." % " ".join(declared))
+
+        for name, depth in zip(declared[::2], declared[1::2]):
             try:
-                status = 0
-                
-                if self.justPrint:
-                    print(command)
-                elif not "_BUILTIN_SHELL" in macros:
-                    status = subprocess.run(command, shell=True, check=True).returncode
-                else:
-                    defaultFlags = []
-                    
-                    if "_SYSTEM_SHELL_PIPES" in macros:
-                        defaultFlags.append(runner.USE_SYSTEM_PIPE)
-                    
-                    status,_ = shellUtility.evalScript(command, self.macroUtil, macros, defaultFlags = defaultFlags)
-                
-                if status != 0 and haltOnFail:
-                    self.errorUtil.reportError("Command %s exited with non-zero exit status, %s." % (command, str(status)))
-            except Exception as e:
-                if haltOnFail: # e.g. -rm foo should be silent even if it cannot remove foo.
-                    self.errorUtil.reportError("Unable to run command:\n    ``%s``. \n\n  Message:\n%s" % (command, str(e)))
-            finally:
-                # We should not switch directories, regardless of the command's result.
-                # Some platforms (e.g. a-Shell) do not reset the cwd after child processes exit.
-                if os.getcwd() != origDir:
-                    os.chdir(origDir)
-        return True
+                scheduler.addPool(name, int(depth))
+            except ValueError:
+                self.errorUtil.reportError("Invalid depth for pool %s, %s. This must be an integer." % (name, depth))
+
+        members = self.getPoolMembers(targets)
+
+        for name, _ in members:
+            if not name in scheduler.pools:
+                self.errorUtil.reportError("%s%s lists targets for the pool %s, which isn't declared by .POOL." % (POOL_TARGET_PREFIX, name, name))
+
+        members = [ (name, patterns) for name, patterns in members if name in scheduler.pools ]
+
+        if len(members) == 0:
+            return
+
+        for node in scheduler.nodes.values():
+            for name, patterns in members:
+                if any([ matchesPattern(pattern, node.target) for pattern in patterns ]):
+                    scheduler.setPool(node, name)
+                    break
+
+    # Add the outdated targets in [goals], and the outdated targets they depend on,
+    # to [scheduler]'s graph. Returns the outdated goals.
+    def addGoalsToGraph(self, goals, scheduler, targets, macros):
+        goals = list(dict.fromkeys([ goal.strip() for goal in goals ])) # Remove duplicates, keeping order.
+        self.targetStates = {}
+
+        with self.tracer.span("checkUpToDate", "check", { 'targets': goals }):
+            goals = [ goal for goal in goals if self.prepareGenerateTarget(goal, targets, macros) ]
+
+            for goal in goals:
+                self.addToGraph(goal, scheduler, targets, macros)
+        return goals
+
+    # Get whether any of [goals] is outdated, without running any recipes.
+    def isAnyGoalOutdated(self, goals, targets, macros):
+        self.targetStates = {}
+
+        with self.tracer.span("checkUpToDate", "check", { 'targets': goals }):
+            return any(self.prepareGenerateTarget(goal, targets, macros) for goal in goals)
+
+    # Get what would be done to make [goals], without running any recipes: a list of
+    # { 'target', 'deps', 'commands' } dictionaries, one for each outdated target, in an
+    # order in which they could be made. 'deps' lists the outdated targets it waits for
+    # and 'commands' its expanded recipe.
+    def getPlan(self, goals, targets, macros):
+        scheduler = scheduleUtil.Scheduler(1)
+        self.addGoalsToGraph(goals, scheduler, targets, macros)
+        plan = []
+
+        def addToPlan(node):
+            recipeMacros, _, _ = self.getRecipeMacros(node.target, targets, macros)
+            _, commands = targets[node.target]
+
+            plan.append(
+            {
+                'target': node.target,
+                'deps': [ dep.target for dep in node.deps ],
+                'commands': [ self.macroUtil.expandMacroUsages(command, recipeMacros).strip() for command in commands ],
+            })
+
+        scheduler.run(addToPlan)
+        return plan
     
     # Handle all .include and include directives, as well as any conditionals.
     def handleIncludes(self, contents, macros):
@@ -543,19 +1437,18 @@ class MakeUtil:
 
                 for fileName in parts:
                     fileName = runner.stripQuotes(fileName)
+                    foundName = self.findInclude(fileName, macros)
 
-                    if not os.path.exists(fileName):
-                        foundName = self.findFile(fileName, macros)
+                    if self.parseRecorder is not None:
+                        self.parseRecorder.recordInclude(fileName, macros.get('VPATH'), foundName)
 
-                        if foundName != None:
-                            fileName = foundName
-
-                    if not os.path.exists(fileName):
+                    if foundName == None:
                         if ignoreError:
                             continue
 
                         self.errorUtil.reportError("File %s does not exist. Context: %s" % (fileName, line))
                         return (contents, macros)
+                    fileName = foundName
                     
                     if not os.path.isfile(fileName):
                         if ignoreError:
@@ -565,6 +1458,9 @@ class MakeUtil:
                         return (contents, macros)
 
                     try:
+                        if self.parseRecorder is not None:
+                            self.parseRecorder.recordFile(fileName)
+
                         with open(fileName, 'r') as file:
                             contents = file.read().split('\n')
                             contents.reverse() # We're reading in reverse, so write in reverse.
@@ -583,8 +1479,28 @@ class MakeUtil:
 
         return self.macroUtil.expandAndDefineMacros("\n".join(newLines), macros)
 
+    # Get the path to the file [fileName] refers to in an include directive,
+    # or None, if it can't be found.
+    def findInclude(self, fileName, macros):
+        if self.fileState.exists(fileName):
+            return fileName
+        return self.findFile(fileName, macros)
+
     ## Macro commands.
 
+    # Example: $(shell echo foo) -> foo
+    def evalShellMacro(self, code, macros):
+        command = self.macroUtil.expandMacroUsages(code, macros)
+        output = self.runShellMacro(command)
+
+        # A cached parse is only valid if the command's output is the same.
+        if self.parseRecorder is not None:
+            self.parseRecorder.recordShell(command, output)
+        return output
+
+    def runShellMacro(self, command):
+        return os.popen(command).read().rstrip(' \n\r\t') # To-do: Use the built-in shell if specified...
+
     # Example: $(subst foo,bar,foobar baz) -> barbar baz
     # See https://www.gnu.org/software/make/manual/html_node/Syntax-of-Functions.html#Syntax-of-Functions
     #     and https://www.gnu.org/software/make/manual/html_node/Text-Functions.html
@@ -694,26 +1610,147 @@ class MakeUtil:
         
         return " ".join(runner.removeEmpty(result))
 
+    # Get whether the parse stored in [entry] (see parseCacheUtil) is still valid: whether
+    # the macros and files it read, and the results of globs and shell commands it ran, are unchanged.
+    def isParseCacheEntryValid(self, entry, defaultMacros):
+        if not self.parseCache.checkMacrosAndFiles(entry, defaultMacros):
+            return False
+        
+        for fileName, vpath, foundName in entry['includes']:
+            if self.findInclude(fileName, self.getVPathMacros(vpath)) != foundName:
+                return False
+
+        for pattern, vpath, result in entry['globs']:
+            if self.glob(pattern, self.getVPathMacros(vpath)) != result:
+                return False
+
+        # Check these last: running commands is slow.
+        for command, output in entry['shellCommands']:
+            if self.runShellMacro(command) != output:
+                return False
+        return True
+
+    # Get a macro table that only defines VPATH, as [vpath] (if not None).
+    def getVPathMacros(self, vpath):
+        if vpath is None:
+            return {}
+        return { 'VPATH': vpath }
+
+    # Parse [contents], the text of a makefile. Returns a tuple, (map from targets to 
+    # rules, list of targets, macros). See getTargetActions. If there is a
+    # parse cache (see setParseCache), reuse an earlier parse if possible.
+    def parseMakefile(self, contents, defaultMacros, overrideMacros={}):
+        cacheKey = None
+
+        if self.parseCache is not None:
+            cacheKey = self.parseCache.getKey(contents, overrideMacros, self.macroUtil.expandUndefinedMacrosTo)
+            with self.tracer.span("loadParseCache", "parse"):
+                entry = self.parseCache.load(cacheKey)
+                entryValid = entry is not None and self.isParseCacheEntryValid(entry, defaultMacros)
+
+            if entryValid:
+                os.environ.update(entry['exports'])
+                return (entry['targetRecipes'], entry['targets'], entry['macros'])
+
+            self.parseRecorder = parseCacheUtil.ParseRecorder(defaultMacros)
+            defaultMacros = self.parseRecorder.macros
+
+        errorCount = self.errorUtil.errorCount + self.macroUtil.errorLogger.errorCount
+
+        try:
+            with self.tracer.span("expandAndDefineMacros", "parse"):
+                contents, macros = self.macroUtil.expandAndDefineMacros(contents, defaultMacros)
+            with self.tracer.span("handleIncludes", "parse"):
+                contents, macros = self.handleIncludes(contents, macros)
+            with self.tracer.span("getTargetActions", "parse"):
+                targetRecipes, targets = self.getTargetActions(contents)
+
+            # Don't cache parses with errors (e.g. when running with -k).
+            noErrors = errorCount == self.errorUtil.errorCount + self.macroUtil.errorLogger.errorCount
+
+            if self.parseRecorder is not None and noErrors:
+                self.parseCache.store(cacheKey, self.parseRecorder.getEntry(targetRecipes, targets, macros))
+        finally:
+            self.parseRecorder = None
+
+        return (targetRecipes, targets, dict(macros))
+
     ## Intended for use directly by clients:
 
     # Run commands specified to generate
     # dependencies of target by the contents
     # of the makefile given in contents.
+    # [target] can also be a list of targets, all of which are made (see satisfyGoals).
+    # The makefile is only parsed once.
     def runMakefile(self, contents, target = '', defaultMacros={ "MAKE": "almake" }, overrideMacros={}):
-        contents, macros = self.macroUtil.expandAndDefineMacros(contents, defaultMacros)
-        contents, macros = self.handleIncludes(contents, macros)
-        targetRecipes, targets = self.getTargetActions(contents)
+        targetRecipes, goals, macros = self.loadMakefile(contents, target, defaultMacros, overrideMacros)
+        madeGoals = self.satisfyGoals(goals, targetRecipes, macros)
+        self.printFailureSummary()
+
+        if not self.silent:
+            for goal in dict.fromkeys([ goal.strip() for goal in goals ]):
+                if not goal in madeGoals:
+                    print("Nothing to be done for target ``%s``." % goal)
+        
+        return (len(madeGoals) > 0, macros)
+
+    # Get whether anything needs to be done to make [target] (or each target in a list
+    # of targets), as described by the makefile in [contents]. Doesn't run any recipes.
+    def isMakefileOutdated(self, contents, target = '', defaultMacros={ "MAKE": "almake" }, overrideMacros={}):
+        targetRecipes, goals, macros = self.loadMakefile(contents, target, defaultMacros, overrideMacros)
+        return self.isAnyGoalOutdated(goals, targetRecipes, macros)
+
+    # Like runMakefile, but rather than running recipes, return what would be run. See getPlan.
+    def planMakefile(self, contents, target = '', defaultMacros={ "MAKE": "almake" }, overrideMacros={}):
+        targetRecipes, goals, macros = self.loadMakefile(contents, target, defaultMacros, overrideMacros)
+        return self.getPlan(goals, targetRecipes, macros)
+
+    # Parse [contents]. Returns (target recipes, goals, macros), where goals
+    # are the targets in [target] (a target or list of targets), or the default target.
+    def loadMakefile(self, contents, target, defaultMacros, overrideMacros):
+        with self.tracer.span("parseMakefile", "parse"):
+            targetRecipes, targets, macros = self.parseMakefile(contents, defaultMacros, overrideMacros)
+            self.getRuleIndex(targetRecipes) # Index pattern and suffix rules for generateRecipeFor.
 
-        if target == '' and len(targets) > 0:
-            target = targets[0]
+        goals = [ target ] if type(target) == str else list(target)
+
+        if len(targets) > 0:
+            goals = [ targets[0] if goal == '' else goal for goal in goals ]
 
         # Fill override macros.
         for macroName in overrideMacros:
             macros[macroName] = overrideMacros[macroName]
 
-        satisfied = self.satisfyDependencies(target, targetRecipes, macros)
+        return (targetRecipes, goals, macros)
 
-        if not satisfied and not self.silent:
-            print("Nothing to be done for target ``%s``." % target)
-        
-        return (satisfied, macros)
+if __name__ == "__main__":
+    print("Testing makeUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    assertEql(getDirectArgs("cc -c foo.c -o 'foo bar.o'"), [ "cc", "-c", "foo.c", "-o", "foo bar.o" ], "Plain commands are split.")
+
+    for command in [ "echo $HOME", "cat a | grep b", "ls *.c", "echo a > b", "a && b", "cd dir", "FOO=bar make", "echo ~", "echo \"a" ]:
+        assertEql(getDirectArgs(command), None, "%s needs a shell." % command)
+
+    make = "%s /path/to/cli.py" % shlex.quote(sys.executable)
+    assertEql(getRecursiveMakeArgs("%s -C lib all" % make, make), [ "-C", "lib", "all" ], "$(MAKE) lines can run in this process.")
+
+    for command in [ "cd lib && %s" % make, "%s -C lib > log" % make, "almake -C lib" ]:
+        assertEql(getRecursiveMakeArgs(command, make), None, "%s needs a separate process." % command)
+
+    assertEql(joinOneShellRecipe([ "@cd dir ", "\t-@rm foo", "ls" ]), "@cd dir\nrm foo\nls", "Only the first line of a .ONESHELL recipe keeps its prefixes.")
+
+    assertEql([ matchesPattern("%.so", target) for target in [ "libfoo.so", ".so", "foo.o" ] ], [ True, False, False ], "% matches non-empty text.")
+    assertEql(matchesPattern("app", "app"), True, "Patterns without a % match themselves.")
+
+    makeUtil = MakeUtil()
+    assertEql(makeUtil.runShellCommand("%s -c 'import sys; sys.exit(0)'" % shlex.quote(sys.executable), {}), 0, "Commands can run without a shell.")
+
+    try:
+        makeUtil.runShellCommand("%s -c 'import sys; sys.exit(3)'" % shlex.quote(sys.executable), {})
+        raise Exception("Failing commands should raise CalledProcessError.")
+    except subprocess.CalledProcessError as ex:
+        assertEql(ex.returncode, 3, "Exit statuses are kept.")
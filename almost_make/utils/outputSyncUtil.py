@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+# Keeps the output of parallel jobs from interleaving.
+# When synchronizing, each job's output (including the commands echoed before they
+# run) is collected, then written as one contiguous block, under a lock. Like GNU
+# make's --output-sync, there are several modes:
+#  - none: Write output as soon as it is produced.
+#  - line: Write the output of each command in a recipe as a block.
+#  - target: Write the output of each recipe as a block.
+#  - recurse: Like target, but also collect the output of recursive calls to make.
+#    (With the other modes, recursive makes write their own output.)
+# See https://www.gnu.org/software/make/manual/html_node/Parallel-Output.html
+
+import sys, threading
+
+import almost_make.utils.scheduleUtil as scheduleUtil
+
+SYNC_NONE = 'none'
+SYNC_LINE = 'line'
+SYNC_TARGET = 'target'
+SYNC_RECURSE = 'recurse'
+
+SYNC_MODES = [ SYNC_NONE, SYNC_LINE, SYNC_TARGET, SYNC_RECURSE ]
+
+# Write [data] (bytes) to [file] (e.g. sys.stdout) in a single call.
+def writeBytes(file, data):
+    if len(data) == 0:
+        return
+
+    file.flush()
+
+    if hasattr(file, 'buffer'):
+        file.buffer.write(data)
+        file.buffer.flush()
+    else:
+        file.write(data.decode('utf-8', errors='replace'))
+        file.flush()
+
+class OutputSync:
+    def __init__(self, mode=SYNC_NONE):
+        if not mode in SYNC_MODES:
+            raise ValueError("Unknown output synchronization mode, %s. Expected one of %s." % (mode, ", ".join(SYNC_MODES)))
+
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.local = scheduleUtil.JobLocal() # Each job's output is collected separately.
+
+    # Get whether output written by the current thread is being collected.
+    def isCollecting(self):
+        return getattr(self.local, 'stdout', None) is not None
+
+    # Get whether the output of a command that runs [command] should be collected.
+    # [makeCommand] is the command used to run make recursively.
+    def shouldCapture(self, command, makeCommand):
+        if not self.isCollecting():
+            return False
+        return self.mode == SYNC_RECURSE or not makeCommand or not makeCommand in command
+
+    # Start collecting output from the current thread, if synchronizing.
+    def begin(self):
+        if self.mode != SYNC_NONE:
+            self.local.stdout = []
+            self.local.stderr = []
+
+    # Write any collected output, as one block per stream.
+    def flush(self):
+        if not self.isCollecting():
+            return
+
+        stdout = b''.join(self.local.stdout)
+        stderr = b''.join(self.local.stderr)
+        self.local.stdout = []
+        self.local.stderr = []
+
+        with self.lock:
+            writeBytes(sys.stdout, stdout)
+            writeBytes(sys.stderr, stderr)
+
+    # Called after each command in a recipe.
+    def endCommand(self):
+        if self.mode == SYNC_LINE:
+            self.flush()
+
+    # Write collected output and stop collecting.
+    def end(self):
+        self.flush()
+        self.local.stdout = None
+        self.local.stderr = None
+
+    # Write [text] (a string) to stdout, or collect it.
+    def write(self, text):
+        if self.isCollecting():
+            self.local.stdout.append(text.encode('utf-8'))
+        else:
+            sys.stdout.write(text)
+            # Flush output so that it's not out of order when there's no TTY.
+            sys.stdout.flush()
+
+    # Collect [stdout] and [stderr] (bytes), captured from a command.
+    def addCaptured(self, stdout, stderr):
+        self.local.stdout.append(stdout or b'')
+        self.local.stderr.append(stderr or b'')
+
+if __name__ == "__main__":
+    import io
+    print("Testing outputSyncUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    realStdout = sys.stdout
+    sys.stdout = io.StringIO()
+
+    try:
+        sync = OutputSync(SYNC_TARGET)
+        sync.write("Not collected.\n")
+
+        def job(index):
+            sync.begin()
+            sync.write("Job %d, line 1.\n" % index)
+            sync.addCaptured(b"Job %d, line 2.\n" % index, b'')
+            sync.endCommand()
+            sync.write("Job %d, line 3.\n" % index)
+            sync.end()
+
+        threads = [ threading.Thread(target=job, args=(index,)) for index in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        lines = sys.stdout.getvalue().split('\n')
+    finally:
+        sys.stdout = realStdout
+
+    assertEql(lines[0], "Not collected.", "Output is only collected between begin and end.")
+    assertEql(len(lines), 8 * 3 + 2, "All output is written.")
+
+    for blockStart in range(1, len(lines) - 1, 3):
+        index = lines[blockStart].split(',')[0]
+        assertEql([ line.split(',')[0] for line in lines[blockStart : blockStart + 3] ], [ index ] * 3, "Each job's output is contiguous.")
+
+    sync = OutputSync(SYNC_TARGET)
+    sync.begin()
+    assertEql(sync.shouldCapture("python3 cli.py -C subdir", "python3 cli.py"), False, "Recursive makes write their own output.")
+    assertEql(OutputSync(SYNC_NONE).shouldCapture("cc -c foo.c", None), False, "Output isn't captured without synchronization.")
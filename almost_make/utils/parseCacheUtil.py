@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+# An on-disk cache of parsed makefiles.
+# Parsing a makefile (expanding macros, handling includes, finding rules) can take
+# seconds for large projects. A cached parse is stored under a key made from the
+# makefile's contents, the current directory, macros given on the command line, and what
+# undefined macros expand to (see --expand-undefined-to and --undefined-is-error).
+# While parsing, a ParseRecorder notes everything else the result depended on:
+#  - macros read from the environment (and their values),
+#  - files read through include directives (and their modification times and sizes),
+#  - the results of $(wildcard ...), include globs, and $(shell ...).
+# A cached parse is only used if all of these are unchanged.
+
+import os, pickle, hashlib, tempfile
+
+from almost_make.version import VERSION_STRING
+
+CACHE_FORMAT = 1
+
+# Get a tuple, (modification time in nanoseconds, size), for the file
+# at [path], or None if it doesn't exist.
+def getFileState(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+# A macro table that notes which of its default macros (e.g. from
+# the environment) are read before being (re)defined.
+class MacroReadRecorder(dict):
+    def __init__(self, defaults):
+        dict.__init__(self, defaults)
+        self.defaults = defaults
+        self.defined = set()
+        self.reads = {} # Maps names to (whether defined by default, default value).
+
+    def noteRead(self, name):
+        if not name in self.defined and not name in self.reads:
+            self.reads[name] = (name in self.defaults, self.defaults.get(name))
+
+    def __getitem__(self, name):
+        self.noteRead(name)
+        return dict.__getitem__(self, name)
+
+    def __contains__(self, name):
+        self.noteRead(name)
+        return dict.__contains__(self, name)
+
+    def get(self, name, default=None):
+        self.noteRead(name)
+        return dict.get(self, name, default)
+
+    def __setitem__(self, name, value):
+        self.defined.add(name)
+        dict.__setitem__(self, name, value)
+
+# Collects what a parse depended on.
+class ParseRecorder:
+    def __init__(self, defaultMacros):
+        self.macros = MacroReadRecorder(defaultMacros)
+        self.environBefore = dict(os.environ)
+
+        self.files = []    # List of (path, getFileState(path)).
+        self.includes = [] # List of (file name, VPATH, path found).
+        self.globs = []    # List of (pattern, VPATH, result).
+        self.shellCommands = [] # List of (command, output).
+
+    def recordFile(self, path):
+        self.files.append((path, getFileState(path)))
+
+    def recordInclude(self, fileName, vpath, foundPath):
+        self.includes.append((fileName, vpath, foundPath))
+
+    def recordGlob(self, pattern, vpath, result):
+        self.globs.append((pattern, vpath, list(result)))
+
+    def recordShell(self, command, output):
+        self.shellCommands.append((command, output))
+
+    # Get the environment variables exported while parsing.
+    def getExports(self):
+        return { name: value for name, value in os.environ.items() if self.environBefore.get(name) != value }
+
+    # Get a cache entry for the given parse result.
+    def getEntry(self, targetRecipes, targets, macros):
+        return \
+        {
+            'targetRecipes': targetRecipes,
+            'targets': targets,
+            'macros': dict(macros),
+            'exports': self.getExports(),
+            'macroReads': self.macros.reads,
+            'files': self.files,
+            'includes': self.includes,
+            'globs': self.globs,
+            'shellCommands': self.shellCommands,
+        }
+
+class ParseCache:
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    # Get the key for the parse of a makefile with content [contents], run in the current
+    # directory, with [overrideMacros] given on the command line. Undefined macros expand
+    # to [undefinedExpansion], or are errors if it's None (see MacroUtil's setDefaultMacroExpansion).
+    def getKey(self, contents, overrideMacros, undefinedExpansion=""):
+        keyData = repr((CACHE_FORMAT, VERSION_STRING, os.getcwd(), sorted(overrideMacros.items()), undefinedExpansion, contents))
+        return hashlib.sha256(keyData.encode('utf-8')).hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.cacheDir, key + '.pickle')
+
+    # Get the entry stored under [key], or None. The caller must check whether it is still valid.
+    def load(self, key):
+        try:
+            with open(self.getPath(key), 'rb') as file:
+                return pickle.load(file)
+        except Exception: # Missing or unreadable entries are cache misses.
+            return None
+
+    def store(self, key, entry):
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+            # Write to a temporary file first so that concurrent makes never read partial entries.
+            fd, tempPath = tempfile.mkstemp(dir=self.cacheDir)
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(entry, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath, self.getPath(key))
+        except OSError:
+            pass # Caching is an optimization. Don't fail the build.
+
+    # Get whether the macros read from [defaultMacros] by [entry]'s parse
+    # and the files it read are unchanged.
+    def checkMacrosAndFiles(self, entry, defaultMacros):
+        for name, (wasDefined, value) in entry['macroReads'].items():
+            if (name in defaultMacros) != wasDefined or defaultMacros.get(name) != value:
+                return False
+
+        for path, state in entry['files']:
+            if getFileState(path) != state:
+                return False
+        return True
+
+if __name__ == "__main__":
+    print("Testing parseCacheUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    recorder = ParseRecorder({ 'CC': 'cc', 'HOME': '/home/test' })
+    macros = recorder.macros
+    macros['CFLAGS'] = '-O2'
+
+    assertEql('CC' in macros, True, "Defaults are available.")
+    assertEql(macros['CFLAGS'], '-O2', "Definitions are available.")
+    assertEql('LDFLAGS' in macros, False, "Missing macros.")
+    assertEql(recorder.macros.reads, { 'CC': (True, 'cc'), 'LDFLAGS': (False, None) }, "Only reads of defaults are recorded.")
+
+    tempDir = tempfile.mkdtemp()
+    cache = ParseCache(tempDir)
+    key = cache.getKey("all:\n\techo test", { 'CC': 'gcc' })
+    assertEql(key == cache.getKey("all:\n\techo test", {}), False, "Command-line macros are part of the key.")
+    assertEql(cache.getKey("X := $(UNDEF)", {}, "") == cache.getKey("X := $(UNDEF)", {}, "hello"), False, "What undefined macros expand to is part of the key.")
+    assertEql(cache.getKey("X := $(UNDEF)", {}, "") == cache.getKey("X := $(UNDEF)", {}, None), False, "Whether undefined macros are errors is part of the key.")
+    assertEql(cache.load(key), None, "Empty caches miss.")
+
+    entry = recorder.getEntry({ 'all': ([], ['echo test']) }, [ 'all' ], macros)
+    cache.store(key, entry)
+    assertEql(cache.load(key)['targets'], [ 'all' ], "Stored entries can be loaded.")
+    assertEql(cache.checkMacrosAndFiles(entry, { 'CC': 'cc' }), True, "Unchanged macros are valid.")
+    assertEql(cache.checkMacrosAndFiles(entry, { 'CC': 'gcc' }), False, "Changed macros are invalid.")
+    assertEql(cache.checkMacrosAndFiles(entry, { 'CC': 'cc', 'LDFLAGS': '' }), False, "Newly-defined macros are invalid.")
+
+    os.remove(cache.getPath(key))
+    os.rmdir(tempDir)
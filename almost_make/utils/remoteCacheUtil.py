@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+
+# A client for a remote build cache, shared over HTTP by many machines.
+# The remote cache stores the same action records and compressed blobs as
+# a local actionCacheUtil.ActionCache. When the local cache misses, the action is
+# fetched from the remote cache into the local cache. Actions stored locally are
+# uploaded in the background.
+#
+# See cacheServer.py for the protocol and a reference server.
+#
+# Connections are kept alive and reused between requests. At most [maxUploads]
+# uploads run at a time, on their own threads, so recipes never wait for uploads.
+#
+# Fetched records and blobs are only trusted as far as the local cache checks them:
+# digests must be valid (so they can't name paths outside the cache), and restored
+# outputs must match their digests (see ActionCache.restore).
+
+import os, json, threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import almost_make.utils.actionCacheUtil as actionCacheUtil
+
+TIMEOUT = 30 # Seconds.
+
+class RemoteCache:
+    def __init__(self, url, maxUploads=4):
+        parts = urlsplit(url)
+
+        if parts.scheme == 'https':
+            self.connectionType = http.client.HTTPSConnection
+        elif parts.scheme == 'http':
+            self.connectionType = http.client.HTTPConnection
+        else:
+            raise ValueError("Unsupported remote cache URL, %s. Only http:// and https:// URLs are supported." % url)
+
+        self.host = parts.netloc
+        self.basePath = parts.path.rstrip('/')
+
+        self.lock = threading.Lock()
+        self.idleConnections = []
+        self.uploads = ThreadPoolExecutor(max_workers=max(1, maxUploads))
+
+        self.hits = 0
+        self.misses = 0
+        self.uploaded = 0
+        self.errors = 0
+
+    # Send a request. [body] can be bytes or a file. Returns a tuple, (status, response body).
+    # Raises OSError or http.client.HTTPException on failure.
+    def request(self, method, path, body=None, headers={}):
+        with self.lock:
+            connection = self.idleConnections.pop() if len(self.idleConnections) > 0 else None
+        reused = connection is not None
+
+        if connection is None:
+            connection = self.connectionType(self.host, timeout=TIMEOUT)
+
+        try:
+            connection.request(method, self.basePath + path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read() # Read everything, so the connection can be reused.
+        except (OSError, http.client.HTTPException):
+            connection.close()
+
+            # The server may have closed an idle connection. Retry once with a new one.
+            if reused and (body is None or isinstance(body, bytes)):
+                return self.request(method, path, body, headers)
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.idleConnections.append(connection)
+        return (response.status, data)
+
+    # Fetch the action with key [key] into [actionCache] (an actionCacheUtil.ActionCache).
+    # Returns True if the action was found.
+    def fetch(self, key, actionCache):
+        try:
+            status, record = self.request('GET', '/ac/' + key)
+
+            if status != 200:
+                self.misses += 1
+                return False
+
+            digest = json.loads(record.decode('utf-8'))['digest']
+
+            if not actionCacheUtil.isValidDigest(digest):
+                raise ValueError("The remote cache's record for %s has an invalid digest." % key)
+            blobPath = actionCache.getBlobPath(digest)
+
+            if not os.path.exists(blobPath):
+                status, blob = self.request('GET', '/cas/' + digest)
+
+                if status != 200:
+                    self.misses += 1
+                    return False
+                actionCache.writeFile(blobPath, blob)
+
+            actionCache.writeFile(actionCache.getActionPath(key), record)
+        except (OSError, ValueError, KeyError, http.client.HTTPException):
+            self.errors += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    # Upload the action with key [key] from [actionCache] in the background.
+    def upload(self, key, actionCache):
+        self.uploads.submit(self.uploadNow, key, actionCache)
+
+    def uploadNow(self, key, actionCache):
+        try:
+            with open(actionCache.getActionPath(key), 'rb') as file:
+                record = file.read()
+            digest = json.loads(record.decode('utf-8'))['digest']
+
+            # Identical outputs share blobs, so the blob may already be there.
+            status, _ = self.request('HEAD', '/cas/' + digest)
+
+            if status != 200:
+                blobPath = actionCache.getBlobPath(digest)
+
+                with open(blobPath, 'rb') as blob:
+                    headers = { 'Content-Length': str(os.fstat(blob.fileno()).st_size) }
+                    status, _ = self.request('PUT', '/cas/' + digest, blob, headers)
+
+                if status >= 300:
+                    raise IOError("Uploading %s failed with status %d." % (digest, status))
+
+            # Upload the record last, so that it never refers to a missing blob.
+            status, _ = self.request('PUT', '/ac/' + key, record)
+
+            if status >= 300:
+                raise IOError("Uploading %s failed with status %d." % (key, status))
+            self.uploaded += 1
+        except (OSError, ValueError, KeyError, http.client.HTTPException):
+            self.errors += 1 # The remote cache is an optimization. Don't fail the build.
+
+    # Wait for uploads to finish, then close all connections.
+    def close(self):
+        self.uploads.shutdown()
+
+        with self.lock:
+            for connection in self.idleConnections:
+                connection.close()
+            self.idleConnections = []
+
+    def getSummary(self):
+        return "Remote cache: %d hits, %d misses, %d uploads, %d errors." % (self.hits, self.misses, self.uploaded, self.errors)
+
+if __name__ == "__main__":
+    import tempfile, shutil, zlib
+    import almost_make.utils.cacheServer as cacheServer
+    print("Testing remoteCacheUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    tempDir = tempfile.mkdtemp()
+    server = cacheServer.startServer(os.path.join(tempDir, 'server'))
+    outputPath = os.path.join(tempDir, 'output.txt')
+
+    with open(outputPath, 'w') as file:
+        file.write("Test output")
+
+    # One machine builds and uploads...
+    remote = RemoteCache(server.getURL(), 2)
+    firstCache = actionCacheUtil.ActionCache(os.path.join(tempDir, 'first'))
+    key = firstCache.getKey([ 'make output.txt' ], [], {})
+
+    assertEql(remote.fetch(key, firstCache), False, "Empty remote caches miss.")
+    firstCache.store(key, outputPath)
+    remote.upload(key, firstCache)
+    remote.close()
+    assertEql((remote.uploaded, remote.errors), (1, 0), "Actions are uploaded.")
+
+    # ...another downloads.
+    os.remove(outputPath)
+    remote = RemoteCache(server.getURL() + '/', 2)
+    secondCache = actionCacheUtil.ActionCache(os.path.join(tempDir, 'second'))
+    assertEql(remote.fetch(key, secondCache), True, "Uploaded actions can be fetched.")
+    assertEql(secondCache.restore(key, outputPath), True, "Fetched actions are stored locally.")
+
+    with open(outputPath, 'r') as file:
+        assertEql(file.read(), "Test output", "Fetched outputs are unchanged.")
+
+    assertEql(remote.request('GET', '/ac/../../etc/passwd')[0], 400, "Invalid paths are rejected.")
+    assertEql(len(remote.idleConnections), 1, "Connections are reused.")
+
+    # Records from the server can't name files outside the cache.
+    badKey = secondCache.getKey([ 'make bad.txt' ], [], {})
+    remote.request('PUT', '/ac/' + badKey, b'{"digest": "../../../output.txt", "mode": 420}')
+    assertEql(remote.fetch(badKey, secondCache), False, "Invalid digests are rejected.")
+    assertEql(os.path.exists(secondCache.getActionPath(badKey)), False, "Invalid records aren't stored.")
+
+    # The server only accepts blobs that match their digests.
+    assertEql(remote.request('PUT', '/cas/' + 'a' * 64, zlib.compress(b"Not a"))[0], 400, "Blobs are checked when uploaded.")
+
+    # Blobs that were changed on the server aren't restored.
+    poisonedKey = secondCache.getKey([ 'make poisoned.txt' ], [], {})
+    poisonedPath = os.path.join(tempDir, 'server', 'cas', 'b' * 2, 'b' * 64)
+    os.makedirs(os.path.dirname(poisonedPath))
+    with open(poisonedPath, 'wb') as file:
+        file.write(zlib.compress(b"Not b"))
+    remote.request('PUT', '/ac/' + poisonedKey, b'{"digest": "' + b'b' * 64 + b'", "mode": 420}')
+
+    assertEql(remote.fetch(poisonedKey, secondCache), True, "Blobs are fetched.")
+    assertEql(secondCache.restore(poisonedKey, outputPath), False, "Fetched blobs are checked before they're restored.")
+    with open(outputPath, 'r') as file:
+        assertEql(file.read(), "Test output", "Outputs aren't replaced by blobs that don't match.")
+    remote.close()
+
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(tempDir)
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+# A persistent record of outputs that .RESTAT recipes (see makeUtil's isRestat) left
+# unchanged, like the modification times ninja's restat writes to .ninja_log.
+# Such an output wasn't rewritten, or was rewritten with the same content, so it's older
+# than (or, as a prerequisite, seems newer than) it should be. Rather than changing its
+# modification time, this records, along with that modification time:
+#  - the newest modification time of its inputs when its recipe last ran. The output is
+#    up-to-date with respect to inputs no newer than this.
+#  - when its content last changed. Targets that depend on it are compared with this.
+# Records only apply while the output's modification time is the one recorded.
+#
+# The log is a text file. After a header line, each line is
+#   OUTPUT_MTIME_NS<tab>INPUTS_MTIME_NS<tab>CONTENT_MTIME_NS<tab>TARGET
+# where TARGET is the output's absolute path. Like buildLogUtil's log, it's only appended
+# to, so later lines replace earlier lines for the same target, and it's rewritten when
+# most lines are out-of-date.
+
+import os, threading, tempfile
+
+LOG_HEADER = "# almake restat log v1"
+
+# Rewrite the log when it has this many more lines than targets.
+MAX_STALE_LINES = 1000
+
+class RestatLog:
+    # If [path] is None, records are only kept for the rest of this build.
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None # Maps targets to (output, inputs, content modification times). See load.
+        self.lineCount = 0
+        self.file = None
+
+    # Get the key used to store [target] in the log.
+    def normalize(self, target):
+        return os.path.normcase(os.path.abspath(target))
+
+    # Read the log, the first time it's needed. Must be called with [lock] held.
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+
+        if self.path is None:
+            return
+
+        try:
+            with open(self.path, 'r') as file:
+                lines = file.read().split('\n')
+        except OSError:
+            return
+
+        # Ignore logs from other versions.
+        if lines[0] != LOG_HEADER:
+            return
+
+        for line in lines[1:]:
+            parts = line.split('\t', 3)
+
+            if len(parts) < 4:
+                continue
+
+            try:
+                self.entries[parts[3]] = (int(parts[0]), int(parts[1]), int(parts[2]))
+            except ValueError:
+                continue # Ignore partially-written lines.
+            self.lineCount += 1
+
+    # Get the record for [target], if its modification time is still [mtime]. Otherwise, None.
+    def get(self, target, mtime):
+        with self.lock:
+            self.load()
+            entry = self.entries.get(self.normalize(target))
+
+        if entry is None or entry[0] != mtime:
+            return None
+        return entry
+
+    # Get the newest modification time of [target]'s inputs for which it's up-to-date.
+    # [mtime] is [target]'s modification time, which is returned if there's no record.
+    def getTargetMTime(self, target, mtime):
+        entry = self.get(target, mtime)
+
+        if entry is None:
+            return mtime
+        return max(mtime, entry[1])
+
+    # Get when the content of [target], with modification time [mtime], last changed.
+    def getContentMTime(self, target, mtime):
+        entry = self.get(target, mtime)
+
+        if entry is None:
+            return mtime
+        return entry[2]
+
+    # Note that [target], now with modification time [mtime], was made from inputs with
+    # modification times up to [inputsMTime], and its content hasn't changed since [contentMTime].
+    def record(self, target, mtime, inputsMTime, contentMTime):
+        target = self.normalize(target)
+        entry = (mtime, inputsMTime, contentMTime)
+
+        with self.lock:
+            self.load()
+
+            if self.path is not None:
+                try:
+                    if self.file is None:
+                        self.openLog()
+
+                    self.file.write(self.formatLine(target, entry))
+                    self.file.flush()
+                    self.lineCount += 1
+                except OSError:
+                    pass # Without the record, the recipe just runs again next time.
+
+            self.entries[target] = entry
+
+    def formatLine(self, target, entry):
+        return "%d\t%d\t%d\t%s\n" % (entry + (target,))
+
+    # Open the log for appending. If it has too many stale lines, rewrite it first.
+    # Must be called with [lock] held.
+    def openLog(self):
+        directory = os.path.dirname(self.path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        if self.lineCount == 0 or self.lineCount > len(self.entries) + MAX_STALE_LINES:
+            fd, tempPath = tempfile.mkstemp(dir=directory or '.')
+
+            with os.fdopen(fd, 'w') as file:
+                file.write(LOG_HEADER + "\n")
+
+                for target, entry in self.entries.items():
+                    file.write(self.formatLine(target, entry))
+            os.replace(tempPath, self.path)
+            self.lineCount = len(self.entries)
+
+        self.file = open(self.path, 'a')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+if __name__ == "__main__":
+    import shutil
+    print("Testing restatLogUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    tempDir = tempfile.mkdtemp()
+    logPath = os.path.join(tempDir, 'state', 'restat')
+
+    log = RestatLog(logPath)
+    assertEql((log.getTargetMTime('gen.h', 100), log.getContentMTime('gen.h', 100)), (100, 100), "Targets without records.")
+
+    log.record('gen.h', 100, 300, 50)
+    log.record('./other.h', 10, 20, 10)
+    log.close()
+    assertEql(os.path.exists(os.path.join(tempDir, 'state')), True, "Logs are created when needed.")
+
+    log = RestatLog(logPath)
+    assertEql(log.getTargetMTime('gen.h', 100), 300, "Outputs are as new as the inputs they were made from.")
+    assertEql(log.getContentMTime('./gen.h', 100), 50, "Dependents see when the content changed.")
+    assertEql((log.getTargetMTime('gen.h', 400), log.getContentMTime('gen.h', 400)), (400, 400), "Records are ignored once outputs change.")
+    assertEql(log.getTargetMTime('other.h', 10), 20, "Each target has a record.")
+
+    log.record('gen.h', 400, 500, 50)
+    log.close()
+    log = RestatLog(logPath)
+    assertEql(log.getContentMTime('gen.h', 400), 50, "Later records replace earlier ones.")
+
+    log.lineCount = len(log.entries) + MAX_STALE_LINES + 1
+    log.record('baz.o', 1, 2, 1)
+    log.close()
+
+    with open(logPath, 'r') as file:
+        assertEql(len(file.read().strip().split('\n')), 4, "Logs with many stale lines are rewritten.")
+
+    memoryLog = RestatLog()
+    memoryLog.record('gen.h', 1, 2, 1)
+    assertEql(memoryLog.getTargetMTime('gen.h', 1), 2, "Records can be kept in memory only.")
+
+    shutil.rmtree(tempDir)
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+# An index of the rules in a parsed makefile, for finding
+# the rules that could make a target without a rule of its own.
+# Without an index, each lookup would need to check every rule.
+#  - Pattern rules (e.g. %.o: %.c) are bucketed by the text after the '%'.
+#  - Suffix rules (e.g. .c.o:) are keyed by the suffix they create.
+#  - Other targets are keyed by their absolute path, so ./foo.o can be made using foo.o's rule.
+# See https://www.gnu.org/software/make/manual/html_node/Pattern-Rules.html
+#  and https://www.gnu.org/software/make/manual/html_node/Suffix-Rules.html
+
+import os
+
+import almost_make.utils.shellUtil.runner as runner
+import almost_make.utils.shellUtil.escapeParser as escaper
+
+class RuleIndex:
+    # [targets] is a map from targets to their rules, as created by MakeUtil's getTargetActions.
+    # [isPatternRule] should return True iff a key in targets is a pattern rule.
+    def __init__(self, targets, isPatternRule):
+        self.targets = targets
+        self.isPatternRule = isPatternRule
+        self.indexed = set()
+
+        # Maps the length of the text after each pattern's '%' to a map from that text
+        # to a list of (order, before '%', after '%', dependencies split by '%', rules).
+        self.patternRules = {}
+
+        # Maps targets named in a pattern rule, but without a '%', to a list of (order, deps, rules).
+        self.literalPatternTargets = {}
+
+        # Maps a suffix (e.g. .o) to a list of (order, suffix made from, key).
+        self.suffixRules = {}
+
+        # Maps absolute paths to a list of (order, key).
+        self.explicitTargets = {}
+
+        for key in list(targets.keys()):
+            self.add(key)
+
+    # Add [key] (already in [targets]) to the index. Candidates are returned in the
+    # order they were added.
+    def add(self, key):
+        if key in self.indexed:
+            return
+        self.indexed.add(key)
+        order = len(self.indexed)
+
+        if self.isPatternRule(key):
+            details, rules = self.targets[key]
+            generates, deps = details
+
+            # Replacing each '%' in deps with the stem then only needs a join.
+            depParts = escaper.escapeSafeSplit(" ".join(deps), "%", "\\")
+
+            for index in range(len(generates)):
+                targetTest = generates[index]
+                entryOrder = (order, index)
+
+                if not '%' in targetTest:
+                    self.literalPatternTargets.setdefault(targetTest, []).append((entryOrder, deps, rules))
+                    continue
+
+                sepIndex = targetTest.index("%")
+                beforeContent = targetTest[:sepIndex]
+                afterContent = targetTest[sepIndex + 1 :]
+
+                bySuffix = self.patternRules.setdefault(len(afterContent), {})
+                bySuffix.setdefault(afterContent, []).append((entryOrder, beforeContent, afterContent, depParts, rules))
+        elif key.startswith(".") and "." in key[1:] and not "/" in key: # Paths like ./foo.c aren't suffix rules.
+            parts = key[1:].split('.') # NOT a regex.
+
+            # Don't index... The user probably didn't intend for us to
+            # make a recipe from this.
+            if len(parts) > 2:
+                return
+
+            requires = '.' + parts[0].strip()
+            creates = '.' + parts[1].strip()
+            self.suffixRules.setdefault(creates, []).append(((order, 0), requires, key))
+        else:
+            self.explicitTargets.setdefault(os.path.abspath(key), []).append(((order, 0), key))
+
+    # Get a list of (dependencies, rules) for each rule that could make [target],
+    # in the order the rules were added.
+    def getCandidates(self, target):
+        candidates = []
+
+        for entryOrder, deps, rules in self.literalPatternTargets.get(target, []):
+            # Replace all '%' symbols with wildcard symbols.
+            dependsOn = runner.shSplit(" ".join(deps).replace("%", "*"), splitChars={ ' ', ';' })
+            candidates.append((entryOrder, dependsOn, rules))
+
+        for suffixLength in self.patternRules:
+            if suffixLength > len(target):
+                continue
+
+            suffix = target[len(target) - suffixLength:]
+
+            for entryOrder, beforeContent, afterContent, depParts, rules in self.patternRules[suffixLength].get(suffix, []):
+                if not target.startswith(beforeContent) or len(target) < len(beforeContent) + len(afterContent):
+                    continue
+
+                stem = target[len(beforeContent) : len(target) - len(afterContent)]
+                deps = stem.join(depParts).split(" ")
+                candidates.append((entryOrder, deps, rules))
+
+        dotIndex = target.rfind('.')
+        if dotIndex >= 0 and ".SUFFIXES" in self.targets:
+            creates = target[dotIndex:]
+            validSuffixes,_ = self.targets[".SUFFIXES"]
+
+            for entryOrder, requires, key in self.suffixRules.get(creates, []):
+                # Are these valid suffixes?
+                if not creates in validSuffixes or not requires in validSuffixes:
+                    continue
+
+                deps, rules = self.targets[key]
+                newDeps = [ dep for dep in deps if dep != '' ]
+                withoutExtension = target[: - len(creates)]
+                newDeps.append(withoutExtension + requires)
+
+                candidates.append((entryOrder, newDeps, rules))
+
+        # Is it the same thing, just formatted differently?
+        for entryOrder, key in self.explicitTargets.get(os.path.abspath(target), []):
+            deps, rules = self.targets[key]
+            candidates.append((entryOrder, deps, rules))
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        return [ (deps, rules) for _, deps, rules in candidates ]
+
+if __name__ == "__main__":
+    print("Testing ruleUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    targets = \
+    {
+        "%.o: %.cc %.h": ((['%.o'], ['%.cc', '%.h']), ['cc-recipe']),
+        "%.o: %.c %.h": ((['%.o'], ['%.c', '%.h']), ['c-recipe']),
+        "lib%.a: %.o": ((['lib%.a'], ['%.o']), ['ar-recipe']),
+        ".SUFFIXES": ([ '.y', '.txt' ], []),
+        ".y.txt": ([], ['suffix-recipe']),
+        "foo.txt": ([ 'bar.txt' ], ['explicit-recipe']),
+    }
+
+    index = RuleIndex(targets, lambda key: '%' in key)
+
+    assertEql(index.getCandidates("main.o"), [ (['main.cc', 'main.h'], ['cc-recipe']), (['main.c', 'main.h'], ['c-recipe']) ],
+            "Pattern rules are returned in order.")
+    assertEql(index.getCandidates("libm.a"), [ (['m.o'], ['ar-recipe']) ], "Prefixes are checked.")
+    assertEql(index.getCandidates("a"), [], "Targets that don't match anything.")
+    assertEql(index.getCandidates("doc.txt"), [ (['doc.y'], ['suffix-recipe']) ], "Suffix rules.")
+    assertEql(index.getCandidates("./foo.txt"), [ (['./foo.y'], ['suffix-recipe']), (['bar.txt'], ['explicit-recipe']) ],
+            "Differently formatted explicit targets.")
+
+    targets["./new.txt"] = ([], ['generated-recipe'])
+    index.add("./new.txt")
+    assertEql(index.getCandidates("new.txt")[-1], ([], ['generated-recipe']), "Targets can be added after the index is created.")
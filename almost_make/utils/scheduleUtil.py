@@ -0,0 +1,452 @@
+#!/usr/bin/python3
+
+# Runs the recipes in a build graph.
+# The whole graph is resolved before anything runs. Then, a fixed pool
+# of workers takes targets from a ready-queue as soon as all of their
+# prerequisites have finished. Each target is built at most once, even if
+# it can be reached through many paths (e.g. a diamond dependency).
+# Before a job starts, a job slot is taken from [jobSlots] (see jobserverUtil).
+#
+# When several nodes are ready, the node on the longest path to the end of the
+# build (by estimated duration) runs first. That way, long chains (e.g. ending
+# in a slow link step) start as early as possible.
+#
+# If a job fails, no new jobs start, unless keepGoing is set (-k). Then, only the nodes
+# that depend on the failed node, directly or through others, are dropped.
+#
+# Nodes can be put in named pools (like ninja's), which limit how many of their jobs
+# run at once (e.g. link steps that each need a lot of memory), on top of [maxJobs].
+#
+# Jobs run on a pool of threads, unless the async executor is used (see asyncScheduleUtil).
+
+import threading, heapq, contextvars
+
+import almost_make.utils.jobserverUtil as jobserverUtil
+
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_ASYNC = 'async'
+
+EXECUTORS = [ EXECUTOR_THREAD, EXECUTOR_ASYNC ]
+
+# Like threading.local, but local to the job being run: to the thread running it or,
+# with the async executor, to its asyncio task. Attributes that haven't been set in
+# the current job have the value they had when the job started.
+class JobLocal:
+    def __init__(self):
+        object.__setattr__(self, 'variables', {})
+
+    def __getattr__(self, name):
+        if not name in self.variables:
+            raise AttributeError(name)
+
+        try:
+            return self.variables[name].get()
+        except LookupError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.variables.setdefault(name, contextvars.ContextVar(name)).set(value)
+
+# The job being run. With the async executor, .lane is a small number that no other job
+# running at the same time has. All jobs share one thread, so traceUtil shows each
+# lane, rather than each thread, as its own row.
+currentJob = JobLocal()
+
+# Limits how many jobs for the nodes in it run at the same time.
+class Pool:
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = max(1, depth)
+        self.running = 0
+        self.waiting = [] # A heap of ready-queue entries for nodes waiting for room in this pool.
+
+class BuildNode:
+    def __init__(self, target):
+        self.target = target
+        self.deps = []        # Nodes that must finish before this one can start.
+        self.dependents = []  # Nodes that are waiting for this one.
+        self.waitingOn = 0    # Number of deps that haven't finished yet.
+        self.result = None    # Value returned by the job that ran for this node.
+        self.priority = 0     # Estimated time from when this node starts to the end of the build.
+        self.pool = None      # The Pool this node's job runs in, if any.
+        self.exception = None # With keepGoing, what this node's job raised, if it failed.
+        self.skipped = False  # Whether this node's job didn't run, because a job it depends on failed.
+        self.done = threading.Event()
+
+    # Block until this node's job has finished. Returns the node's result.
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+class Scheduler:
+    # [getEstimate], if given, should return the estimated duration of a node's job.
+    # Otherwise, ready nodes run in the order they became ready.
+    # If [keepGoing], jobs that raise an Exception only stop the nodes that depend on them.
+    # [onFailure], if given, is called when the build stops because a job failed (e.g. to stop
+    # other running jobs early).
+    def __init__(self, maxJobs=1, jobSlots=None, getEstimate=None, keepGoing=False, onFailure=None):
+        self.maxJobs = max(1, maxJobs)
+        self.jobSlots = jobSlots or jobserverUtil.JobSlots(self.maxJobs)
+        self.getEstimate = getEstimate
+        self.keepGoing = keepGoing
+        self.onFailure = onFailure
+        self.nodes = {}
+        self.pools = {}
+        self.ready = [] # A heap of (-priority, order added, node).
+        self.readyCount = 0
+        self.lock = threading.Condition()
+        self.remaining = 0
+        self.acquiring = 0  # Number of workers waiting for a job slot.
+        self.failure = None # The first exception raised by a job that stopped the build, if any.
+        self.failed = []    # With keepGoing, the nodes whose jobs failed.
+        self.skipped = []   # With keepGoing, the nodes that didn't run because of those failures.
+
+    # Get whether there is a node for [target].
+    def hasNode(self, target):
+        return target in self.nodes
+
+    # Get the node for [target], creating it if it doesn't exist.
+    def getNode(self, target):
+        if not target in self.nodes:
+            self.nodes[target] = BuildNode(target)
+        return self.nodes[target]
+
+    # Add a pool, [name], in which at most [depth] jobs can run at once.
+    def addPool(self, name, depth):
+        self.pools[name] = Pool(name, depth)
+
+    # Run [node]'s job in the pool named [poolName].
+    def setPool(self, node, poolName):
+        node.pool = self.pools[poolName]
+
+    # [node] can't start until [dep] has finished.
+    def addDependency(self, node, dep):
+        if dep in node.deps:
+            return
+
+        node.deps.append(dep)
+        dep.dependents.append(node)
+
+    # Get whether [node] can't start until [dep] has finished, directly or through other nodes.
+    def dependsOn(self, node, dep):
+        toVisit = [ node ]
+        visited = set()
+
+        while len(toVisit) > 0:
+            current = toVisit.pop()
+
+            if current is dep:
+                return True
+
+            if not current in visited:
+                visited.add(current)
+                toVisit.extend(current.deps)
+        return False
+
+    # Add [node] to the ready-queue. Must be called with [lock] held (or before running).
+    def pushReady(self, node):
+        heapq.heappush(self.ready, (-node.priority, self.readyCount, node))
+        self.readyCount += 1
+
+    # Remove and return the highest-priority node in the ready-queue that can start now, or
+    # None. Nodes whose pools are full wait in their pools, rather than the ready-queue.
+    # Must be called with [lock] held (or from the only thread running jobs).
+    def popReady(self):
+        while len(self.ready) > 0:
+            entry = heapq.heappop(self.ready)
+            pool = entry[2].pool
+
+            if pool is None:
+                return entry[2]
+
+            if pool.running < pool.depth:
+                pool.running += 1
+                return entry[2]
+            heapq.heappush(pool.waiting, entry)
+        return None
+
+    # Set the priority of each node to the estimated duration of the longest
+    # path from it to a node nothing depends on.
+    def computePriorities(self):
+        if self.getEstimate is None:
+            return
+
+        # Visit each node after all of its dependents.
+        waitingOn = { node: len(node.dependents) for node in self.nodes.values() }
+        toVisit = [ node for node in self.nodes.values() if waitingOn[node] == 0 ]
+
+        while len(toVisit) > 0:
+            node = toVisit.pop()
+            node.priority = self.getEstimate(node) + max([ parent.priority for parent in node.dependents ], default=0)
+
+            for dep in node.deps:
+                waitingOn[dep] -= 1
+
+                if waitingOn[dep] == 0:
+                    toVisit.append(dep)
+
+    # Note that [node]'s job is no longer running in its pool, if it has one.
+    def leavePool(self, node):
+        if node.pool is not None:
+            node.pool.running -= 1
+
+            # The pool has room for another node.
+            if len(node.pool.waiting) > 0:
+                heapq.heappush(self.ready, heapq.heappop(node.pool.waiting))
+
+    # Mark [node] as finished with [result] and queue any dependents
+    # that were only waiting on it. Must be called with [lock] held.
+    def finishNode(self, node, result):
+        node.result = result
+        node.done.set()
+        self.remaining -= 1
+        self.leavePool(node)
+
+        for parent in node.dependents:
+            parent.waitingOn -= 1
+
+            if parent.waitingOn == 0:
+                self.pushReady(parent)
+        self.lock.notify_all()
+
+    # Note that [node]'s job raised [exception]. With keepGoing (unless [exception] isn't
+    # an Exception, e.g. KeyboardInterrupt), drop every node that depends on [node], and
+    # keep running the others. Otherwise, stop the build. Must be called with [lock] held.
+    def failNode(self, node, exception):
+        if not self.keepGoing or not isinstance(exception, Exception):
+            if self.failure is None:
+                self.failure = exception
+
+                if self.onFailure is not None:
+                    self.onFailure()
+            self.lock.notify_all()
+            return
+
+        node.exception = exception
+        node.done.set()
+        self.failed.append(node)
+        self.remaining -= 1
+        self.leavePool(node)
+
+        # These can't have started: each waits on [node], directly or through other nodes.
+        toSkip = list(node.dependents)
+
+        while len(toSkip) > 0:
+            dependent = toSkip.pop()
+
+            if not dependent.skipped:
+                dependent.skipped = True
+                dependent.done.set()
+                self.skipped.append(dependent)
+                self.remaining -= 1
+                toSkip.extend(dependent.dependents)
+        self.lock.notify_all()
+
+    # Take nodes from the ready-queue and run them until there is
+    # nothing left to do, or a job has failed.
+    def work(self, runJob):
+        while True:
+            with self.lock:
+                # Only wait for a job slot if there is a node for it. Otherwise,
+                # we could hold tokens other make processes need.
+                while len(self.ready) <= self.acquiring and self.remaining > 0 and self.failure is None:
+                    self.lock.wait()
+
+                if self.remaining == 0 or self.failure is not None:
+                    return
+                self.acquiring += 1
+
+            self.jobSlots.acquire()
+
+            with self.lock:
+                self.acquiring -= 1
+
+                node = None
+                if self.failure is None:
+                    node = self.popReady()
+
+                if node is None:
+                    self.jobSlots.release()
+                    continue
+
+            try:
+                result = runJob(node)
+            except BaseException as ex: # errorUtil's reportError raises SystemExit.
+                with self.lock:
+                    self.failNode(node, ex)
+                continue
+            finally:
+                self.jobSlots.release()
+
+            with self.lock:
+                self.finishNode(node, result)
+
+    # Queue the nodes that can start right away.
+    def prepareRun(self):
+        self.remaining = len(self.nodes)
+        self.computePriorities()
+
+        for node in self.nodes.values():
+            node.waitingOn = len(node.deps)
+
+            if node.waitingOn == 0:
+                self.pushReady(node)
+
+    # Run [runJob] once for each node in the graph, with at most
+    # [maxJobs] jobs running at a time. A node's job is only run after
+    # the jobs for all of its deps have finished. If a job raises an exception (and,
+    # with keepGoing, it isn't an Exception), no new jobs are started and the exception
+    # is re-raised here once all running jobs have finished. With keepGoing, see
+    # [failed] and [skipped] for the jobs that failed and didn't run.
+    def run(self, runJob):
+        self.prepareRun()
+        workerCount = min(self.maxJobs, self.remaining)
+
+        if workerCount <= 1:
+            self.work(runJob)
+        else:
+            workers = [ threading.Thread(target=self.work, args=(runJob,), name='Worker %d' % (i + 1)) for i in range(workerCount) ]
+
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        if self.failure is not None:
+            raise self.failure
+
+if __name__ == "__main__":
+    import time
+    print("Testing scheduleUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    # A diamond: top depends on left and right, which both depend on shared.
+    scheduler = Scheduler(4)
+    top, left, right, shared = [ scheduler.getNode(name) for name in [ 'top', 'left', 'right', 'shared' ] ]
+    scheduler.addDependency(top, left)
+    scheduler.addDependency(top, right)
+    scheduler.addDependency(left, shared)
+    scheduler.addDependency(right, shared)
+
+    order = []
+    orderLock = threading.Lock()
+
+    def recordJob(node):
+        with orderLock:
+            order.append(node.target)
+        return node.target
+
+    scheduler.run(recordJob)
+    assertEql(len(order), 4, "Each node runs exactly once.")
+    assertEql(order[0], 'shared', "The shared dependency runs first.")
+    assertEql(order[-1], 'top', "The top-level target runs last.")
+    assertEql(top.wait(), 'top', "Nodes store their results.")
+    assertEql(scheduler.dependsOn(top, shared), True, "Dependencies can be indirect.")
+    assertEql(scheduler.dependsOn(left, right), False, "Siblings don't depend on each other.")
+
+    # With estimates, the longest chain starts first.
+    scheduler = Scheduler(1, getEstimate=lambda node: 10 if node.target == 'link' else 1)
+    top, compile1, compile2, link = [ scheduler.getNode(name) for name in [ 'top', 'compile1', 'compile2', 'link' ] ]
+    scheduler.addDependency(top, compile1)
+    scheduler.addDependency(top, compile2)
+    scheduler.addDependency(top, link)
+    scheduler.addDependency(link, compile2)
+
+    order = []
+    scheduler.run(recordJob)
+    assertEql(order, [ 'compile2', 'link', 'compile1', 'top' ], "Nodes on the critical path run first.")
+    assertEql(compile2.priority, 12, "Priorities are path lengths.")
+
+    # A failing job stops the build.
+    scheduler = Scheduler(2)
+    parent = scheduler.getNode('parent')
+    scheduler.addDependency(parent, scheduler.getNode('child'))
+
+    def failOnChild(node):
+        if node.target == 'child':
+            raise SystemExit(1)
+        return True
+
+    try:
+        scheduler.run(failOnChild)
+        raise Exception("Scheduler.run should re-raise job failures.")
+    except SystemExit:
+        pass
+    assertEql(parent.done.is_set(), False, "Dependents of a failed job don't run.")
+
+    # With keepGoing, only the nodes that depend on a failed job are dropped.
+    failures = []
+    scheduler = Scheduler(2, keepGoing=True, onFailure=lambda: failures.append(True))
+    top, app, other, broken, working = [ scheduler.getNode(name) for name in [ 'top', 'app', 'other', 'broken.o', 'working.o' ] ]
+    scheduler.addDependency(top, app)
+    scheduler.addDependency(top, other)
+    scheduler.addDependency(app, broken)
+    scheduler.addDependency(app, working)
+    scheduler.addDependency(other, working)
+
+    def failOnBroken(node):
+        if node.target == 'broken.o':
+            raise Exception("Failed")
+        return True
+
+    scheduler.run(failOnBroken)
+    assertEql([ node.target for node in scheduler.failed ], [ 'broken.o' ], "Failed jobs are recorded.")
+    assertEql(sorted([ node.target for node in scheduler.skipped ]), [ 'app', 'top' ], "Nodes that depend on failed jobs don't run.")
+    assertEql((other.result, working.result), (True, True), "Other nodes still run.")
+    assertEql(failures, [], "With keepGoing, failed jobs don't stop the build.")
+
+    scheduler = Scheduler(2, onFailure=lambda: failures.append(True))
+    scheduler.getNode('broken.o')
+
+    try:
+        scheduler.run(failOnBroken)
+        raise Exception("Without keepGoing, Scheduler.run should re-raise job failures.")
+    except Exception as ex:
+        assertEql(str(ex), "Failed", "The job's exception is re-raised.")
+    assertEql(failures, [ True ], "onFailure is called when a failed job stops the build.")
+
+    # Pools limit how many of their nodes run at once.
+    scheduler = Scheduler(4)
+    scheduler.addPool('link', 1)
+    running = { 'link': 0, 'all': 0 }
+    mostRunning = { 'link': 0, 'all': 0 }
+
+    for index in range(6):
+        node = scheduler.getNode(index)
+
+        if index % 2 == 0:
+            scheduler.setPool(node, 'link')
+
+    def sleepJob(node):
+        kinds = [ 'all' ] + ([ 'link' ] if node.pool is not None else [])
+
+        with orderLock:
+            for kind in kinds:
+                running[kind] += 1
+                mostRunning[kind] = max(mostRunning[kind], running[kind])
+        time.sleep(0.05)
+
+        with orderLock:
+            for kind in kinds:
+                running[kind] -= 1
+
+    scheduler.run(sleepJob)
+    assertEql(mostRunning['link'], 1, "Pools limit how many of their jobs run at once.")
+    assertEql(mostRunning['all'] > 1, True, "Other jobs still run in parallel.")
+
+    local = JobLocal()
+    local.value = 'main'
+    values = []
+
+    def setLocal():
+        values.append(getattr(local, 'value', None))
+        local.value = 'thread'
+        values.append(local.value)
+
+    thread = threading.Thread(target=setLocal)
+    thread.start()
+    thread.join()
+    assertEql((values, local.value), ([ None, 'thread' ], 'main'), "JobLocals are local to each thread.")
@@ -16,11 +16,19 @@ import os, fnmatch, re
 
 HAS_PATTERN = re.compile(r"([^\\]{2})*[\*\[\]]")
 
+# Matches the characters that glob handles specially. Text without any of these
+# (e.g. most prerequisites) can't match anything. On Windows, paths containing '/'
+# are also normalized.
+SPECIAL_CHARS = re.compile(r"[\"'\\ \[\]\*~/]" if os.name == 'nt' else r"[\"'\\ \[\]\*~]")
+
 # Glob the contents of [text] if it appears to be a path using
 # patterns supported by Python's fnmatch module. If no matches
 # are found and [defaultCase] is given, return [defaultCase].
 # Otherwise, return [text], possibly with tilde-expansion.
 def glob(text, cwd, defaultCase = None):
+    if SPECIAL_CHARS.search(text) is None:
+        return [ text ] if defaultCase == None else defaultCase
+
     # First, determine if the text needs to be/can be globbed.
     canGlob = False
     canSimplify = False
@@ -148,6 +156,7 @@ if __name__ == "__main__":
         assertEql(pathSetA, pathSetB, message)
 
     assertEql(glob("willNotMatch", "."), ["willNotMatch"], "A glob that does nothing!")
+    assertEql(glob("willNotMatch", ".", []), [], "Plain text without matches gives the default case.")
     assertPathListsEql(glob("*.txt", "."), ["*.txt"], "A glob that does nothing (but is a valid glob)!")
     assertHas(glob("*.py", "."), "globber.py", "Finding this script with a glob!")
     assertHas(glob("globber.*", "."), "globber.py", "Finding this script with a different glob!")
@@ -4,9 +4,9 @@
 # See: https://www.gnu.org/software/bash/manual/bash.html#Shell-Expansions
 
 import shlex, os, re
-import subprocess
 
 import almost_make.utils.shellUtil.globber as globber
+import almost_make.utils.spawnUtil as spawnUtil
 
 PRECEDENCE_LIST = [ '||', '&&', ";", '|', '>', '2>&1', '&' ]
 TWO_ARGUMENTS = { "||", "&&", ";", '|', '>' }
@@ -273,10 +273,9 @@ def rawRun(args, customCommands={}, flags=[], stdin=None, stdout=None, stderr=No
         return result
 
     if blocking:
-        proc = subprocess.run(args, stdin=stdin, stdout=stdout, stderr=stderr, shell=sysShell, close_fds=False, cwd=state.cwd)
-        return proc.returncode
+        return spawnUtil.run(args, stdin=stdin, stdout=stdout, stderr=stderr, shell=sysShell, cwd=state.cwd)
     else:
-        result = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, shell=sysShell, close_fds=False, cwd=state.cwd)
+        result = spawnUtil.spawn(args, stdin=stdin, stdout=stdout, stderr=stderr, shell=sysShell, cwd=state.cwd)
 
         if returnOverride:
             return 0
@@ -453,9 +452,49 @@ def filterSplitList(splitString):
     
     return result
 
+# Split [text] into lines, except where newlines are quoted or escaped.
+def splitLines(text):
+    escaped = False
+    inQuote = None
+    result = []
+    buff = ""
+
+    for char in text:
+        if char == '\n' and not escaped and inQuote == None:
+            result.append(buff)
+            buff = ""
+            continue
+
+        buff += char
+        if char in { '"', "'" } and not escaped:
+            if inQuote == char:
+                inQuote = None
+            elif inQuote == None:
+                inQuote = char
+        elif char == '\\' and not escaped:
+            escaped = True
+        elif escaped:
+            escaped = False
+
+    result.append(buff)
+    return result
+
 # Run the POSIX-like shell command [commandString]. Define
-# any additional commands through [customCommands].
-def runCommand(commandString, customCommands = {}, flags = [], state=ShellState()):
+# any additional commands through [customCommands]. If given, [stdout] and [stderr]
+# are file descriptors to which output is written.
+# Like sh, each line of a multi-line [commandString] runs in turn (with the same [state]),
+# and the status of the last is returned.
+def runCommand(commandString, customCommands = {}, flags = [], state=ShellState(), stdout=None, stderr=None):
+    lines = splitLines(commandString)
+
+    if len(lines) > 1:
+        status = 0
+
+        for line in lines:
+            if line.strip() != '':
+                status = runCommand(line, customCommands, flags, state, stdout, stderr)
+        return status
+
     # Note: punctuation_chars=True causes shlex to cluster ();&| runs.
     #       For example, a && b -> ['a', '&&', 'b'], instead of ['a', '&', '&', 'b'].
     #       It also, however, clusters runs we don't want, like a &&& b -> ['a', '&&&', 'b'].
@@ -464,7 +503,7 @@ def runCommand(commandString, customCommands = {}, flags = [], state=ShellState(
     portions = filterSplitList(shSplit(commandString))
     ordered = cluster(portions) # Convert ['a', '&&', 'b', '||', 'c'] into
                                 #       [[['a'], '&&', ['b']], '||', ['c']]
-    return evalCommand(ordered, customCommands, flags, state=state)
+    return evalCommand(ordered, customCommands, flags, stdout=stdout, stderr=stderr, state=state)
 
 if __name__ == "__main__":
     # Run directly? Run tests!
@@ -477,6 +516,7 @@ if __name__ == "__main__":
     assertEql("1", "1", "This should always pass. A test of assertEql.")
     assertEql(['1', ['2', '3']], ['1', ['2', '3']], "We rely on this for our tests.")
 
+    assertEql(splitLines("a\nb 'c\nd' e\\\nf"), [ "a", "b 'c\nd' e\\\nf" ], "Quoted and escaped newlines don't split lines.")
     assertEql(cluster([]), [], "Empty cluster")
     assertEql(cluster(['a']), ['a'], "Identity cluster")
     assertEql(cluster([ "a", "||", "b"]), [['a'], '||', ['b']], "Simple cluster test.")
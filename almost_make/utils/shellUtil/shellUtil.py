@@ -602,7 +602,7 @@ def getCustomCommands(macros):
     
     return result
 
-def evalScript(text, macroUtil, macros={}, defaultFlags = [], state=None):
+def evalScript(text, macroUtil, macros={}, defaultFlags = [], state=None, stdout=None, stderr=None):
     if not state:
         state = runner.ShellState()
     
@@ -610,7 +610,7 @@ def evalScript(text, macroUtil, macros={}, defaultFlags = [], state=None):
     macros["PWD"] = state.cwd
 
     text, macros = macroUtil.expandAndDefineMacros(text, macros)
-    return (runner.runCommand(text, getCustomCommands(macros), defaultFlags, state), macros)
+    return (runner.runCommand(text, getCustomCommands(macros), defaultFlags, state, stdout, stderr), macros)
 
 if __name__ == "__main__":
     import almost_make.utils.macroUtil as macroUtility
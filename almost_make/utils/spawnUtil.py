@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+# Starts commands with os.posix_spawnp, rather than subprocess.
+# A parsed build graph can make almake's process large. Where fork (rather than vfork)
+# is used, every started command pays to copy almake's page tables. posix_spawn lets the
+# C library use vfork (or clone with CLONE_VM) on every platform that has it.
+#
+# Redirections are done with posix_spawn file actions. Where posix_spawnp isn't available
+# (e.g. on Windows), or a command must run in a directory other than almake's own
+# (Python has no file action for changing directories), subprocess is used instead.
+#
+# Started commands are tracked until they're waited for, so that they can be stopped
+# early (see terminateAll), e.g. when another recipe fails and the build won't finish.
+
+import os, sys, signal, threading, subprocess
+
+SHELL = '/bin/sh'
+
+# Signals Python ignores that commands should see with their default handlers.
+# (subprocess does the same, with restore_signals.)
+DEFAULT_SIGNALS = [ getattr(signal, name) for name in [ 'SIGPIPE', 'SIGXFSZ' ] if hasattr(signal, name) ]
+
+canSpawn = hasattr(os, 'posix_spawnp') and os.name != 'nt'
+
+# Get the exit code of a process with the status [status], from os.waitpid.
+# Like subprocess, a process killed by a signal has a negative exit code.
+def getExitCode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+# Get the file descriptor [stream] (None, a file descriptor or a file) refers to.
+def getFd(stream):
+    if stream is None or type(stream) == int:
+        return stream
+    return stream.fileno()
+
+# A command started by posix_spawnp. Has the parts of subprocess.Popen's interface
+# used by almake.
+class Process:
+    def __init__(self, pid, args):
+        self.pid = pid
+        self.args = args
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = getExitCode(status)
+            runningProcesses.remove(self)
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def communicate(self):
+        self.wait()
+        return (None, None)
+
+# Commands that have been started, but not waited for.
+class RunningProcesses:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+
+    # [process] should have returncode and terminate(), like a subprocess.Popen.
+    def add(self, process):
+        with self.lock:
+            # Drop processes that were waited for elsewhere (e.g. a subprocess.Popen).
+            self.processes = { running for running in self.processes if running.returncode is None }
+            self.processes.add(process)
+
+    def remove(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    # Send SIGTERM to each command that is still running. Commands that start their own
+    # children (e.g. a shell running a pipeline) are responsible for stopping them.
+    def terminateAll(self):
+        with self.lock:
+            processes = list(self.processes)
+
+        for process in processes:
+            try:
+                process.terminate()
+            except ProcessLookupError: # e.g. an asyncio process that has already exited.
+                pass
+
+runningProcesses = RunningProcesses()
+
+# Stop all commands started with spawn (or added to runningProcesses) that are still running.
+def terminateAll():
+    runningProcesses.terminateAll()
+
+# Get whether a command can be started with posix_spawnp, given its redirections
+# [fds] (a list of None or file descriptors for stdin, stdout, stderr) and [cwd].
+def canSpawnWith(fds, cwd):
+    if not canSpawn:
+        return False
+
+    # dup2-ing one standard stream over another depends on the order the file
+    # actions run in. Leave these to subprocess.
+    for target, fd in enumerate(fds):
+        if fd is not None and fd != target and fd < 3:
+            return False
+
+    return cwd is None or os.path.abspath(cwd) == os.getcwd()
+
+# Start [args] (a list of arguments or, if [shell], a command for the system shell),
+# with stdin, stdout, and stderr redirected to [stdin], [stdout], and [stderr], if given,
+# in the directory [cwd]. Returns a Process or a subprocess.Popen.
+def spawn(args, stdin=None, stdout=None, stderr=None, cwd=None, shell=False):
+    fds = [ getFd(stdin), getFd(stdout), getFd(stderr) ]
+
+    if not canSpawnWith(fds, cwd):
+        process = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, shell=shell, close_fds=False, cwd=cwd)
+        runningProcesses.add(process)
+        return process
+
+    if shell:
+        if type(args) == str:
+            args = [ args ]
+        args = [ SHELL, '-c' ] + list(args)
+    elif type(args) == str:
+        args = [ args ]
+
+    fileActions = [ (os.POSIX_SPAWN_DUP2, fd, target) for target, fd in enumerate(fds) if fd is not None and fd != target ]
+    pid = os.posix_spawnp(args[0], args, os.environ, file_actions=fileActions, setsigdef=DEFAULT_SIGNALS)
+
+    process = Process(pid, args)
+    runningProcesses.add(process)
+    return process
+
+# Run [args] (see spawn) and wait for it to exit. Returns its exit code.
+# If [check] and the command fails, raises subprocess.CalledProcessError.
+def run(args, stdin=None, stdout=None, stderr=None, cwd=None, shell=False, check=False):
+    process = spawn(args, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd, shell=shell)
+
+    try:
+        returncode = process.wait()
+    finally:
+        runningProcesses.remove(process)
+
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return returncode
+
+if __name__ == "__main__":
+    import tempfile
+    print("Testing spawnUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    def runWithOutput(args, **kwargs):
+        with tempfile.TemporaryFile() as output:
+            status = run(args, stdout=output.fileno(), **kwargs)
+            output.seek(0)
+            return (status, output.read())
+
+    python = sys.executable
+
+    assertEql(runWithOutput([ python, '-c', 'print("Out")' ]), (0, b"Out\n"), "stdout is redirected.")
+    assertEql(run([ python, '-c', 'import sys; sys.exit(3)' ]), 3, "Exit codes are returned.")
+    assertEql(runWithOutput('echo "Shell"; exit 2', shell=True), (2, b"Shell\n"), "Commands can be run by the shell.")
+
+    if canSpawn:
+        process = spawn([ python, '-c', '' ])
+        assertEql((type(process), process.wait()), (Process, 0), "posix_spawnp is used when possible.")
+        process = spawn([ python, '-c', '' ], cwd='/')
+        assertEql(type(process) == Process, os.getcwd() == '/', "Other directories fall back to subprocess.")
+        process.wait()
+        assertEql(run('kill -9 $$', shell=True), -signal.SIGKILL, "Signals give negative exit codes.")
+
+        if os.path.exists('/proc/self/status'):
+            status = runWithOutput([ 'grep', 'SigIgn', '/proc/self/status' ])[1]
+            ignored = int(status.split()[-1], 16)
+            assertEql(ignored & (1 << (signal.SIGPIPE - 1)), 0, "Commands don't ignore SIGPIPE.")
+
+    assertEql(runWithOutput('pwd', shell=True, cwd='/')[1].strip(), b"/", "Commands can run in other directories.")
+
+    readFd, writeFd = os.pipe()
+    with tempfile.TemporaryFile() as output:
+        process = spawn([ python, '-c', 'print(input().upper())' ], stdin=readFd, stdout=output)
+        os.close(readFd)
+        os.write(writeFd, b"piped\n")
+        os.close(writeFd)
+        process.communicate()
+
+        output.seek(0)
+        assertEql((process.returncode, output.read()), (0, b"PIPED\n"), "stdin is redirected.")
+
+    try:
+        run([ python, '-c', 'import sys; sys.exit(1)' ], check=True)
+        assertEql(True, False, "Failing commands raise with check.")
+    except subprocess.CalledProcessError as ex:
+        assertEql(ex.returncode, 1, "Exit codes are kept.")
+
+    process = spawn([ 'sleep', '10' ])
+    assertEql(process in runningProcesses.processes, True, "Started commands are tracked.")
+    terminateAll()
+    assertEql(process.wait(), -signal.SIGTERM, "terminateAll stops running commands.")
+    assertEql(process in runningProcesses.processes, False, "Commands that have been waited for aren't tracked.")
+
+    try:
+        run([ 'almake-command-that-does-not-exist' ])
+        assertEql(True, False, "Missing commands raise.")
+    except FileNotFoundError:
+        pass
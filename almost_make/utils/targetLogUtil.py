@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+# Archives the output of each target's recipe in its own log file, while still
+# showing it on the terminal. The log for a target, foo/bar.o, is [logDir]/foo/bar.o.log.
+# Targets are named relative to the directory containing [logDir], so that recursive
+# makes (in other directories) sharing a log directory don't overwrite each other's logs.
+#
+# Each command's output is read from pipes by a background thread. On Linux, output is
+# moved from the pipes into the log with os.splice, then copied from the log to the
+# terminal with os.sendfile, so the kernel copies the data and Python never reads it.
+# Elsewhere (or if the kernel refuses), output is copied with os.read and os.write.
+
+import os, threading, selectors
+
+import almost_make.utils.scheduleUtil as scheduleUtil
+
+CHUNK_SIZE = 64 * 1024
+
+# Write all of [data] (bytes) to [fd].
+def writeAll(fd, data):
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+# Copies the output of one command into a TargetLog, and to the terminal (or, if
+# [collect], to [collected]).
+class Tee:
+    def __init__(self, log, collect):
+        self.log = log
+        self.collect = collect
+        self.collected = { }
+
+        stdoutRead, self.stdout = os.pipe()
+        stderrRead, self.stderr = os.pipe()
+        self.destinations = { stdoutRead: 1, stderrRead: 2 }
+
+        for fd in self.destinations:
+            self.collected[self.destinations[fd]] = []
+
+        self.thread = threading.Thread(target=self.pump, args=(stdoutRead, stderrRead), daemon=True)
+        self.thread.start()
+
+    # Copy [count] bytes, starting at [offset] in the log, to [destination] (1 or 2).
+    def copyFromLog(self, destination, offset, count):
+        if self.collect:
+            self.collected[destination].append(os.pread(self.log.fd, count, offset))
+            return
+
+        try:
+            while count > 0:
+                sent = os.sendfile(destination, self.log.fd, offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        except OSError:
+            writeAll(destination, os.pread(self.log.fd, count, offset))
+
+    # Move output from [fd] (the read end of a pipe) into the log, then copy it to its destination.
+    # Returns False at end-of-file.
+    def copyChunk(self, fd):
+        offset = self.log.offset
+
+        if self.log.useSplice:
+            try:
+                count = os.splice(fd, self.log.fd, CHUNK_SIZE, offset_dst=offset)
+            except OSError:
+                self.log.useSplice = False # e.g. the log is on a file system that doesn't support splice.
+                return True
+        else:
+            data = os.read(fd, CHUNK_SIZE)
+            os.pwrite(self.log.fd, data, offset)
+            count = len(data)
+
+        if count == 0:
+            return False
+
+        self.log.offset += count
+        self.copyFromLog(self.destinations[fd], offset, count)
+        return True
+
+    def pump(self, stdoutRead, stderrRead):
+        selector = selectors.DefaultSelector()
+        selector.register(stdoutRead, selectors.EVENT_READ)
+        selector.register(stderrRead, selectors.EVENT_READ)
+        openPipes = 2
+
+        try:
+            while openPipes > 0:
+                for key, _ in selector.select():
+                    if not self.copyChunk(key.fd):
+                        selector.unregister(key.fd)
+                        openPipes -= 1
+        finally:
+            selector.close()
+            os.close(stdoutRead)
+            os.close(stderrRead)
+
+    # Wait for the command's output to end (after the command exits). Returns what was
+    # collected from stdout and stderr, as bytes.
+    def finish(self):
+        os.close(self.stdout)
+        os.close(self.stderr)
+        self.thread.join()
+
+        return (b''.join(self.collected[1]), b''.join(self.collected[2]))
+
+# The log of one run of a target's recipe.
+class TargetLog:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        # Not O_APPEND: splice can't write to files opened for appending. Track the offset instead.
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.offset = 0
+        self.useSplice = hasattr(os, 'splice')
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        os.pwrite(self.fd, data, self.offset)
+        self.offset += len(data)
+
+    def close(self):
+        os.close(self.fd)
+
+class TargetLogs:
+    def __init__(self, logDir):
+        self.logDir = os.path.abspath(logDir)
+        self.local = scheduleUtil.JobLocal() # The log of the recipe each job is running.
+
+    # Get the path to the log for [target].
+    def getLogPath(self, target):
+        name = os.path.relpath(os.path.abspath(target), os.path.dirname(self.logDir))
+        parts = [ '__' if part == os.pardir else part for part in name.split(os.sep) ]
+
+        return os.path.join(self.logDir, *parts) + '.log'
+
+    # Start logging the output of the current thread to [target]'s log.
+    def begin(self, target):
+        self.local.log = TargetLog(self.getLogPath(target))
+
+    def end(self):
+        self.local.log.close()
+        self.local.log = None
+
+    def isLogging(self):
+        return getattr(self.local, 'log', None) is not None
+
+    # Add [text] (e.g. an echoed command) to the current log.
+    def write(self, text):
+        if self.isLogging():
+            self.local.log.write(text)
+
+    # Start copying the output of a command into the current log. Give the command
+    # the returned Tee's stdout and stderr file descriptors, then call its finish method.
+    # If [collect], output is collected, rather than written to the terminal.
+    def startTee(self, collect=False):
+        return Tee(self.local.log, collect)
+
+if __name__ == "__main__":
+    import tempfile, shutil, subprocess
+    print("Testing targetLogUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    tempDir = tempfile.mkdtemp()
+    logs = TargetLogs(os.path.join(tempDir, 'logs'))
+
+    assertEql(logs.getLogPath(os.path.join(tempDir, 'foo', 'bar.o')), os.path.join(tempDir, 'logs', 'foo', 'bar.o.log'), "Logs are named after targets.")
+    assertEql(logs.getLogPath(os.path.join(tempDir, '..', 'out')), os.path.join(tempDir, 'logs', '__', 'out.log'), "Logs stay in the log directory.")
+
+    def runLogged(target, command, useSplice=True):
+        logs.begin(target)
+        logs.local.log.useSplice = logs.local.log.useSplice and useSplice
+        logs.write("$ %s\n" % command)
+
+        tee = logs.startTee(collect=True)
+        try:
+            subprocess.run(command, shell=True, stdout=tee.stdout, stderr=tee.stderr)
+        finally:
+            result = tee.finish()
+        logs.end()
+
+        with open(logs.getLogPath(target), 'rb') as file:
+            return (result, file.read())
+
+    target = os.path.join(tempDir, 'out')
+    (stdout, stderr), log = runLogged(target, "echo Out; echo Err 1>&2")
+    assertEql((stdout, stderr), (b"Out\n", b"Err\n"), "Output is collected.")
+    assertEql(log.startswith(b"$ echo Out"), True, "Logs include written text.")
+    assertEql(b"Out\n" in log and b"Err\n" in log, True, "Logs include stdout and stderr.")
+
+    largeCommand = "python3 -c \"import sys; sys.stdout.write('x' * 1000000)\""
+    for useSplice in [ True, False ]:
+        (stdout, _), log = runLogged(target, largeCommand, useSplice)
+        assertEql(len(stdout), 1000000, "Large outputs are copied (splice: %s)." % useSplice)
+        assertEql(log.endswith(b'x' * 1000000), True, "Large outputs are logged (splice: %s)." % useSplice)
+
+    shutil.rmtree(tempDir)
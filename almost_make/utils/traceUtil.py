@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Records where time goes during a build, in Chrome's trace event format.
+# Traces can be viewed with https://ui.perfetto.dev or chrome://tracing.
+# See https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+#
+# Each thread (e.g. each of the scheduler's workers) is shown as its own row. With the
+# async executor, jobs share a thread, so each job's lane (see scheduleUtil.currentJob)
+# is shown as its own row instead.
+
+import os, json, time, threading
+
+import almost_make.utils.scheduleUtil as scheduleUtil
+
+# Returned by NullTracer.span. Does nothing.
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+# A tracer that records nothing. Used when tracing is off, so that
+# spans cost almost nothing.
+class NullTracer:
+    def span(self, name, category, args=None):
+        return NULL_SPAN
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.tracer.addComplete(self.name, self.category, self.start, time.perf_counter(), self.args)
+        return False
+
+class Tracer(NullTracer):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.threadIds = {} # Maps thread identifiers (or ('lane', lane)) to small integers (tids).
+        self.pid = os.getpid()
+        self.startTime = time.perf_counter()
+
+    # Get the tid of the current thread or, with the async executor, of the current
+    # job's lane. Must be called with [lock] held.
+    def getThreadId(self):
+        ident = threading.get_ident()
+        name = threading.current_thread().name
+        lane = getattr(scheduleUtil.currentJob, 'lane', None)
+
+        if lane is not None:
+            ident = ('lane', lane)
+            name = "Job %d" % lane
+
+        if not ident in self.threadIds:
+            self.threadIds[ident] = len(self.threadIds)
+
+            # Name the thread's row.
+            self.events.append(
+            {
+                'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': self.threadIds[ident],
+                'args': { 'name': name }
+            })
+        return self.threadIds[ident]
+
+    # Get a context manager that records the time spent in its body as an event,
+    # [name], in [category]. [args] is shown with the event.
+    def span(self, name, category, args=None):
+        return Span(self, name, category, args)
+
+    # Record an event that started at [start] and ended at [end] (from time.perf_counter).
+    def addComplete(self, name, category, start, end, args=None):
+        event = \
+        {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': (start - self.startTime) * 1e6, 'dur': (end - start) * 1e6,
+            'pid': self.pid,
+        }
+
+        if args is not None:
+            event['args'] = args
+
+        with self.lock:
+            event['tid'] = self.getThreadId()
+            self.events.append(event)
+
+    # Write recorded events to the file at [path].
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+
+        with open(path, 'w') as file:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, file)
+
+if __name__ == "__main__":
+    import tempfile
+    print("Testing traceUtil.py...")
+
+    def assertEql(a, b, message):
+        if a != b:
+            raise Exception("%s != %s (%s)" % (str(a), str(b), message))
+
+    with NullTracer().span('test', 'test'):
+        pass
+
+    tracer = Tracer()
+
+    with tracer.span('outer', 'test', { 'target': 'all' }):
+        thread = threading.Thread(target=lambda: tracer.span('inner', 'test').__enter__().__exit__(None, None, None), name='worker')
+        thread.start()
+        thread.join()
+
+    events = [ event for event in tracer.events if event['ph'] == 'X' ]
+    assertEql([ event['name'] for event in events ], [ 'inner', 'outer' ], "Events are recorded when they end.")
+    assertEql(events[0]['tid'] != events[1]['tid'], True, "Each thread has its own tid.")
+    assertEql(events[1]['args'], { 'target': 'all' }, "Events have arguments.")
+    assertEql(events[1]['dur'] >= events[0]['dur'], True, "Outer events contain inner events.")
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    tracer.write(path)
+
+    with open(path, 'r') as file:
+        assertEql(len(json.load(file)['traceEvents']), 4, "Events and thread names are written.")
+    os.remove(path)
+
+    # Async jobs share a thread, but spans from jobs running at the same time overlap,
+    # so they must be on different rows.
+    import asyncio
+    tracer = Tracer()
+
+    async def asyncJob(lane):
+        scheduleUtil.currentJob.lane = lane
+
+        with tracer.span('job', 'test'):
+            await asyncio.sleep(0.01)
+
+    async def runJobs():
+        await asyncio.gather(*[ asyncJob(lane) for lane in range(3) ])
+
+    asyncio.run(runJobs())
+    events = [ event for event in tracer.events if event['ph'] == 'X' ]
+    assertEql(len(set([ event['tid'] for event in events ])), 3, "Overlapping async jobs have their own tids.")
+
+    with tracer.span('main', 'test'):
+        pass
+    assertEql(tracer.events[-1]['tid'] in [ event['tid'] for event in events ], False, "Lanes aren't set outside of jobs.")
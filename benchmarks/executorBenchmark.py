@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+# Compares the thread and async executors (--executor) at a high -j, as when recipes
+# run on a distributed compiler. Each of many targets runs one short command (sleep),
+# so almake's own overhead decides how close the build gets to the ideal time of
+# (number of targets / jobs) * sleep time.
+#
+# Usage: python3 benchmarks/executorBenchmark.py [number of targets] [jobs] [sleep time, in seconds]
+# Defaults to 5000 targets, -j 500, sleep 0.2.
+
+import os, sys, time, shutil, tempfile, subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(REPO_DIR, 'almost_make', 'cli.py')
+
+# Write a makefile with [count] targets, each of which sleeps for [sleepTime], to [directory].
+def writeMakefile(directory, count, sleepTime):
+    targets = [ "t%d" % index for index in range(count) ]
+
+    with open(os.path.join(directory, 'Makefile'), 'w') as file:
+        file.write("all: %s\n\n" % " ".join(targets))
+
+        for target in targets:
+            file.write("%s:\n\t@sleep %s\n" % (target, sleepTime))
+        file.write(".PHONY: all %s\n" % " ".join(targets))
+
+# Run almake in [directory] with [args]. Returns (time taken in seconds, CPU time in
+# seconds, peak resident memory in MiB) for almake and the commands it ran.
+def timeBuild(directory, args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+    env.pop('_BUILTIN_SHELL', None)
+    env.pop('MAKEFLAGS', None)
+
+    start = time.perf_counter()
+    process = subprocess.Popen([ sys.executable, CLI_PATH ] + args, cwd=directory, env=env)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise Exception("almake %s failed with status %d." % (" ".join(args), process.returncode))
+
+    maxRss = usage.ru_maxrss / 1024 # KiB on Linux.
+    if sys.platform == 'darwin':
+        maxRss /= 1024 # Bytes on macOS.
+    return (elapsed, usage.ru_utime + usage.ru_stime, maxRss)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    jobs = sys.argv[2] if len(sys.argv) > 2 else '500'
+    sleepTime = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        writeMakefile(directory, count, sleepTime)
+        results = [ (executor, timeBuild(directory, [ '-j', jobs, '--executor=' + executor ])) for executor in [ 'thread', 'async' ] ]
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d targets, -j %s, sleep %s (ideal: %.2f s):" % (count, jobs, sleepTime, count / int(jobs) * sleepTime))
+    print("%10s %10s %10s %16s" % ("Executor", "Time (s)", "CPU (s)", "Peak RSS (MiB)"))
+
+    for executor, (elapsed, cpuTime, maxRss) in results:
+        print("%10s %10.2f %10.2f %16.1f" % (executor, elapsed, cpuTime, maxRss))
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# Measures how long almake takes to run a tree of recursive makes, with $(MAKE) -C dir
+# run in the same process and, with _MAKE_IN_SUBPROCESS defined, in a new almake
+# process for each directory.
+#
+# Usage: python3 benchmarks/recursiveMakeBenchmark.py [number of directories] [targets per directory]
+# Defaults to 100 directories, with 10 targets each.
+
+import os, sys, time, shutil, tempfile, subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(REPO_DIR, 'almost_make', 'cli.py')
+
+# Write a makefile to [directory] that runs $(MAKE) in each of [count] subdirectories,
+# each with [targets] up-to-date targets.
+def writeMakefiles(directory, count, targets):
+    subdirs = [ "dir%d" % index for index in range(count) ]
+
+    with open(os.path.join(directory, 'Makefile'), 'w') as file:
+        file.write("all:\n")
+
+        for subdir in subdirs:
+            file.write("\t@$(MAKE) -C %s\n" % subdir)
+        file.write(".PHONY: all\n")
+
+    for subdir in subdirs:
+        path = os.path.join(directory, subdir)
+        os.mkdir(path)
+        names = [ "t%d.txt" % index for index in range(targets) ]
+
+        with open(os.path.join(path, 'Makefile'), 'w') as file:
+            file.write("all: %s\n\n" % " ".join(names))
+            file.write("%.txt:\n\t@touch $@\n")
+
+# Run almake in [directory] with [env] added to the environment. Returns how long it took, in seconds.
+def timeBuild(directory, env):
+    env = dict(os.environ, **env)
+    env['PYTHONPATH'] = REPO_DIR
+    env.pop('_BUILTIN_SHELL', None)
+    env.pop('MAKEFLAGS', None)
+
+    start = time.perf_counter()
+    subprocess.run([ sys.executable, CLI_PATH ], cwd=directory, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    targets = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        writeMakefiles(directory, count, targets)
+        timeBuild(directory, {}) # Make every target, so both runs below only check them.
+
+        inSubprocess = timeBuild(directory, { '_MAKE_IN_SUBPROCESS': '1' })
+        inProcess = timeBuild(directory, {})
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d directories, %d targets each:" % (count, targets))
+    print("  New process per $(MAKE): %.2f s (%.1f ms per directory)" % (inSubprocess, inSubprocess * 1000 / count))
+    print("  In this process:         %.2f s (%.1f ms per directory)" % (inProcess, inProcess * 1000 / count))
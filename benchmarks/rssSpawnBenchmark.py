@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+# Measures how long starting a command takes as almake's memory use grows, with
+# posix_spawn (spawnUtil) and with subprocess. Memory is allocated (and touched, so it's
+# resident) before each round, as a large parsed build graph would be.
+#
+# Usage: python3 benchmarks/rssSpawnBenchmark.py [spawns per round] [sizes, in MiB, e.g. 0,256,1024]
+# Defaults to 500 spawns at 0, 128, 512 and 1024 MiB.
+
+import os, sys, time, resource, subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import almost_make.utils.spawnUtil as spawnUtil
+
+COMMAND = [ 'true' ]
+PAGE_SIZE = resource.getpagesize()
+
+# Allocate [size] MiB and write to each page.
+def allocate(size):
+    ballast = bytearray(size * 1024 * 1024)
+
+    for index in range(0, len(ballast), PAGE_SIZE):
+        ballast[index] = 1
+    return ballast
+
+# Get the largest resident set size of this process so far, in MiB.
+def getMaxRss():
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KiB, macOS bytes.
+    if sys.platform == 'darwin':
+        return maxRss / 1024 / 1024
+    return maxRss / 1024
+
+# Start COMMAND [count] times with [run]. Returns the average time per spawn, in ms.
+def timeSpawns(run, count):
+    start = time.perf_counter()
+
+    for _ in range(count):
+        run()
+    return (time.perf_counter() - start) * 1000 / count
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    sizes = [ int(size) for size in sys.argv[2].split(',') ] if len(sys.argv) > 2 else [ 0, 128, 512, 1024 ]
+
+    if not spawnUtil.canSpawn:
+        print("posix_spawnp isn't available. spawnUtil uses subprocess here.")
+
+    print("%d spawns of %s per round." % (count, " ".join(COMMAND)))
+    print("%10s %16s %16s %16s" % ("RSS (MiB)", "posix_spawn (ms)", "subprocess (ms)", "fork+exec (ms)"))
+
+    def forkExec():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.execvp(COMMAND[0], COMMAND)
+            finally:
+                os._exit(127)
+        os.waitpid(pid, 0)
+
+    for size in sizes:
+        ballast = allocate(size)
+
+        spawnTime = timeSpawns(lambda: spawnUtil.run(COMMAND), count)
+        subprocessTime = timeSpawns(lambda: subprocess.run(COMMAND), count)
+        forkTime = timeSpawns(forkExec, count)
+
+        print("%10d %16.3f %16.3f %16.3f" % (getMaxRss(), spawnTime, subprocessTime, forkTime))
+        del ballast
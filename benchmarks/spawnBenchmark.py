@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+# Measures how long almake takes to run many short recipe lines, with and without
+# starting a shell for each line. Commands without shell syntax (e.g. cc -c foo.c)
+# are run directly; defining _ALWAYS_USE_SHELL runs every command through /bin/sh.
+#
+# Usage: python3 benchmarks/spawnBenchmark.py [number of commands] [jobs]
+# Defaults to 10000 commands, run with -j 1.
+
+import os, sys, time, shutil, tempfile, subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(REPO_DIR, 'almost_make', 'cli.py')
+
+# Write a makefile with [count] targets, each with one command, to [directory].
+def writeMakefile(directory, count):
+    targets = [ "t%d" % index for index in range(count) ]
+
+    with open(os.path.join(directory, 'Makefile'), 'w') as file:
+        file.write("all: %s\n\n" % " ".join(targets))
+
+        for target in targets:
+            file.write("%s:\n\t@sleep 0\n" % target)
+        file.write(".PHONY: all %s\n" % " ".join(targets))
+
+# Run almake in [directory] with [args]. Returns how long it took, in seconds.
+def timeBuild(directory, args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+    env.pop('_BUILTIN_SHELL', None)
+    env.pop('MAKEFLAGS', None)
+
+    start = time.perf_counter()
+    subprocess.run([ sys.executable, CLI_PATH ] + args, cwd=directory, env=env, check=True)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    jobs = sys.argv[2] if len(sys.argv) > 2 else '1'
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        writeMakefile(directory, count)
+
+        withShell = timeBuild(directory, [ '-j', jobs, '_ALWAYS_USE_SHELL=1' ])
+        direct = timeBuild(directory, [ '-j', jobs ])
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d commands, -j %s:" % (count, jobs))
+    print("  Through /bin/sh: %.2f s (%.3f ms per command)" % (withShell, withShell * 1000 / count))
+    print("  Run directly:    %.2f s (%.3f ms per command)" % (direct, direct * 1000 / count))
+    print("  Saved:           %.3f ms per command" % ((withShell - direct) * 1000 / count))
@@ -31,7 +31,8 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "almake = almost_make.cli:main",
-            "almake_shell = almost_make.utils.shellUtil.interactiveShell:main"
+            "almake_shell = almost_make.utils.shellUtil.interactiveShell:main",
+            "almake_cache_server = almost_make.utils.cacheServer:main"
         ]
     },
     python_requires=">=3.6.8"